@@ -1,161 +1,133 @@
 """
-额外的API端点 - 流式生成和其他高级功能
-这个文件包含了一些额外的端点，可以根据需要添加到main.py中
+额外的API端点 - 批量上传和系统状态等高级功能
+流式生成见 main.py 的 /api/generate-stream
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import StreamingResponse
+from PIL import Image
+import asyncio
 import json
-import sqlite3
-from .doubao_api import DoubaoAPIClient, DoubaoImageRequest, resize_image_for_api
-import sqlite3
-from pydantic import BaseModel
-from typing import Optional, List
+import os
+import time
+import database
+from client_registry import ClientRegistry
+from doubao_api import DoubaoAPIClient, resize_image_for_api
+from image_executor import ImageTaskTimeout, image_executor
+from typing import Any, Dict
 
-# 重新定义需要的类型，避免循环导入
-class GenerationParameters(BaseModel):
-    width: Optional[int] = 1024
-    height: Optional[int] = 1024
-    batch_size: Optional[int] = 1
+# 批量上传同时处理的文件数
+BATCH_UPLOAD_WORKERS = int(os.getenv("BATCH_UPLOAD_WORKERS", "4"))
 
-class GenerationRequest(BaseModel):
-    prompt: str
-    parameters: GenerationParameters
-    api_config_id: str
 
-def get_db_connection():
-    """获取数据库连接"""
-    return sqlite3.connect("chat_history.db")
+def upload_error_message(error: Exception) -> str:
+    """返回给客户端的错误信息，不包含异常中的内部细节（详细信息只记录在服务端日志）"""
+    if isinstance(error, ImageTaskTimeout):
+        return "图片处理超时"
+    if isinstance(error, (Image.DecompressionBombError, OSError, SyntaxError)):
+        # Pillow解码失败：无法识别、文件截断或像素数超过限制
+        return "无法识别的图片格式"
+    return "图片处理失败"
 
-# 注意：这些端点需要添加到main.py的app实例中
 
-def add_stream_endpoint(app: FastAPI):
-    """添加流式生成端点到FastAPI应用"""
+def add_advanced_endpoints(app: FastAPI, client_registry: ClientRegistry):
+    """添加高级功能端点"""
     
-    @app.post("/api/stream-generate")
-    async def stream_generate(request: GenerationRequest):
-        """流式生成图片"""
+    async def process_upload(index: int, file: UploadFile) -> Dict[str, Any]:
+        """处理批量上传中的一个文件，返回结果和各阶段耗时"""
+        started = time.perf_counter()
+        result: Dict[str, Any] = {"index": index, "filename": file.filename}
+        if not file.content_type or not file.content_type.startswith('image/'):
+            result.update({"success": False, "error": "不支持的文件类型"})
+            return result
+        
         try:
-            # 获取API配置
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM api_configs WHERE id = ?", (request.api_config_id,))
-            config_row = cursor.fetchone()
-            conn.close()
-            
-            if not config_row:
-                raise HTTPException(status_code=404, detail="API配置不存在")
-            
-            api_key = config_row[3]
-            api_url = config_row[2]
-            model = config_row[5]
-            
-            # 创建豆包API客户端
-            if "/api/v3" in api_url:
-                base_url = api_url.split("/api/v3")[0] + "/api/v3"
-            else:
-                base_url = "https://ark.cn-beijing.volces.com/api/v3"
-                
-            client = DoubaoAPIClient(api_key, base_url)
-            
-            # 构建请求
-            size = f"{request.parameters.width}x{request.parameters.height}"
-            doubao_request = DoubaoImageRequest(
-                model=model or "doubao-seedream-4-0-250828",
-                prompt=request.prompt,
-                size=size,
-                n=request.parameters.batch_size or 1
-            )
-            
-            # 流式生成
-            async def generate_stream():
-                try:
-                    async for chunk in client.stream_generation(doubao_request):
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                    yield "data: [DONE]\n\n"
-                except Exception as e:
-                    error_data = {"error": str(e)}
-                    yield f"data: {json.dumps(error_data)}\n\n"
-            
-            return StreamingResponse(
-                generate_stream(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Headers": "*",
-                }
-            )
-            
+            content = await file.read()
+            read_done = time.perf_counter()
+            # 缩放在图片处理进程池中执行，不阻塞事件循环
+            base64_image = await image_executor.run(resize_image_for_api, data=content)
+            finished = time.perf_counter()
         except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-
-def add_advanced_endpoints(app: FastAPI):
-    """添加高级功能端点"""
+            print(f"批量上传处理文件 {file.filename} 失败: {type(e).__name__}: {e}")
+            result.update({"success": False, "error": upload_error_message(e)})
+            return result
+        
+        result.update({
+            "success": True,
+            "image": base64_image,
+            "size": len(content),
+            "timings": {
+                "read_ms": round((read_done - started) * 1000, 2),
+                "resize_ms": round((finished - read_done) * 1000, 2),
+                "total_ms": round((finished - started) * 1000, 2)
+            }
+        })
+        return result
     
     @app.post("/api/batch-upload")
     async def batch_upload_images(files: list[UploadFile] = File(...)):
-        """批量上传图片"""
-        try:
-            results = []
-            for file in files:
-                if not file.content_type or not file.content_type.startswith('image/'):
-                    results.append({
-                        "filename": file.filename,
-                        "success": False,
-                        "error": "不支持的文件类型"
-                    })
-                    continue
-                
-                content = await file.read()
-                base64_image = resize_image_for_api(content)
-                
-                results.append({
-                    "filename": file.filename,
-                    "success": True,
-                    "image": base64_image,
-                    "size": len(content)
-                })
+        """
+        批量上传图片 - 最多同时处理 BATCH_UPLOAD_WORKERS 个文件，
+        按完成顺序以NDJSON逐行返回每个文件的结果，最后一行为汇总
+        """
+        workers = max(1, min(BATCH_UPLOAD_WORKERS, len(files)))
+        
+        async def stream_results():
+            started = time.perf_counter()
+            # 队列容量等于并发数：客户端读取慢时处理方等待，内存中最多保留少量结果
+            results: asyncio.Queue = asyncio.Queue(maxsize=workers)
+            pending = iter(enumerate(files))
             
-            return {"success": True, "results": results}
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+            async def worker():
+                for index, file in pending:
+                    await results.put(await process_upload(index, file))
+                await results.put(None)
+            
+            tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+            succeeded = failed = 0
+            try:
+                remaining = workers
+                while remaining:
+                    result = await results.get()
+                    if result is None:
+                        remaining -= 1
+                        continue
+                    if result["success"]:
+                        succeeded += 1
+                    else:
+                        failed += 1
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+                
+                yield json.dumps({
+                    "done": True,
+                    "succeeded": succeeded,
+                    "failed": failed,
+                    "total_ms": round((time.perf_counter() - started) * 1000, 2)
+                }) + "\n"
+            finally:
+                # 客户端断开时停止处理剩余文件
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
     
     @app.get("/api/system-status")
     async def get_system_status():
         """获取系统状态"""
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # 统计API配置数量
-            cursor.execute("SELECT COUNT(*) FROM api_configs")
-            api_count = cursor.fetchone()[0]
-            
-            # 统计历史记录数量
-            cursor.execute("SELECT COUNT(*) FROM chat_history")
-            history_count = cursor.fetchone()[0]
-            
-            # 获取活跃的API配置
-            cursor.execute("SELECT name FROM api_configs WHERE is_active = 1")
-            active_api = cursor.fetchone()
-            
-            conn.close()
+            # API配置数量、历史记录数量和活跃的API配置
+            api_count, history_count, active_api = await database.fetch_system_counts()
             
             return {
                 "status": "running",
                 "api_configs": api_count,
                 "history_records": history_count,
-                "active_api": active_api[0] if active_api else None,
+                "active_api": active_api,
                 "supported_models": DoubaoAPIClient.get_supported_models(),
-                "supported_sizes": DoubaoAPIClient.get_supported_sizes()
+                "supported_sizes": DoubaoAPIClient.get_supported_sizes(),
+                # 本进程用过的API配置的熔断状态和最近的失败率、耗时
+                "circuit_breakers": client_registry.get_breaker_stats()
             }
         except Exception as e:
             return {"status": "error", "error": str(e)}
-
-# 使用示例：
-# 在main.py中添加以下代码来启用这些端点：
-# from additional_endpoints import add_stream_endpoint, add_advanced_endpoints
-# add_stream_endpoint(app)
-# add_advanced_endpoints(app)
\ No newline at end of file
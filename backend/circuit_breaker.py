@@ -0,0 +1,221 @@
+"""
+提供商熔断
+每个API配置一个熔断器，统计最近一段时间内调用的失败率和慢调用比例，超过阈值时打开：
+打开期间的调用直接失败，不再等待超时；到期后进入半开状态，只放行少量探测调用，
+探测成功则关闭并清空统计，失败则重新打开并延长打开时间
+"""
+
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from rate_limiter import limit_setting
+
+# 统计窗口（秒）和窗口内至少需要的调用数
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+# 失败率阈值
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+# 超过该耗时（秒）的调用记为慢调用，慢调用比例超过阈值时同样打开
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "60"))
+BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.8"))
+# 打开时长（秒），半开探测失败后翻倍，不超过上限
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "300"))
+# 半开状态同时放行的探测调用数，全部成功后关闭
+BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", "1"))
+
+# 窗口内最多保留的调用记录
+MAX_SAMPLES = 1000
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，调用未发出"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """单个API配置的熔断器"""
+
+    def __init__(self, window_seconds: float = BREAKER_WINDOW_SECONDS,
+                 min_calls: int = BREAKER_MIN_CALLS, error_rate: float = BREAKER_ERROR_RATE,
+                 slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+                 open_seconds: float = BREAKER_OPEN_SECONDS,
+                 max_open_seconds: float = BREAKER_MAX_OPEN_SECONDS,
+                 half_open_calls: int = BREAKER_HALF_OPEN_CALLS):
+        """
+        Args:
+            window_seconds: 统计窗口（秒）
+            min_calls: 窗口内调用数达到该值后才判断是否打开
+            error_rate: 失败率阈值
+            slow_call_seconds: 慢调用的耗时阈值（秒）
+            slow_call_rate: 慢调用比例阈值
+            open_seconds: 打开时长（秒）
+            max_open_seconds: 打开时长上限（秒）
+            half_open_calls: 半开状态的探测调用数
+        """
+        self.window_seconds = window_seconds
+        self.min_calls = max(min_calls, 1)
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.half_open_calls = max(half_open_calls, 1)
+
+        self.state = STATE_CLOSED
+        self.open_seconds = open_seconds
+        self.opened_reason: Optional[str] = None
+        self._open_until = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        # (结束时间, 耗时, 是否失败)
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=MAX_SAMPLES)
+
+        # 统计
+        self.opened = 0
+        self.rejected = 0
+
+    @classmethod
+    def for_provider(cls, provider: str) -> "CircuitBreaker":
+        """按提供商的环境变量（如 QWEN_BREAKER_ERROR_RATE）创建熔断器"""
+        return cls(
+            window_seconds=limit_setting(provider, "BREAKER_WINDOW_SECONDS", BREAKER_WINDOW_SECONDS),
+            min_calls=int(limit_setting(provider, "BREAKER_MIN_CALLS", BREAKER_MIN_CALLS)),
+            error_rate=limit_setting(provider, "BREAKER_ERROR_RATE", BREAKER_ERROR_RATE),
+            slow_call_seconds=limit_setting(provider, "BREAKER_SLOW_CALL_SECONDS", BREAKER_SLOW_CALL_SECONDS),
+            slow_call_rate=limit_setting(provider, "BREAKER_SLOW_CALL_RATE", BREAKER_SLOW_CALL_RATE),
+            open_seconds=limit_setting(provider, "BREAKER_OPEN_SECONDS", BREAKER_OPEN_SECONDS),
+            max_open_seconds=limit_setting(provider, "BREAKER_MAX_OPEN_SECONDS", BREAKER_MAX_OPEN_SECONDS),
+            half_open_calls=int(limit_setting(provider, "BREAKER_HALF_OPEN_CALLS", BREAKER_HALF_OPEN_CALLS))
+        )
+
+    @property
+    def available(self) -> bool:
+        """当前是否可能放行调用（打开且未到期时为False），供路由选择时参考"""
+        if self.state == STATE_OPEN:
+            return time.monotonic() >= self._open_until
+        if self.state == STATE_HALF_OPEN:
+            return self._probes < self.half_open_calls
+        return True
+
+    def acquire(self) -> bool:
+        """
+        调用前检查
+
+        Returns:
+            是否为半开状态的探测调用
+
+        Raises:
+            CircuitOpenError: 熔断器打开，或半开状态的探测名额已用完
+        """
+        now = time.monotonic()
+        if self.state == STATE_OPEN:
+            if now < self._open_until:
+                self.rejected += 1
+                retry_after = self._open_until - now
+                raise CircuitOpenError(f"提供商暂时不可用（{self.opened_reason}），"
+                                       f"{math.ceil(retry_after)}秒后重试", retry_after)
+            self.state = STATE_HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+
+        if self.state == STATE_HALF_OPEN:
+            if self._probes >= self.half_open_calls:
+                self.rejected += 1
+                raise CircuitOpenError(f"提供商暂时不可用（{self.opened_reason}），正在探测恢复情况")
+            self._probes += 1
+            return True
+        return False
+
+    def record(self, latency: float, failed: bool, probe: bool = False) -> None:
+        """记录一次调用的结果"""
+        now = time.monotonic()
+        self._samples.append((now, latency, failed))
+        slow = latency >= self.slow_call_seconds
+
+        if probe:
+            self._probes -= 1
+            if self.state != STATE_HALF_OPEN:
+                return
+            if failed or slow:
+                self._open("探测失败" if failed else "探测调用过慢", self.open_seconds * 2)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_calls:
+                self._close()
+            return
+
+        if self.state != STATE_CLOSED:
+            return
+        calls, failures, slow_calls = self._window_counts(now)
+        if calls < self.min_calls:
+            return
+        if failures / calls >= self.error_rate:
+            self._open(f"失败率{failures / calls:.0%}", self.base_open_seconds)
+        elif slow_calls / calls >= self.slow_call_rate:
+            self._open(f"慢调用比例{slow_calls / calls:.0%}", self.base_open_seconds)
+
+    def abandon(self, probe: bool = False) -> None:
+        """调用被取消，不记录结果"""
+        if probe:
+            self._probes -= 1
+
+    def _open(self, reason: str, seconds: float) -> None:
+        self.state = STATE_OPEN
+        self.opened_reason = reason
+        self.open_seconds = min(seconds, self.max_open_seconds)
+        self._open_until = time.monotonic() + self.open_seconds
+        self.opened += 1
+        print(f"熔断器打开（{reason}），{self.open_seconds:.0f}秒后探测")
+
+    def _close(self) -> None:
+        self.state = STATE_CLOSED
+        self.opened_reason = None
+        self.open_seconds = self.base_open_seconds
+        self._samples.clear()
+
+    def _window_counts(self, now: float) -> Tuple[int, int, int]:
+        """窗口内的调用数、失败数和慢调用数"""
+        while self._samples and self._samples[0][0] < now - self.window_seconds:
+            self._samples.popleft()
+        failures = sum(1 for _, _, failed in self._samples if failed)
+        slow_calls = sum(1 for _, latency, _ in self._samples if latency >= self.slow_call_seconds)
+        return len(self._samples), failures, slow_calls
+
+    def get_stats(self) -> Dict[str, Any]:
+        """熔断状态和窗口内的调用统计"""
+        now = time.monotonic()
+        calls, failures, slow_calls = self._window_counts(now)
+        latencies = sorted(latency for _, latency, _ in self._samples)
+
+        def percentile(fraction: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 2)
+
+        return {
+            "state": self.state,
+            "reason": self.opened_reason,
+            "retry_after": round(max(self._open_until - now, 0.0), 1) if self.state == STATE_OPEN else None,
+            "window_seconds": self.window_seconds,
+            "calls": calls,
+            "failures": failures,
+            "error_rate": round(failures / calls, 3) if calls else 0.0,
+            "slow_calls": slow_calls,
+            "slow_call_rate": round(slow_calls / calls, 3) if calls else 0.0,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "opened": self.opened,
+            "rejected": self.rejected
+        }
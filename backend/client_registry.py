@@ -0,0 +1,159 @@
+"""
+API配置缓存与客户端注册表
+按apiConfigId缓存解析后的配置和可直接使用的提供商客户端，避免每次生成都查询数据库并创建客户端
+"""
+
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Union
+
+from circuit_breaker import CircuitBreaker
+from doubao_api import DoubaoAPIClient
+from qwen_api import AsyncQwenAPIClient
+from rate_limiter import ProviderRateLimiter
+from retry_policy import RetryPolicy
+
+# 缓存有效期（秒），多进程部署时其他进程的修改最迟在此时间后生效
+REGISTRY_TTL = float(os.getenv("REGISTRY_TTL", "60"))
+
+PROVIDER_DOUBAO = "doubao"
+PROVIDER_QWEN = "qwen"
+
+ProviderClient = Union[DoubaoAPIClient, AsyncQwenAPIClient]
+
+
+def detect_provider(api_url: str) -> str:
+    """根据URL判断API类型"""
+    if "dashscope" in api_url or "aliyuncs" in api_url:
+        return PROVIDER_QWEN
+    return PROVIDER_DOUBAO
+
+
+def config_from_row(row: Sequence[Any]) -> Dict[str, Any]:
+    """将api_configs表的一行解析为配置字典"""
+    return {
+        "id": row[0],
+        "name": row[1],
+        "url": row[2],
+        "api_key": row[3],
+        "headers": json.loads(row[4]) if row[4] else {},
+        "model": row[5],
+        "is_active": bool(row[6])
+    }
+
+
+class ProviderControls:
+    """按API配置共享的限流器、重试策略和熔断器，缓存过期重建客户端时沿用已学习到的速率、耗时和熔断状态"""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.provider = detect_provider(config["url"])
+        # 地址或密钥变化时重新创建
+        self.key = (config["url"], config["api_key"])
+        self.name = config["name"]
+        self.limiter = ProviderRateLimiter.for_provider(self.provider)
+        self.retry_policy = RetryPolicy.for_provider(self.provider)
+        self.breaker = CircuitBreaker.for_provider(self.provider)
+
+
+def build_client(config: Dict[str, Any], controls: Optional[ProviderControls] = None) -> ProviderClient:
+    """根据配置创建提供商客户端"""
+    options: Dict[str, Any] = {}
+    if controls is not None:
+        options = {"limiter": controls.limiter, "retry_policy": controls.retry_policy,
+                   "breaker": controls.breaker}
+    if detect_provider(config["url"]) == PROVIDER_QWEN:
+        return AsyncQwenAPIClient(api_key=config["api_key"], base_url=config["url"], **options)
+    return DoubaoAPIClient(api_key=config["api_key"], base_url=config["url"], **options)
+
+
+class RegistryEntry:
+    """注册表中的一项：解析后的配置和对应的客户端"""
+
+    def __init__(self, config: Dict[str, Any], controls: Optional[ProviderControls] = None):
+        self.config = config
+        self.provider = detect_provider(config["url"])
+        self.controls = controls
+        self.client = build_client(config, controls)
+        self.loaded_at = time.monotonic()
+
+    @property
+    def is_active(self) -> bool:
+        return self.config["is_active"]
+
+    @property
+    def model(self) -> Optional[str]:
+        return self.config["model"]
+
+
+class ClientRegistry:
+    """进程内的配置ID到客户端的映射，配置增删改时由接口调用invalidate失效"""
+
+    def __init__(self, loader: Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+                 ttl: float = REGISTRY_TTL):
+        """
+        Args:
+            loader: 按配置ID从数据库加载配置的协程函数，不存在时返回None
+            ttl: 缓存有效期（秒）
+        """
+        self._loader = loader
+        self._ttl = ttl
+        self._entries: Dict[str, RegistryEntry] = {}
+        self._controls: Dict[str, ProviderControls] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, config_id: str) -> Optional[RegistryEntry]:
+        """获取配置对应的注册项，缓存未命中时从数据库加载"""
+        entry = self._entries.get(config_id)
+        if entry is not None and time.monotonic() - entry.loaded_at < self._ttl:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        config = await self._loader(config_id)
+        if config is None:
+            self._entries.pop(config_id, None)
+            self._controls.pop(config_id, None)
+            return None
+
+        entry = RegistryEntry(config, self._controls_for(config))
+        self._entries[config_id] = entry
+        return entry
+
+    def _controls_for(self, config: Dict[str, Any]) -> ProviderControls:
+        controls = self._controls.get(config["id"])
+        if controls is None or controls.key != (config["url"], config["api_key"]):
+            controls = self._controls[config["id"]] = ProviderControls(config)
+        controls.name = config["name"]
+        return controls
+
+    def invalidate(self, config_id: Optional[str] = None) -> None:
+        """使指定配置失效，不指定时清空全部"""
+        if config_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(config_id, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        """缓存统计"""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各配置的限流状态（速率、并发、排队深度）"""
+        return {config_id: controls.limiter.get_stats() for config_id, controls in self._controls.items()}
+
+    def get_retry_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各配置的重试、对冲次数和请求耗时"""
+        return {config_id: controls.retry_policy.get_stats() for config_id, controls in self._controls.items()}
+
+    def get_breaker_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各配置的熔断状态和最近一段时间的失败率、慢调用比例和耗时"""
+        return {
+            config_id: {"name": controls.name, "provider": controls.provider, **controls.breaker.get_stats()}
+            for config_id, controls in self._controls.items()
+        }
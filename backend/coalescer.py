@@ -0,0 +1,61 @@
+"""
+相同生成请求合并
+双击生成或多个标签页重复提交时，进行中的相同请求（按规范化后的请求哈希判断）共用一次提供商调用，
+所有等待方得到同一个结果或同一个错误
+"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict
+
+
+def canonical_hash(payload: Any) -> str:
+    """按键排序、去掉空白后的JSON的SHA-256，字段顺序不同的相同请求得到相同的哈希"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class RequestCoalescer:
+    """按请求哈希合并进行中的相同请求"""
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+        # 统计
+        self.leaders = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        执行 factory，已有相同 key 的请求在进行中时等待它的结果
+
+        调用在独立的任务中执行：某个等待方断开（被取消）不影响其他等待方
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled():
+            # 所有等待方都已断开时也取出异常，避免未处理异常的警告
+            task.exception()
+
+    def get_stats(self) -> Dict[str, int]:
+        """实际调用次数、被合并的请求数和进行中的调用数"""
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": self.in_flight
+        }
@@ -0,0 +1,924 @@
+"""
+数据访问层
+基于SQLAlchemy异步引擎（aiosqlite），使用连接池、WAL日志模式和预定义语句，
+查询不再阻塞事件循环，多个uvicorn进程可以同时读写同一个数据库文件
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///chat_history.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+
+def _async_database_url(url: str) -> str:
+    """将 sqlite:/// 地址转换为异步驱动地址"""
+    if url.startswith("sqlite:///"):
+        return "sqlite+aiosqlite:///" + url[len("sqlite:///"):]
+    return url
+
+
+def _create_engine() -> AsyncEngine:
+    """创建带连接池的异步引擎"""
+    engine = create_async_engine(
+        _async_database_url(DATABASE_URL),
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        # 每个连接缓存已编译的SQL语句
+        connect_args={"cached_statements": 256}
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL模式下读写互不阻塞，多进程可并发访问
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-16000")
+        cursor.execute("PRAGMA mmap_size=134217728")
+        cursor.close()
+
+    return engine
+
+
+engine = _create_engine()
+
+# 建表语句
+CREATE_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS api_configs (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        url TEXT NOT NULL,
+        api_key TEXT NOT NULL,
+        headers TEXT,
+        model TEXT,
+        is_active BOOLEAN DEFAULT 0
+    )
+    ''',
+    # 路由组：一个逻辑端点按策略把请求分配到多个API配置，members为 [{"config_id", "weight"}] 的JSON
+    '''
+    CREATE TABLE IF NOT EXISTS routing_groups (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        policy TEXT NOT NULL DEFAULT 'weighted',
+        members TEXT NOT NULL
+    )
+    ''',
+    # 旧版历史表，仅用于迁移到 generations
+    '''
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id TEXT PRIMARY KEY,
+        prompt TEXT NOT NULL,
+        result_images TEXT,
+        parameters TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # 生成记录：常用查询字段拆为带类型的列，parameters 保留完整参数
+    '''
+    CREATE TABLE IF NOT EXISTS generations (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL UNIQUE,
+        prompt TEXT NOT NULL,
+        negative_prompt TEXT,
+        provider TEXT,
+        api_config_id TEXT,
+        model TEXT,
+        generation_type TEXT,
+        width INTEGER,
+        height INTEGER,
+        seed INTEGER,
+        batch_size INTEGER,
+        image_count INTEGER NOT NULL DEFAULT 0,
+        latency_ms INTEGER,
+        parameters TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # 生成结果图片，按生成记录内的顺序保存；image_hash 指向本地图片存储，
+    # url 只在未能保存到本地时保留原始地址（以及迁移前的旧记录）
+    '''
+    CREATE TABLE IF NOT EXISTS generation_images (
+        generation_id TEXT NOT NULL REFERENCES generations (id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        image_hash TEXT,
+        url TEXT,
+        PRIMARY KEY (generation_id, position)
+    ) WITHOUT ROWID
+    ''',
+    # 图片元数据：按内容哈希保存宽高、占位图和缩略图哈希（JSON，键为最长边）
+    '''
+    CREATE TABLE IF NOT EXISTS image_metadata (
+        image_hash TEXT PRIMARY KEY,
+        width INTEGER,
+        height INTEGER,
+        placeholder TEXT,
+        thumbnails TEXT
+    ) WITHOUT ROWID
+    ''',
+    # 异步生成任务：状态、请求和结果持久化，执行中的任务由租约标记归属，
+    # 持有者定期续约，租约过期的任务由任意进程重新入队
+    '''
+    CREATE TABLE IF NOT EXISTS generation_jobs (
+        seq INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        status TEXT NOT NULL DEFAULT 'queued',
+        request TEXT NOT NULL,
+        provider_task_id TEXT,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires_at REAL,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )
+    ''',
+    # 指定seed的生成结果缓存：key为规范化请求的哈希，images为本地图片存储结果的JSON，
+    # 超过有效期或按最近使用时间超出条数上限的被清理
+    '''
+    CREATE TABLE IF NOT EXISTS result_cache (
+        key TEXT PRIMARY KEY,
+        images TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS schema_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    '''
+]
+
+# 索引：历史记录按 (timestamp, id) 做游标分页，筛选和统计字段各自带上分页列
+CREATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_generations_timestamp_id ON generations (timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_generations_model ON generations (model, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_generations_type ON generations (generation_type, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_generations_size ON generations (width, height, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_generations_provider ON generations (provider, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_generations_seed ON generations (seed) WHERE seed IS NOT NULL",
+    # 缩略图补全按图片哈希扫描还没有元数据的图片
+    "CREATE INDEX IF NOT EXISTS idx_generation_images_hash ON generation_images (image_hash) WHERE image_hash IS NOT NULL",
+    # 任务队列只扫描排队中和执行中的少量行，已结束的任务按结束时间清理
+    "CREATE INDEX IF NOT EXISTS idx_generation_jobs_queued ON generation_jobs (seq) WHERE status = 'queued'",
+    "CREATE INDEX IF NOT EXISTS idx_generation_jobs_running ON generation_jobs (lease_expires_at) WHERE status = 'running'",
+    "CREATE INDEX IF NOT EXISTS idx_generation_jobs_finished ON generation_jobs (finished_at) WHERE finished_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache (last_used_at)"
+]
+
+# 提示词全文索引：trigram分词支持中文子串检索，由触发器与generations保持同步
+CREATE_HISTORY_FTS = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+        prompt, negative_prompt, content='generations', content_rowid='seq', tokenize='trigram'
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+        INSERT INTO generations_fts (rowid, prompt, negative_prompt)
+        VALUES (new.seq, new.prompt, new.negative_prompt);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+        INSERT INTO generations_fts (generations_fts, rowid, prompt, negative_prompt)
+        VALUES ('delete', old.seq, old.prompt, old.negative_prompt);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS generations_fts_update AFTER UPDATE OF prompt, negative_prompt ON generations BEGIN
+        INSERT INTO generations_fts (generations_fts, rowid, prompt, negative_prompt)
+        VALUES ('delete', old.seq, old.prompt, old.negative_prompt);
+        INSERT INTO generations_fts (rowid, prompt, negative_prompt)
+        VALUES (new.seq, new.prompt, new.negative_prompt);
+    END
+    '''
+]
+
+# 旧版 chat_history 迁移：首次创建时记录迁移范围，由后台任务分批复制
+CREATE_HISTORY_MIGRATION = [
+    '''
+    INSERT OR IGNORE INTO schema_state (key, value)
+    SELECT 'history_migration_high', COALESCE(MAX(rowid), 0) FROM chat_history
+    ''',
+    "INSERT OR IGNORE INTO schema_state (key, value) VALUES ('history_migration_position', 0)"
+]
+
+# 预定义语句
+API_CONFIG_COLUMNS = "id, name, url, api_key, headers, model, is_active"
+
+SELECT_API_CONFIGS = text(f"SELECT {API_CONFIG_COLUMNS} FROM api_configs")
+SELECT_API_CONFIG = text(f"SELECT {API_CONFIG_COLUMNS} FROM api_configs WHERE id = :id")
+SELECT_API_CONFIG_URLS = text("SELECT url FROM api_configs")
+SELECT_SYSTEM_COUNTS = text('''
+    SELECT (SELECT COUNT(*) FROM api_configs),
+           (SELECT COUNT(*) FROM generations),
+           (SELECT name FROM api_configs WHERE is_active = 1 LIMIT 1)
+''')
+INSERT_API_CONFIG = text('''
+    INSERT INTO api_configs (id, name, url, api_key, headers, model, is_active)
+    VALUES (:id, :name, :url, :api_key, :headers, :model, :is_active)
+''')
+DELETE_API_CONFIG = text("DELETE FROM api_configs WHERE id = :id")
+
+SELECT_ROUTING_GROUPS = text("SELECT id, name, policy, members FROM routing_groups")
+INSERT_ROUTING_GROUP = text('''
+    INSERT INTO routing_groups (id, name, policy, members) VALUES (:id, :name, :policy, :members)
+''')
+UPDATE_ROUTING_GROUP = text('''
+    UPDATE routing_groups SET name = :name, policy = :policy, members = :members WHERE id = :id
+''')
+DELETE_ROUTING_GROUP = text("DELETE FROM routing_groups WHERE id = :id")
+
+INSERT_GENERATION = text('''
+    INSERT INTO generations (
+        id, prompt, negative_prompt, provider, api_config_id, model, generation_type,
+        width, height, seed, batch_size, image_count, latency_ms, parameters, timestamp
+    ) VALUES (
+        :id, :prompt, :negative_prompt, :provider, :api_config_id, :model, :generation_type,
+        :width, :height, :seed, :batch_size, :image_count, :latency_ms, :parameters, :timestamp
+    )
+''')
+INSERT_GENERATION_IMAGE = text('''
+    INSERT INTO generation_images (generation_id, position, image_hash, url)
+    VALUES (:generation_id, :position, :image_hash, :url)
+''')
+
+# 历史记录的完整字段和精简字段（只取第一张图作为缩略图），
+# 图片为 [image_hash, url, width, height, placeholder, thumbnails] 数组，缩略图未生成时元数据为null
+HISTORY_IMAGE_FIELDS = '''
+    json_array(i.image_hash, i.url, m.width, m.height, m.placeholder, json(m.thumbnails))
+'''
+HISTORY_FULL_COLUMNS = f'''
+    g.id, g.prompt,
+    (SELECT json_group_array(json(image)) FROM (
+        SELECT {HISTORY_IMAGE_FIELDS} AS image
+        FROM generation_images i LEFT JOIN image_metadata m ON m.image_hash = i.image_hash
+        WHERE i.generation_id = g.id ORDER BY i.position
+    )) AS images,
+    g.parameters, g.timestamp
+'''
+HISTORY_THUMBNAIL_COLUMN = f'''
+    (SELECT {HISTORY_IMAGE_FIELDS}
+     FROM generation_images i LEFT JOIN image_metadata m ON m.image_hash = i.image_hash
+     WHERE i.generation_id = g.id AND i.position = 0) AS thumbnail
+'''
+HISTORY_SUMMARY_COLUMNS = f"g.id, g.prompt, g.timestamp, {HISTORY_THUMBNAIL_COLUMN}"
+
+# 历史记录筛选条件
+HISTORY_FILTERS = {
+    "model": "g.model = :model",
+    "generation_type": "g.generation_type = :generation_type",
+    "provider": "g.provider = :provider",
+    "width": "g.width = :width",
+    "height": "g.height = :height",
+    "since": "g.timestamp >= :since",
+    "until": "g.timestamp <= :until"
+}
+
+# 统计维度
+HISTORY_STATS_GROUPS = {
+    "model": "model",
+    "provider": "provider",
+    "generation_type": "generation_type",
+    "size": "width || 'x' || height",
+    "day": "date(timestamp)"
+}
+
+SELECT_GENERATION_IMAGE = text('''
+    SELECT image_hash, url FROM generation_images
+    WHERE generation_id = :generation_id AND position = :position
+''')
+
+SELECT_IMAGE_METADATA_EXISTS = text("SELECT 1 FROM image_metadata WHERE image_hash = :image_hash")
+SELECT_IMAGES_WITHOUT_METADATA = text('''
+    SELECT DISTINCT i.image_hash FROM generation_images i
+    LEFT JOIN image_metadata m ON m.image_hash = i.image_hash
+    WHERE i.image_hash IS NOT NULL AND i.image_hash > :after AND m.image_hash IS NULL
+    ORDER BY i.image_hash
+    LIMIT :limit
+''')
+UPSERT_IMAGE_METADATA = text('''
+    INSERT OR REPLACE INTO image_metadata (image_hash, width, height, placeholder, thumbnails)
+    VALUES (:image_hash, :width, :height, :placeholder, :thumbnails)
+''')
+
+SELECT_HISTORY_MIGRATION_STATE = text(
+    "SELECT key, value FROM schema_state WHERE key IN ('history_migration_position', 'history_migration_high')"
+)
+SELECT_HISTORY_MIGRATION_END = text('''
+    SELECT MAX(rowid) FROM (
+        SELECT rowid FROM chat_history
+        WHERE rowid > :position AND rowid <= :high
+        ORDER BY rowid LIMIT :batch_size
+    )
+''')
+ADVANCE_HISTORY_MIGRATION = text('''
+    UPDATE schema_state SET value = :new_position
+    WHERE key = 'history_migration_position' AND CAST(value AS INTEGER) = :position
+''')
+MIGRATE_HISTORY_GENERATIONS = text('''
+    INSERT OR IGNORE INTO generations (
+        id, prompt, negative_prompt, provider, model, generation_type,
+        width, height, seed, batch_size, image_count, parameters, timestamp
+    )
+    SELECT id, prompt,
+           json_extract(parameters, '$.negative_prompt'),
+           CASE
+               WHEN json_extract(parameters, '$.model') LIKE 'wanx%'
+                 OR json_extract(parameters, '$.model') LIKE 'qwen%' THEN 'qwen'
+               WHEN json_extract(parameters, '$.model') IS NOT NULL THEN 'doubao'
+           END,
+           json_extract(parameters, '$.model'),
+           COALESCE(json_extract(parameters, '$.generation_type'), 'text_to_image'),
+           json_extract(parameters, '$.width'),
+           json_extract(parameters, '$.height'),
+           json_extract(parameters, '$.seed'),
+           json_extract(parameters, '$.batch_size'),
+           json_array_length(COALESCE(result_images, '[]')),
+           parameters, timestamp
+    FROM chat_history
+    WHERE rowid > :position AND rowid <= :new_position
+    ORDER BY rowid
+''')
+MIGRATE_HISTORY_IMAGES = text('''
+    INSERT OR IGNORE INTO generation_images (generation_id, position, url)
+    SELECT h.id, CAST(image.key AS INTEGER), image.value
+    FROM chat_history h, json_each(COALESCE(h.result_images, '[]')) image
+    WHERE h.rowid > :position AND h.rowid <= :new_position
+''')
+
+JOB_COLUMNS = "id, status, request, provider_task_id, result, error, attempts, created_at, started_at, finished_at"
+
+INSERT_JOB = text('''
+    INSERT INTO generation_jobs (id, request, created_at) VALUES (:id, :request, :created_at)
+''')
+# 认领最早排队的任务：单条语句完成选择和加租约，多个进程同时认领也不会重复
+CLAIM_JOBS = text(f'''
+    UPDATE generation_jobs
+    SET status = 'running', lease_owner = :owner, lease_expires_at = :lease_expires_at,
+        attempts = attempts + 1, started_at = COALESCE(started_at, :now)
+    WHERE seq IN (
+        SELECT seq FROM generation_jobs WHERE status = 'queued' ORDER BY seq LIMIT :limit
+    )
+    RETURNING seq, {JOB_COLUMNS}
+''')
+RENEW_JOB_LEASES = text('''
+    UPDATE generation_jobs SET lease_expires_at = :lease_expires_at
+    WHERE lease_owner = :owner AND status = 'running'
+    RETURNING id
+''')
+# 租约过期（持有进程崩溃或失联）的任务重新入队，超过尝试次数的标记为失败
+RECLAIM_EXPIRED_JOBS = text('''
+    UPDATE generation_jobs
+    SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'queued' END,
+        error = CASE WHEN attempts >= :max_attempts THEN :error END,
+        finished_at = CASE WHEN attempts >= :max_attempts THEN :now END,
+        lease_owner = NULL, lease_expires_at = NULL
+    WHERE status = 'running' AND lease_expires_at < :now
+    RETURNING id, status
+''')
+# 正常关闭时交还租约，不计入尝试次数，重启后立即继续
+RELEASE_JOB_LEASES = text('''
+    UPDATE generation_jobs
+    SET status = 'queued', attempts = attempts - 1, lease_owner = NULL, lease_expires_at = NULL
+    WHERE lease_owner = :owner AND status = 'running'
+''')
+SET_JOB_PROVIDER_TASK = text('''
+    UPDATE generation_jobs SET provider_task_id = :provider_task_id
+    WHERE id = :id AND lease_owner = :owner AND status = 'running'
+''')
+# 只有仍持有租约时才写入结果，租约已被回收的旧执行者不会覆盖新的执行结果
+FINISH_JOB = text('''
+    UPDATE generation_jobs
+    SET status = :status, result = :result, error = :error, finished_at = :now,
+        lease_owner = NULL, lease_expires_at = NULL
+    WHERE id = :id AND lease_owner = :owner AND status = 'running'
+''')
+CANCEL_JOB = text('''
+    UPDATE generation_jobs
+    SET status = 'canceled', error = :error, finished_at = :now, lease_owner = NULL, lease_expires_at = NULL
+    WHERE id = :id AND status IN ('queued', 'running')
+''')
+SELECT_JOB = text(f"SELECT {JOB_COLUMNS} FROM generation_jobs WHERE id = :id")
+SELECT_RECENT_JOBS = text(f"SELECT {JOB_COLUMNS} FROM generation_jobs ORDER BY seq DESC LIMIT :limit")
+SELECT_JOB_COUNTS = text('''
+    SELECT (SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued'),
+           (SELECT COUNT(*) FROM generation_jobs WHERE status = 'running')
+''')
+DELETE_FINISHED_JOBS = text("DELETE FROM generation_jobs WHERE finished_at < :finished_before")
+
+SELECT_CACHED_RESULT = text('''
+    SELECT images FROM result_cache WHERE key = :key AND created_at >= :created_after
+''')
+TOUCH_CACHED_RESULT = text("UPDATE result_cache SET last_used_at = :now WHERE key = :key")
+UPSERT_CACHED_RESULT = text('''
+    INSERT INTO result_cache (key, images, created_at, last_used_at) VALUES (:key, :images, :now, :now)
+    ON CONFLICT (key) DO UPDATE SET images = excluded.images, created_at = excluded.created_at,
+        last_used_at = excluded.last_used_at
+''')
+DELETE_CACHED_RESULT = text("DELETE FROM result_cache WHERE key = :key")
+DELETE_EXPIRED_RESULTS = text("DELETE FROM result_cache WHERE created_at < :created_after")
+# 按最近使用时间保留 max_entries 条，其余删除
+DELETE_LEAST_RECENT_RESULTS = text('''
+    DELETE FROM result_cache WHERE key IN (
+        SELECT key FROM result_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET :max_entries
+    )
+''')
+COUNT_CACHED_RESULTS = text("SELECT COUNT(*) FROM result_cache")
+
+# 全文检索：按bm25相关度排序，(rank, rowid) 作为分页游标
+SEARCH_HISTORY = text('''
+    SELECT g.id, g.prompt, g.timestamp,
+           {thumbnail},
+           highlight(generations_fts, 0, '<mark>', '</mark>') AS prompt_highlight,
+           highlight(generations_fts, 1, '<mark>', '</mark>') AS negative_prompt_highlight,
+           f.rank, f.rowid
+    FROM generations_fts f
+    JOIN generations g ON g.seq = f.rowid
+    WHERE generations_fts MATCH :query AND (f.rank, f.rowid) > (:cursor_rank, :cursor_rowid)
+    ORDER BY f.rank, f.rowid
+    LIMIT :limit
+'''.format(thumbnail=HISTORY_THUMBNAIL_COLUMN))
+
+# 允许更新的API配置字段
+API_CONFIG_UPDATABLE_COLUMNS = {"name", "url", "api_key", "headers", "model", "is_active"}
+
+
+async def init_database() -> None:
+    """创建数据表（幂等，多进程同时启动也安全）"""
+    async with engine.begin() as conn:
+        for statement in CREATE_TABLES + CREATE_INDEXES + CREATE_HISTORY_FTS + CREATE_HISTORY_MIGRATION:
+            await conn.execute(text(statement))
+
+
+async def migrate_legacy_history(batch_size: int = 1000, pause: float = 0.05) -> int:
+    """
+    分批将旧版 chat_history 迁移到 generations 和 generation_images
+
+    每批是一个短事务，批次之间让出写锁，迁移期间不影响正常读写；
+    全文索引由 generations 上的触发器同步写入。
+    迁移位置通过比较并更新的方式推进，多个进程同时执行也不会重复迁移。
+
+    Returns:
+        本次迁移的记录数
+    """
+    total = 0
+    while True:
+        async with engine.begin() as conn:
+            state = dict((await conn.execute(SELECT_HISTORY_MIGRATION_STATE)).fetchall())
+            position = int(state.get("history_migration_position", 0))
+            high = int(state.get("history_migration_high", 0))
+            if position >= high:
+                return total
+
+            last_rowid = (await conn.execute(SELECT_HISTORY_MIGRATION_END, {
+                "position": position, "high": high, "batch_size": batch_size
+            })).scalar()
+            if last_rowid is None:
+                last_rowid = high
+
+            result = await conn.execute(ADVANCE_HISTORY_MIGRATION, {
+                "position": position, "new_position": last_rowid
+            })
+            if result.rowcount == 0:
+                # 其他进程已推进迁移位置，重新读取
+                continue
+
+            batch_range = {"position": position, "new_position": last_rowid}
+            migrated = await conn.execute(MIGRATE_HISTORY_GENERATIONS, batch_range)
+            await conn.execute(MIGRATE_HISTORY_IMAGES, batch_range)
+            total += migrated.rowcount
+        await asyncio.sleep(pause)
+
+
+async def dispose() -> None:
+    """关闭连接池"""
+    await engine.dispose()
+
+
+async def fetch_api_configs() -> List[Any]:
+    """获取所有API配置行"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_API_CONFIGS)
+        return result.fetchall()
+
+
+async def fetch_api_config(config_id: str) -> Optional[Any]:
+    """按ID获取API配置行"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_API_CONFIG, {"id": config_id})
+        return result.fetchone()
+
+
+async def fetch_api_config_urls() -> List[str]:
+    """获取所有API配置的地址"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_API_CONFIG_URLS)
+        return [row[0] for row in result.fetchall() if row[0]]
+
+
+async def fetch_system_counts() -> Any:
+    """API配置数量、历史记录数量和第一个活跃配置的名称"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_SYSTEM_COUNTS)
+        return result.fetchone()
+
+
+async def insert_api_config(config_id: str, name: str, url: str, api_key: str,
+                            headers: Optional[Dict[str, str]], model: Optional[str],
+                            is_active: bool = False) -> None:
+    """新增API配置"""
+    async with engine.begin() as conn:
+        await conn.execute(INSERT_API_CONFIG, {
+            "id": config_id,
+            "name": name,
+            "url": url,
+            "api_key": api_key,
+            "headers": json.dumps(headers) if headers else None,
+            "model": model,
+            "is_active": is_active
+        })
+
+
+async def update_api_config(config_id: str, fields: Dict[str, Any]) -> int:
+    """更新API配置，返回受影响的行数"""
+    columns = [column for column in fields if column in API_CONFIG_UPDATABLE_COLUMNS]
+    if not columns:
+        return 0
+
+    assignments = ", ".join(f"{column} = :{column}" for column in columns)
+    params = {column: fields[column] for column in columns}
+    params["id"] = config_id
+
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            text(f"UPDATE api_configs SET {assignments} WHERE id = :id"), params
+        )
+        return result.rowcount
+
+
+async def delete_api_config(config_id: str) -> int:
+    """删除API配置，返回受影响的行数"""
+    async with engine.begin() as conn:
+        result = await conn.execute(DELETE_API_CONFIG, {"id": config_id})
+        return result.rowcount
+
+
+async def fetch_routing_groups() -> List[Any]:
+    """获取所有路由组行"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_ROUTING_GROUPS)
+        return result.fetchall()
+
+
+async def insert_routing_group(group_id: str, name: str, policy: str,
+                               members: List[Dict[str, Any]]) -> None:
+    """新增路由组"""
+    async with engine.begin() as conn:
+        await conn.execute(INSERT_ROUTING_GROUP, {
+            "id": group_id, "name": name, "policy": policy, "members": json.dumps(members)
+        })
+
+
+async def update_routing_group(group_id: str, name: str, policy: str,
+                               members: List[Dict[str, Any]]) -> int:
+    """替换路由组的名称、策略和成员，返回受影响的行数"""
+    async with engine.begin() as conn:
+        result = await conn.execute(UPDATE_ROUTING_GROUP, {
+            "id": group_id, "name": name, "policy": policy, "members": json.dumps(members)
+        })
+        return result.rowcount
+
+
+async def delete_routing_group(group_id: str) -> int:
+    """删除路由组，返回受影响的行数"""
+    async with engine.begin() as conn:
+        result = await conn.execute(DELETE_ROUTING_GROUP, {"id": group_id})
+        return result.rowcount
+
+
+def _generation_row(record: Dict[str, Any]) -> Dict[str, Any]:
+    """将历史记录转换为 generations 表的一行"""
+    parameters = record["parameters"]
+    return {
+        "id": record["id"],
+        "prompt": record["prompt"],
+        "negative_prompt": parameters.get("negative_prompt"),
+        "provider": record.get("provider"),
+        "api_config_id": record.get("api_config_id"),
+        "model": parameters.get("model"),
+        "generation_type": parameters.get("generation_type"),
+        "width": parameters.get("width"),
+        "height": parameters.get("height"),
+        "seed": parameters.get("seed"),
+        "batch_size": parameters.get("batch_size"),
+        "image_count": len(record["images"]),
+        "latency_ms": record.get("latency_ms"),
+        "parameters": json.dumps(parameters),
+        "timestamp": record["timestamp"]
+    }
+
+
+async def insert_history_batch(records: List[Dict[str, Any]]) -> None:
+    """在一个事务中批量保存生成记录和结果图片"""
+    if not records:
+        return
+    images = [
+        {"generation_id": record["id"], "position": position,
+         "image_hash": image["hash"], "url": image["url"]}
+        for record in records
+        for position, image in enumerate(record["images"])
+    ]
+    async with engine.begin() as conn:
+        await conn.execute(INSERT_GENERATION, [_generation_row(record) for record in records])
+        if images:
+            await conn.execute(INSERT_GENERATION_IMAGE, images)
+
+
+async def fetch_history(limit: int = 50, cursor: Optional[Tuple[str, str]] = None,
+                        filters: Optional[Dict[str, Any]] = None,
+                        summary: bool = False) -> List[Any]:
+    """
+    按时间倒序获取生成历史（游标分页）
+
+    Args:
+        limit: 返回条数
+        cursor: 上一页最后一条的 (timestamp, id)，从其之后继续
+        filters: 筛选条件，键见 HISTORY_FILTERS
+        summary: 为True时只返回 id、prompt、timestamp 和第一张图
+
+    Returns:
+        历史记录行，完整模式下图片列为JSON数组
+    """
+    conditions, params = _history_conditions(filters)
+    params["limit"] = limit
+
+    if cursor is not None:
+        conditions.append("(g.timestamp, g.id) < (:cursor_timestamp, :cursor_id)")
+        params["cursor_timestamp"], params["cursor_id"] = cursor
+
+    columns = HISTORY_SUMMARY_COLUMNS if summary else HISTORY_FULL_COLUMNS
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"SELECT {columns} FROM generations g {where} ORDER BY g.timestamp DESC, g.id DESC LIMIT :limit"
+
+    async with engine.connect() as conn:
+        result = await conn.execute(text(query), params)
+        return result.fetchall()
+
+
+async def fetch_history_stats(group_by: str, filters: Optional[Dict[str, Any]] = None) -> List[Any]:
+    """
+    按维度汇总生成记录
+
+    Args:
+        group_by: 统计维度，键见 HISTORY_STATS_GROUPS
+        filters: 筛选条件，键见 HISTORY_FILTERS
+
+    Returns:
+        (维度值, 生成次数, 图片数, 平均耗时毫秒) 行
+    """
+    conditions, params = _history_conditions(filters)
+    key = HISTORY_STATS_GROUPS[group_by]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f'''
+        SELECT {key} AS key, COUNT(*) AS generations, SUM(image_count) AS images,
+               AVG(latency_ms) AS avg_latency_ms
+        FROM generations g {where}
+        GROUP BY {key}
+        ORDER BY generations DESC
+    '''
+
+    async with engine.connect() as conn:
+        result = await conn.execute(text(query), params)
+        return result.fetchall()
+
+
+def _history_conditions(filters: Optional[Dict[str, Any]]) -> Tuple[List[str], Dict[str, Any]]:
+    """根据筛选条件生成WHERE子句和参数"""
+    conditions = []
+    params: Dict[str, Any] = {}
+    for key, value in (filters or {}).items():
+        if value is not None:
+            conditions.append(HISTORY_FILTERS[key])
+            params[key] = value
+    return conditions, params
+
+
+async def fetch_generation_image(generation_id: str, position: int = 0) -> Optional[Any]:
+    """获取历史记录中的一张结果图片 (image_hash, url)"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_GENERATION_IMAGE, {
+            "generation_id": generation_id,
+            "position": position
+        })
+        return result.fetchone()
+
+
+async def image_metadata_exists(image_hash: str) -> bool:
+    """图片是否已生成缩略图和元数据"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_IMAGE_METADATA_EXISTS, {"image_hash": image_hash})
+        return result.first() is not None
+
+
+async def fetch_images_without_metadata(after: str, limit: int) -> List[str]:
+    """按哈希顺序返回哈希大于 after、还没有缩略图和元数据的结果图片"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_IMAGES_WITHOUT_METADATA, {"after": after, "limit": limit})
+        return [row[0] for row in result.fetchall()]
+
+
+async def upsert_image_metadata(image_hash: str, metadata: Dict[str, Any]) -> None:
+    """保存图片的宽高、占位图和缩略图"""
+    async with engine.begin() as conn:
+        await conn.execute(UPSERT_IMAGE_METADATA, {
+            "image_hash": image_hash,
+            "width": metadata["width"],
+            "height": metadata["height"],
+            "placeholder": metadata["placeholder"],
+            "thumbnails": json.dumps(metadata["thumbnails"])
+        })
+
+
+async def search_history(query: str, limit: int = 20,
+                         cursor: Optional[Tuple[float, int]] = None) -> List[Any]:
+    """
+    全文检索生成历史
+
+    Args:
+        query: FTS5 MATCH表达式
+        limit: 返回条数
+        cursor: 上一页最后一条的 (rank, rowid)
+
+    Returns:
+        按相关度排序的匹配行
+    """
+    cursor_rank, cursor_rowid = cursor if cursor is not None else (float("-inf"), 0)
+    async with engine.connect() as conn:
+        result = await conn.execute(SEARCH_HISTORY, {
+            "query": query,
+            "limit": limit,
+            "cursor_rank": cursor_rank,
+            "cursor_rowid": cursor_rowid
+        })
+        return result.fetchall()
+
+
+async def insert_job(job_id: str, request: Dict[str, Any], created_at: float) -> None:
+    """新增排队中的任务"""
+    async with engine.begin() as conn:
+        await conn.execute(INSERT_JOB, {
+            "id": job_id,
+            "request": json.dumps(request, ensure_ascii=False),
+            "created_at": created_at
+        })
+
+
+async def claim_jobs(owner: str, limit: int, lease_seconds: float, now: float) -> List[Any]:
+    """认领最多 limit 个最早排队的任务，按排队顺序返回"""
+    async with engine.begin() as conn:
+        result = await conn.execute(CLAIM_JOBS, {
+            "owner": owner,
+            "limit": limit,
+            "lease_expires_at": now + lease_seconds,
+            "now": now
+        })
+        rows = result.fetchall()
+    return [row[1:] for row in sorted(rows)]
+
+
+async def renew_job_leases(owner: str, lease_seconds: float, now: float) -> List[str]:
+    """为持有的全部任务续约，返回仍持有的任务ID"""
+    async with engine.begin() as conn:
+        result = await conn.execute(RENEW_JOB_LEASES, {
+            "owner": owner,
+            "lease_expires_at": now + lease_seconds
+        })
+        return [row[0] for row in result.fetchall()]
+
+
+async def reclaim_expired_jobs(max_attempts: int, error: str, now: float) -> List[Any]:
+    """回收租约过期的任务，返回 (id, 新状态)"""
+    async with engine.begin() as conn:
+        result = await conn.execute(RECLAIM_EXPIRED_JOBS, {
+            "max_attempts": max_attempts,
+            "error": error,
+            "now": now
+        })
+        return result.fetchall()
+
+
+async def release_job_leases(owner: str) -> int:
+    """交还持有的全部任务"""
+    async with engine.begin() as conn:
+        result = await conn.execute(RELEASE_JOB_LEASES, {"owner": owner})
+        return result.rowcount
+
+
+async def set_job_provider_task(job_id: str, owner: str, provider_task_id: str) -> None:
+    """记录提供商的任务ID，重启后据此继续等待而不是重新提交"""
+    async with engine.begin() as conn:
+        await conn.execute(SET_JOB_PROVIDER_TASK, {
+            "id": job_id,
+            "owner": owner,
+            "provider_task_id": provider_task_id
+        })
+
+
+async def finish_job(job_id: str, owner: str, status: str, result: Optional[Dict[str, Any]],
+                     error: Optional[str], now: float) -> bool:
+    """写入任务结果，租约已不属于 owner 时不写入并返回False"""
+    async with engine.begin() as conn:
+        updated = await conn.execute(FINISH_JOB, {
+            "id": job_id,
+            "owner": owner,
+            "status": status,
+            "result": json.dumps(result, ensure_ascii=False) if result is not None else None,
+            "error": error,
+            "now": now
+        })
+        return updated.rowcount > 0
+
+
+async def cancel_job(job_id: str, error: str, now: float) -> bool:
+    """取消排队中或执行中的任务（执行中的由持有进程在续约时发现并停止）"""
+    async with engine.begin() as conn:
+        result = await conn.execute(CANCEL_JOB, {"id": job_id, "error": error, "now": now})
+        return result.rowcount > 0
+
+
+async def fetch_job(job_id: str) -> Optional[Any]:
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_JOB, {"id": job_id})
+        return result.fetchone()
+
+
+async def fetch_recent_jobs(limit: int = 50) -> List[Any]:
+    """最近提交的任务，新的在前"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_RECENT_JOBS, {"limit": limit})
+        return result.fetchall()
+
+
+async def fetch_job_counts() -> Any:
+    """排队中和执行中的任务数（所有进程）"""
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_JOB_COUNTS)
+        return result.fetchone()
+
+
+async def delete_finished_jobs(finished_before: float) -> int:
+    """删除结束时间早于 finished_before 的任务"""
+    async with engine.begin() as conn:
+        result = await conn.execute(DELETE_FINISHED_JOBS, {"finished_before": finished_before})
+        return result.rowcount
+
+
+async def fetch_cached_result(key: str, created_after: float, now: float) -> Optional[List[Dict[str, Any]]]:
+    """读取未过期的缓存结果并更新最近使用时间，不存在时返回None"""
+    async with engine.begin() as conn:
+        result = await conn.execute(SELECT_CACHED_RESULT, {"key": key, "created_after": created_after})
+        row = result.fetchone()
+        if row is None:
+            return None
+        await conn.execute(TOUCH_CACHED_RESULT, {"key": key, "now": now})
+        return json.loads(row[0])
+
+
+async def put_cached_result(key: str, images: List[Dict[str, Any]], now: float,
+                            created_after: float, max_entries: int) -> int:
+    """写入缓存结果，同时清理过期和超出条数上限的缓存，返回清理的条数"""
+    async with engine.begin() as conn:
+        await conn.execute(UPSERT_CACHED_RESULT, {"key": key, "images": json.dumps(images), "now": now})
+        expired = await conn.execute(DELETE_EXPIRED_RESULTS, {"created_after": created_after})
+        evicted = await conn.execute(DELETE_LEAST_RECENT_RESULTS, {"max_entries": max_entries})
+        return expired.rowcount + evicted.rowcount
+
+
+async def delete_cached_result(key: str) -> None:
+    async with engine.begin() as conn:
+        await conn.execute(DELETE_CACHED_RESULT, {"key": key})
+
+
+async def count_cached_results() -> int:
+    async with engine.connect() as conn:
+        result = await conn.execute(COUNT_CACHED_RESULTS)
+        return result.scalar()
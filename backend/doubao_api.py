@@ -9,7 +9,11 @@ import base64
 import io
 from typing import Any, Optional, Union
 from pydantic import BaseModel
-from PIL import Image
+from PIL import Image, ImageOps
+from http_client import get_shared_client
+from circuit_breaker import CircuitBreaker
+from rate_limiter import ProviderRateLimiter
+from retry_policy import RetryPolicy, open_stream, send_request
 
 class DoubaoImageRequest(BaseModel):
     """豆包图像生成请求模型"""
@@ -38,7 +42,11 @@ class DoubaoImageRequest(BaseModel):
 class DoubaoAPIClient:
     """豆包API客户端"""
     
-    def __init__(self, api_key: str, base_url: str = "https://ark.cn-beijing.volces.com/api/v3"):
+    def __init__(self, api_key: str, base_url: str = "https://ark.cn-beijing.volces.com/api/v3",
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 limiter: Optional[ProviderRateLimiter] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 breaker: Optional[CircuitBreaker] = None):
         self.api_key = api_key
         # 确保base_url不以/结尾，避免重复路径
         self.base_url = base_url.rstrip('/')
@@ -49,11 +57,71 @@ class DoubaoAPIClient:
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        # 未指定时使用按base_url共享的长连接客户端
+        self._http_client = http_client
+        # 按API配置共享的限流器、重试策略和熔断器，未指定时不限流、不重试、不熔断
+        self.limiter = limiter
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+    
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """请求使用的HTTP客户端"""
+        return self._http_client or get_shared_client(self.base_url)
+    
+    @property
+    def endpoint(self) -> str:
+        """图像生成接口地址"""
+        return f"{self.base_url}/images/generations"
     
     async def text_to_image(self, request: DoubaoImageRequest) -> dict[str, Any]:
         """文生图 - 纯文本输入单图输出"""
-        endpoint = f"{self.base_url}/images/generations"
-        
+        return await self._make_request(self.endpoint, await self._text_to_image_payload(request))
+    
+    async def image_to_image(self, request: DoubaoImageRequest) -> dict[str, Any]:
+        """图文生图 - 单图输入单图输出"""
+        return await self._make_request(self.endpoint, await self._image_to_image_payload(request))
+    
+    async def multi_image_fusion(self, request: DoubaoImageRequest) -> dict[str, Any]:
+        """多图融合 - 多图输入单图输出"""
+        return await self._make_request(self.endpoint, await self._multi_image_fusion_payload(request))
+    
+    async def batch_generation(self, request: DoubaoImageRequest) -> dict[str, Any]:
+        """组图输出 - 多图输出"""
+        return await self._make_request(self.endpoint, await self._batch_generation_payload(request))
+    
+    async def text_to_batch(self, request: DoubaoImageRequest) -> dict[str, Any]:
+        """文生组图"""
+        return await self.batch_generation(request)
+    
+    async def image_to_batch(self, request: DoubaoImageRequest) -> dict[str, Any]:
+        """单张图生组图"""
+        return await self._make_request(self.endpoint, await self._image_to_batch_payload(request))
+    
+    async def multi_reference_batch(self, request: DoubaoImageRequest) -> dict[str, Any]:
+        """多参考图生组图"""
+        return await self._make_request(self.endpoint, await self._multi_reference_batch_payload(request))
+    
+    async def generate(self, request: DoubaoImageRequest, generation_type: str = "text_to_image") -> dict[str, Any]:
+        """按生成类型生成图片，未知类型按文生图处理"""
+        return await self._make_request(self.endpoint, await self.build_payload(request, generation_type))
+    
+    async def build_payload(self, request: DoubaoImageRequest,
+                            generation_type: str = "text_to_image") -> dict[str, Any]:
+        """按生成类型构建请求体，未知类型按文生图处理"""
+        builders = {
+            "text_to_image": self._text_to_image_payload,
+            "image_to_image": self._image_to_image_payload,
+            "multi_image_fusion": self._multi_image_fusion_payload,
+            "batch_generation": self._batch_generation_payload,
+            "text_to_batch": self._batch_generation_payload,
+            "image_to_batch": self._image_to_batch_payload,
+            "multi_reference_batch": self._multi_reference_batch_payload,
+        }
+        builder = builders.get(generation_type, self._text_to_image_payload)
+        return await builder(request)
+    
+    async def _text_to_image_payload(self, request: DoubaoImageRequest) -> dict[str, Any]:
         payload = {
             "model": request.model,
             "prompt": request.prompt,
@@ -77,12 +145,9 @@ class DoubaoAPIClient:
         if request.watermark is not None:
             payload["watermark"] = request.watermark
         
-        return await self._make_request(endpoint, payload)
+        return payload
     
-    async def image_to_image(self, request: DoubaoImageRequest) -> dict[str, Any]:
-        """图文生图 - 单图输入单图输出"""
-        endpoint = f"{self.base_url}/images/generations"
-        
+    async def _image_to_image_payload(self, request: DoubaoImageRequest) -> dict[str, Any]:
         payload = {
             "model": request.model,
             "prompt": request.prompt,
@@ -92,12 +157,7 @@ class DoubaoAPIClient:
         }
         
         # 添加图像输入
-        if request.image:
-            payload["image"] = request.image
-        elif request.image_url:
-            # 如果是URL，需要下载并转换为base64
-            image_b64 = await self._url_to_base64(request.image_url)
-            payload["image"] = image_b64
+        await self._add_image_input(payload, request)
         
         # 添加可选参数
         if request.negative_prompt:
@@ -109,12 +169,9 @@ class DoubaoAPIClient:
         if request.watermark is not None:
             payload["watermark"] = request.watermark
         
-        return await self._make_request(endpoint, payload)
+        return payload
     
-    async def multi_image_fusion(self, request: DoubaoImageRequest) -> dict[str, Any]:
-        """多图融合 - 多图输入单图输出"""
-        endpoint = f"{self.base_url}/images/generations"
-        
+    async def _multi_image_fusion_payload(self, request: DoubaoImageRequest) -> dict[str, Any]:
         payload = {
             "model": request.model,
             "prompt": request.prompt,
@@ -130,12 +187,9 @@ class DoubaoAPIClient:
         if request.watermark is not None:
             payload["watermark"] = request.watermark
         
-        return await self._make_request(endpoint, payload)
+        return payload
     
-    async def batch_generation(self, request: DoubaoImageRequest) -> dict[str, Any]:
-        """组图输出 - 多图输出"""
-        endpoint = f"{self.base_url}/images/generations"
-        
+    async def _batch_generation_payload(self, request: DoubaoImageRequest) -> dict[str, Any]:
         # 设置更大的生成数量
         payload = {
             "model": request.model,
@@ -151,16 +205,9 @@ class DoubaoAPIClient:
         if request.seed is not None:
             payload["seed"] = request.seed
         
-        return await self._make_request(endpoint, payload)
+        return payload
     
-    async def text_to_batch(self, request: DoubaoImageRequest) -> dict[str, Any]:
-        """文生组图"""
-        return await self.batch_generation(request)
-    
-    async def image_to_batch(self, request: DoubaoImageRequest) -> dict[str, Any]:
-        """单张图生组图"""
-        endpoint = f"{self.base_url}/images/generations"
-        
+    async def _image_to_batch_payload(self, request: DoubaoImageRequest) -> dict[str, Any]:
         payload = {
             "model": request.model,
             "prompt": request.prompt,
@@ -170,12 +217,7 @@ class DoubaoAPIClient:
         }
         
         # 添加图像输入
-        if request.image:
-            payload["image"] = request.image
-        elif request.image_url:
-            # 如果是URL，需要下载并转换为base64
-            image_b64 = await self._url_to_base64(request.image_url)
-            payload["image"] = image_b64
+        await self._add_image_input(payload, request)
         
         # 添加可选参数
         if request.negative_prompt:
@@ -187,12 +229,9 @@ class DoubaoAPIClient:
         if request.watermark is not None:
             payload["watermark"] = request.watermark
         
-        return await self._make_request(endpoint, payload)
+        return payload
     
-    async def multi_reference_batch(self, request: DoubaoImageRequest) -> dict[str, Any]:
-        """多参考图生组图"""
-        endpoint = f"{self.base_url}/images/generations"
-        
+    async def _multi_reference_batch_payload(self, request: DoubaoImageRequest) -> dict[str, Any]:
         payload = {
             "model": request.model,
             "prompt": request.prompt,
@@ -210,54 +249,71 @@ class DoubaoAPIClient:
         if request.watermark is not None:
             payload["watermark"] = request.watermark
         
-        return await self._make_request(endpoint, payload)
+        return payload
     
-    async def stream_generation(self, request: DoubaoImageRequest):
-        """流式输出"""
-        endpoint = f"{self.base_url}/images/generations"
+    async def _add_image_input(self, payload: dict[str, Any], request: DoubaoImageRequest) -> None:
+        """添加单张输入图像"""
+        if request.image:
+            payload["image"] = request.image
+        elif request.image_url:
+            # 如果是URL，需要下载并转换为base64
+            payload["image"] = await self._url_to_base64(request.image_url)
+    
+    async def stream_generation(self, request: DoubaoImageRequest, generation_type: str = "text_to_image"):
+        """
+        流式输出 - 支持全部生成类型，逐个产出提供商的事件
         
-        payload = {
-            "model": request.model,
-            "prompt": request.prompt,
-            "size": request.size,
-            "n": request.n,
-            "stream": True,
-            "response_format": request.response_format
-        }
+        事件的 type 为 image_generation.partial_succeeded（单张图片完成，含 url 或 b64_json）、
+        image_generation.partial_failed（单张图片失败）和 image_generation.completed（全部结束）。
+        不支持流式输出的模型直接返回完整结果，这时按同样的事件格式逐张产出
+        """
+        payload = await self.build_payload(request, generation_type)
+        payload["stream"] = True
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            async with client.stream("POST", endpoint, json=payload, headers=self.headers) as response:
-                if response.status_code == 200:
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            data = line[6:]  # 移除 "data: " 前缀
-                            if data.strip() == "[DONE]":
-                                break
-                            try:
-                                yield json.loads(data)
-                            except json.JSONDecodeError:
-                                continue
-                else:
-                    raise Exception(f"API调用失败: {response.status_code} - {response.text}")
+        http_request = self.http_client.build_request("POST", self.endpoint, json=payload, headers=self.headers)
+        async with open_stream(self.http_client, http_request,
+                               self.limiter, self.retry_policy, self.breaker) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"API调用失败: {response.status_code} - {response.text}")
+            
+            if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                await response.aread()
+                result = response.json()
+                for index, item in enumerate(result.get("data") or []):
+                    yield {"type": "image_generation.partial_succeeded", "image_index": index, **item}
+                yield {"type": "image_generation.completed", "usage": result.get("usage")}
+                return
+            
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    data = line[6:]  # 移除 "data: " 前缀
+                    if data.strip() == "[DONE]":
+                        break
+                    try:
+                        yield json.loads(data)
+                    except json.JSONDecodeError:
+                        continue
     
     async def _make_request(self, endpoint: str, payload: dict[str, Any]) -> dict[str, Any]:
         """发送API请求"""
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(endpoint, json=payload, headers=self.headers)
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(f"API调用失败: {response.status_code} - {response.text}")
+        http_request = self.http_client.build_request("POST", endpoint, json=payload, headers=self.headers)
+        response = await send_request(self.http_client, http_request,
+                                      self.limiter, self.retry_policy, self.breaker)
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise Exception(f"API调用失败: {response.status_code} - {response.text}")
     
     async def _url_to_base64(self, image_url: str) -> str:
         """将图片URL转换为base64"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(image_url)
-            if response.status_code == 200:
-                return base64.b64encode(response.content).decode('utf-8')
-            else:
-                raise Exception(f"无法下载图片: {image_url}")
+        # 图片可能来自任意域名，使用默认共享连接池
+        response = await get_shared_client().get(image_url)
+        if response.status_code == 200:
+            return base64.b64encode(response.content).decode('utf-8')
+        else:
+            raise Exception(f"无法下载图片: {image_url}")
     
     @staticmethod
     def get_supported_sizes() -> list[str]:
@@ -305,20 +361,81 @@ def calculate_aspect_ratio(width: int, height: int) -> str:
     g = gcd(width, height)
     return f"{width//g}:{height//g}"
 
-def resize_image_for_api(image_data: bytes, max_size: int = 1024) -> str:
-    """调整图片大小并转换为base64"""
-    image = Image.open(io.BytesIO(image_data))
-    
-    # 保持宽高比调整大小
-    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-    
-    # 转换为RGB（如果是RGBA）
-    if image.mode in ('RGBA', 'LA'):
-        background = Image.new('RGB', image.size, (255, 255, 255))
-        background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-        image = background
-    
-    # 转换为base64
-    buffer = io.BytesIO()
-    image.save(buffer, format='JPEG', quality=85)
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
\ No newline at end of file
+# 尺寸已在限制内的JPEG不超过该字节数时直接透传，不重新编码
+RESIZE_PASSTHROUGH_MAX_BYTES = 2 * 1024 * 1024
+# EXIF中的方向标记（Orientation）
+EXIF_ORIENTATION = 0x0112
+
+
+class _BufferReader(io.RawIOBase):
+    """在bytearray/memoryview上按需读取的只读文件对象，避免先复制出完整的bytes"""
+
+    def __init__(self, data: Union[bytearray, memoryview]):
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = max(min(len(buffer), len(self._view) - self._position), 0)
+        buffer[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def resize_image_for_api(image_data: Union[bytes, bytearray, memoryview],
+                         max_size: int = 1024) -> str:
+    """
+    调整图片大小并转换为base64（JPEG）
+
+    已经是JPEG且尺寸、体积都在限制内、没有EXIF旋转的图片直接编码原始数据；
+    需要缩小的JPEG在解码时按DCT比例缩小（draft），再用reducing_gap分步缩放
+    """
+    fp = io.BytesIO(image_data) if isinstance(image_data, bytes) else _BufferReader(image_data)
+    with Image.open(fp) as image:
+        # Image.open只解析文件头，判断能否透传时不会解码像素
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        if (image.format == "JPEG" and image.mode in ("RGB", "L") and orientation == 1
+                and max(image.size) <= max_size
+                and len(image_data) <= RESIZE_PASSTHROUGH_MAX_BYTES):
+            return base64.b64encode(image_data).decode('utf-8')
+        
+        # JPEG解码时直接缩小到不小于目标尺寸的最小比例，其他格式无影响
+        image.draft("RGB", (max_size, max_size))
+        
+        # 重新编码不保留EXIF，先按方向标记旋转像素
+        if orientation != 1:
+            image = ImageOps.exif_transpose(image)
+        
+        # 保持宽高比调整大小
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        
+        # 透明图片合成到白色背景，其他模式转换为RGB
+        if image.mode == 'P':
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        if image.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        # 转换为base64
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+    return base64.b64encode(buffer.getbuffer()).decode('utf-8')
\ No newline at end of file
@@ -0,0 +1,164 @@
+"""
+历史记录批量写入器
+生成结果先进入有界队列，由后台协程按数量或时间分批写入数据库，持久化不再阻塞响应
+"""
+
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import database
+
+# write_behind: 入队后立即返回，后台批量写入；write_through: 提交完成后才返回
+HISTORY_WRITE_MODE = os.getenv("HISTORY_WRITE_MODE", "write_behind")
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "1000"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "100"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_FLUSH_RETRIES = 3
+
+# 通知后台协程写完剩余记录后退出
+_STOP = object()
+
+
+def history_timestamp() -> str:
+    """与 datetime('now') 相同格式的UTC时间，在入队时记录而不是写入时"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class HistoryWriter:
+    """后台批量写入历史记录"""
+
+    def __init__(self, max_queue_size: int = HISTORY_QUEUE_SIZE,
+                 batch_size: int = HISTORY_BATCH_SIZE,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL,
+                 mode: str = HISTORY_WRITE_MODE):
+        """
+        Args:
+            max_queue_size: 队列上限，队列满时写入方等待（背压）
+            batch_size: 单个事务最多写入的记录数
+            flush_interval: 攒批的最长等待时间（秒）
+            mode: write_behind 或 write_through
+        """
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.mode = mode
+        self._queue: Optional[asyncio.Queue] = None
+        self._runner: Optional[asyncio.Task] = None
+        # 已出队、等待攒批写入的记录
+        self._batch: List[Dict[str, Any]] = []
+
+        # 统计
+        self.records_written = 0
+        self.records_failed = 0
+        self.batches_flushed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self) -> None:
+        """启动后台写入协程"""
+        if self.mode == "write_through":
+            return
+        if self._runner is None or self._runner.done():
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """写入队列中剩余的记录后停止后台协程"""
+        if self._runner is not None and not self._runner.done():
+            await self._queue.put(_STOP)
+            await self._runner
+        self._runner = None
+
+    async def write(self, record: Dict[str, Any]) -> None:
+        """
+        保存一条历史记录
+
+        Args:
+            record: 包含 id、prompt、images、parameters 的字典
+        """
+        record.setdefault("timestamp", history_timestamp())
+        if self._runner is None or self._runner.done():
+            # 直写模式或写入器未启动时同步提交
+            await self._flush([record])
+            return
+        await self._queue.put(record)
+
+    async def _run(self) -> None:
+        """按数量或时间攒批写入"""
+        while True:
+            record = await self._queue.get()
+            if record is _STOP:
+                return
+
+            batch = self._batch = [record]
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            await self._flush(batch)
+            self._batch = []
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        """在一个事务中写入一批记录，失败时重试；仍然失败时逐条写入，只丢弃写不进去的记录"""
+        for attempt in range(HISTORY_FLUSH_RETRIES):
+            started = time.perf_counter()
+            try:
+                await database.insert_history_batch(batch)
+            except Exception as e:
+                print(f"写入历史记录失败（第{attempt + 1}次）: {e}")
+                await asyncio.sleep(0.1 * (attempt + 1))
+                continue
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.records_written += len(batch)
+            self.batches_flushed += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+            return
+
+        for record in batch:
+            try:
+                await database.insert_history_batch([record])
+            except Exception as e:
+                self.records_failed += 1
+                prompt = str(record.get("prompt", ""))[:30]
+                print(f"丢弃无法写入的历史记录 {record.get('id')}（提示词: {prompt!r}）: {e}")
+            else:
+                self.records_written += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """队列深度和写入延迟统计"""
+        return {
+            "mode": self.mode,
+            "queue_depth": self.queue_depth,
+            "buffered": len(self._batch),
+            "max_queue_size": self.max_queue_size,
+            "records_written": self.records_written,
+            "records_failed": self.records_failed,
+            "batches_flushed": self.batches_flushed,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.batches_flushed, 2) if self.batches_flushed else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2)
+        }
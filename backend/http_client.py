@@ -0,0 +1,78 @@
+"""
+共享HTTP连接池
+按base_url复用长连接的httpx.AsyncClient，避免每次请求重新进行DNS、TCP和TLS握手
+"""
+
+import importlib.util
+import os
+from typing import Dict, Iterable, Optional
+
+import httpx
+
+# 连接池配置（可通过环境变量调整）
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") != "0"
+
+# 未指定base_url时使用的键（例如下载任意图片URL）
+DEFAULT_POOL_KEY = ""
+
+_shared_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_available() -> bool:
+    """HTTP/2需要安装h2（httpx[http2]）"""
+    return HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+
+
+def _normalize_base_url(base_url: Optional[str]) -> str:
+    """按协议和主机归一化base_url，保证同一服务地址只对应一个连接池"""
+    if not base_url:
+        return DEFAULT_POOL_KEY
+    url = httpx.URL(base_url)
+    if not url.host:
+        return base_url.rstrip('/')
+    return f"{url.scheme}://{url.netloc.decode('ascii')}"
+
+
+def _create_client() -> httpx.AsyncClient:
+    """创建带连接池限制和keep-alive的客户端"""
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        limits=limits,
+        http2=_http2_available()
+    )
+
+
+def get_shared_client(base_url: Optional[str] = None) -> httpx.AsyncClient:
+    """获取base_url对应的共享客户端，不存在或已关闭时创建"""
+    key = _normalize_base_url(base_url)
+    client = _shared_clients.get(key)
+    if client is None or client.is_closed:
+        client = _create_client()
+        _shared_clients[key] = client
+    return client
+
+
+def init_shared_clients(base_urls: Iterable[str] = ()) -> None:
+    """在应用启动时预先创建连接池"""
+    get_shared_client(DEFAULT_POOL_KEY)
+    for base_url in base_urls:
+        get_shared_client(base_url)
+
+
+async def close_shared_clients() -> None:
+    """在应用关闭时释放所有连接"""
+    clients = list(_shared_clients.values())
+    _shared_clients.clear()
+    for client in clients:
+        if not client.is_closed:
+            await client.aclose()
+
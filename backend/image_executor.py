@@ -0,0 +1,255 @@
+"""
+图片处理进程池
+所有Pillow处理（缩放、缩略图、转码）都提交到这里，在独立进程中执行，不占用事件循环线程和GIL。
+提交数量有上限，超过时调用方等待；每个任务有超时；较大的输入输出通过共享内存传递，避免序列化大段字节
+"""
+
+import asyncio
+import gc
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Optional, Union
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+# 同时提交到进程池的任务上限（包括排队中的），超过时调用方等待
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", str(IMAGE_WORKERS * 4)))
+IMAGE_TASK_TIMEOUT = float(os.getenv("IMAGE_TASK_TIMEOUT", "30"))
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class ImageTaskTimeout(Exception):
+    """图片处理超时"""
+
+
+def _read_shared(name: str, size: int) -> bytes:
+    shared = SharedMemory(name=name)
+    try:
+        return bytes(shared.buf[:size])
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def _discard_output(result: Any) -> None:
+    """释放调用方已放弃的任务的输出共享内存"""
+    if result[0] == "shm":
+        shared = SharedMemory(name=result[1])
+        shared.close()
+        shared.unlink()
+
+
+def _write_shared(data: BytesLike) -> SharedMemory:
+    data = memoryview(data).cast("B")
+    shared = SharedMemory(create=True, size=max(len(data), 1))
+    shared.buf[:len(data)] = data
+    return shared
+
+
+def _run_task(func: Callable, input_name: Optional[str], input_size: int, args: tuple) -> Any:
+    """
+    在工作进程中执行任务
+
+    输入在共享内存中时以memoryview传给func（不复制）；
+    func返回bytes或str时结果写入新的共享内存，由主进程读取后释放
+    """
+    if input_name is None:
+        result = func(*args)
+    else:
+        shared = SharedMemory(name=input_name)
+        view = shared.buf[:input_size]
+        error = None
+        try:
+            result = func(view, *args)
+        except Exception as e:
+            # traceback中的栈帧仍引用着输入的memoryview，丢弃后才能释放共享内存
+            e.__traceback__ = e.__context__ = e.__cause__ = None
+            error = e
+        try:
+            view.release()
+        except BufferError:
+            gc.collect()
+            view.release()
+        shared.close()
+        if error is not None:
+            raise error
+
+    is_text = isinstance(result, str)
+    if is_text:
+        result = result.encode("utf-8")
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        output = _write_shared(result)
+        output.close()
+        return ("shm", output.name, memoryview(result).nbytes, is_text)
+    return ("value", result)
+
+
+class ImageExecutor:
+    """有界提交、带超时的图片处理进程池"""
+
+    def __init__(self, workers: int = IMAGE_WORKERS, max_queue_size: int = IMAGE_QUEUE_SIZE,
+                 task_timeout: float = IMAGE_TASK_TIMEOUT):
+        """
+        Args:
+            workers: 进程数
+            max_queue_size: 同时提交到进程池的任务上限
+            task_timeout: 单个任务的默认超时（秒），包括等待提交的时间
+        """
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.task_timeout = task_timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+        # 统计
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.max_task_ms = 0.0
+        self._total_task_ms = 0.0
+        self._total_wait_ms = 0.0
+
+    def start(self) -> None:
+        """启动进程池"""
+        if self._executor is None:
+            # spawn避免在已有线程的进程中fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            self._slots = asyncio.Semaphore(self.max_queue_size)
+
+    async def stop(self) -> None:
+        """等待已提交的任务完成后关闭进程池"""
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown)
+
+    async def run(self, func: Callable, *args, data: Optional[BytesLike] = None,
+                  timeout: Optional[float] = None) -> Any:
+        """
+        在进程池中执行 func(*args)
+
+        Args:
+            func: 模块级函数（需要能被子进程导入）
+            data: 图片数据，通过共享内存传入，作为第一个参数以memoryview传给func
+            timeout: 超时（秒），默认使用 task_timeout
+
+        Raises:
+            ImageTaskTimeout: 等待提交或执行超时
+        """
+        if self._executor is None:
+            self.start()
+        deadline = time.monotonic() + (timeout or self.task_timeout)
+
+        self.waiting += 1
+        wait_started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise ImageTaskTimeout("图片处理队列已满，等待超时")
+        finally:
+            self.waiting -= 1
+        self._total_wait_ms += (time.perf_counter() - wait_started) * 1000
+
+        shared = None
+        try:
+            if data is not None:
+                data = memoryview(data).cast("B")
+                shared = _write_shared(data)
+            future = self._executor.submit(
+                _run_task, func, shared.name if shared else None, len(data) if shared else 0, args
+            )
+        except Exception:
+            self._release_input(shared)
+            self._slots.release()
+            raise
+        started = time.perf_counter()
+
+        # 任务真正结束时才释放名额和输入共享内存，超时的任务仍占用进程，名额反映实际负载
+        self.in_flight += 1
+        task_state = {"finished": False, "abandoned": False}
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(
+            lambda done: loop.call_soon_threadsafe(self._finish, done, shared, task_state)
+        )
+
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), timeout=max(deadline - time.monotonic(), 0)
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._abandon(future, task_state)
+            raise ImageTaskTimeout("图片处理超时")
+        except asyncio.CancelledError:
+            # 调用方被取消（如批量上传的客户端断开），同样不再读取输出
+            self._abandon(future, task_state)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.completed += 1
+        self.max_task_ms = max(self.max_task_ms, elapsed_ms)
+        self._total_task_ms += elapsed_ms
+
+        if result[0] == "shm":
+            _, name, size, is_text = result
+            output = _read_shared(name, size)
+            return output.decode("utf-8") if is_text else output
+        return result[1]
+
+    def _finish(self, future: Future, shared: Optional[SharedMemory],
+                task_state: Dict[str, bool]) -> None:
+        """任务结束（在事件循环中执行）：释放输入共享内存和提交名额"""
+        self._release_input(shared)
+        self.in_flight -= 1
+        self._slots.release()
+        task_state["finished"] = True
+        if task_state["abandoned"]:
+            self._discard_result(future)
+
+    def _abandon(self, future: Future, task_state: Dict[str, bool]) -> None:
+        """不再等待任务：尚未开始的取消，已结束的立即丢弃输出，否则在结束时丢弃"""
+        future.cancel()
+        task_state["abandoned"] = True
+        if task_state["finished"]:
+            self._discard_result(future)
+
+    @staticmethod
+    def _discard_result(future: Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            _discard_output(future.result())
+
+    @staticmethod
+    def _release_input(shared: Optional[SharedMemory]) -> None:
+        if shared is not None:
+            shared.close()
+            shared.unlink()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """队列深度和处理耗时统计"""
+        return {
+            "workers": self.workers,
+            "max_queue_size": self.max_queue_size,
+            "queue_depth": self.waiting,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "avg_task_ms": round(self._total_task_ms / self.completed, 2) if self.completed else 0.0,
+            "max_task_ms": round(self.max_task_ms, 2),
+            "avg_wait_ms": round(self._total_wait_ms / (self.completed + self.failed), 2)
+                           if self.completed + self.failed else 0.0
+        }
+
+
+# 全局图片处理进程池
+image_executor = ImageExecutor()
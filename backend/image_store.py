@@ -0,0 +1,432 @@
+"""
+内容寻址的本地图片存储
+生成结果按SHA-256保存到分片目录中（ab/cd/<hash>），历史记录只保存哈希，
+通过 /api/images/{hash} 提供带强ETag、长期缓存和Range支持的访问
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Any, Dict, List, Optional, Tuple
+
+import anyio
+from PIL import Image
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+from http_client import get_shared_client
+from image_executor import image_executor
+
+try:
+    # 可选依赖：安装 pillow-heif 后Pillow可以解码HEIC/HEIF
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_DECODER = True
+except ImportError:
+    HEIF_DECODER = False
+
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+# 单张图片的最大字节数，超过时放弃保存
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(50 * 1024 * 1024)))
+# 最近用作输入的图片的data URL缓存上限（字节），连续编辑同一张图时不必重复读取和编码
+INPUT_CACHE_BYTES = int(os.getenv("INPUT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# 内容不变，浏览器和CDN可以永久缓存
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# 本服务 /api/images/{hash} 地址中的哈希
+IMAGE_URL_PATTERN = re.compile(r"/api/images/([0-9a-f]{64})$")
+
+# 文件头到Content-Type的映射
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+]
+# ISO BMFF 文件（ftyp box）的品牌到Content-Type的映射
+_HEIF_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"heim": "image/heic", b"heis": "image/heic",
+    b"hevc": "image/heic-sequence", b"hevx": "image/heic-sequence",
+    b"mif1": "image/heif", b"msf1": "image/heif-sequence",
+    b"avif": "image/avif", b"avis": "image/avif",
+}
+
+
+def is_image_hash(value: str) -> bool:
+    """判断字符串是否为存储使用的哈希"""
+    return bool(HASH_PATTERN.match(value))
+
+
+def parse_image_handle(value: str) -> Optional[str]:
+    """
+    解析图片句柄：哈希本身或本服务的 /api/images/{hash} 地址
+
+    Returns:
+        图片哈希；data URL和外部URL返回None
+    """
+    if is_image_hash(value):
+        return value
+    if value.startswith(("http://", "https://", "/")):
+        match = IMAGE_URL_PATTERN.search(value.split("?", 1)[0])
+        if match:
+            return match.group(1)
+    return None
+
+
+def sniff_media_type(header: bytes) -> str:
+    """根据文件头判断图片类型"""
+    for signature, media_type in _SIGNATURES:
+        if header.startswith(signature):
+            return media_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp" and header[8:12] in _HEIF_BRANDS:
+        return _HEIF_BRANDS[header[8:12]]
+    return "application/octet-stream"
+
+
+def verify_image_file(path: str) -> str:
+    """
+    在工作进程中执行：用Pillow校验图片文件，返回Content-Type
+
+    没有安装HEIC/HEIF解码器时按文件头接受这两种格式
+
+    Raises:
+        ValueError: 不是Pillow能识别的完整图片
+    """
+    with open(path, "rb") as file:
+        media_type = sniff_media_type(file.read(12))
+    if media_type.startswith("image/hei") and not HEIF_DECODER:
+        return media_type
+    try:
+        with Image.open(path) as image:
+            image_format = image.format
+            image.verify()
+    except Exception as e:
+        raise ValueError("无法识别的图片格式") from e
+    return Image.MIME.get(image_format) or media_type
+
+
+def image_path(root: str, image_hash: str) -> str:
+    """哈希对应的文件路径：前两级目录各取两位，避免单个目录文件过多"""
+    return os.path.join(root, image_hash[:2], image_hash[2:4], image_hash)
+
+
+def store_bytes(root: str, data: bytes) -> str:
+    """同步保存图片并返回哈希，供进程池中的缩略图任务使用"""
+    image_hash = hashlib.sha256(data).hexdigest()
+    path = image_path(root, image_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    return image_hash
+
+
+class ImageWriter:
+    """边写入边计算哈希的临时文件，提交后移动到哈希对应的位置"""
+
+    def __init__(self, store: "ImageStore"):
+        self._store = store
+        self._digest = hashlib.sha256()
+        self.size = 0
+        # 提交时相同内容已存在
+        self.duplicate = False
+        os.makedirs(store.temp_dir, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=store.temp_dir)
+        self._file = os.fdopen(fd, "wb")
+
+    async def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > IMAGE_MAX_BYTES:
+            raise ValueError(f"图片超过大小限制 {IMAGE_MAX_BYTES} 字节")
+        self._digest.update(chunk)
+        await asyncio.to_thread(self._file.write, chunk)
+
+    async def verify(self) -> str:
+        """写入完成后在进程池中校验图片，返回Content-Type"""
+        await asyncio.to_thread(self._file.flush)
+        return await image_executor.run(verify_image_file, self._temp_path)
+
+    async def commit(self) -> str:
+        """写入完成，返回图片哈希；相同内容已存在时直接复用"""
+        image_hash = self._digest.hexdigest()
+        self.duplicate = await asyncio.to_thread(
+            self._store._commit_file, self._file, self._temp_path, image_hash
+        )
+        return image_hash
+
+    async def abort(self) -> None:
+        await asyncio.to_thread(self._store._discard_file, self._file, self._temp_path)
+
+
+class DataUrlCache:
+    """按字节数限制的LRU缓存，键为图片哈希"""
+
+    def __init__(self, max_bytes: int = INPUT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+
+    def get(self, image_hash: str) -> Optional[str]:
+        value = self._entries.get(image_hash)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(image_hash)
+        self.hits += 1
+        return value
+
+    def put(self, image_hash: str, value: str) -> None:
+        if len(value) > self.max_bytes or image_hash in self._entries:
+            return
+        self._entries[image_hash] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class ImageStore:
+    """按内容哈希分片保存图片的目录"""
+
+    def __init__(self, root: str = IMAGE_STORE_DIR):
+        self.root = os.path.abspath(root)
+        self.temp_dir = os.path.join(self.root, "tmp")
+        self.input_cache = DataUrlCache()
+
+    def path_for(self, image_hash: str) -> str:
+        return image_path(self.root, image_hash)
+
+    def exists(self, image_hash: str) -> bool:
+        return is_image_hash(image_hash) and os.path.isfile(self.path_for(image_hash))
+
+    def writer(self) -> ImageWriter:
+        return ImageWriter(self)
+
+    def _commit_file(self, file, temp_path: str, image_hash: str) -> bool:
+        """移动到哈希对应的位置，返回是否已存在相同内容"""
+        file.close()
+        path = self.path_for(image_hash)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 原子替换，并发写入相同内容时结果一致
+        os.replace(temp_path, path)
+        return False
+
+    def _discard_file(self, file, temp_path: str) -> None:
+        file.close()
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    async def put_bytes(self, data: bytes) -> str:
+        """保存内存中的图片，返回哈希"""
+        image_hash = hashlib.sha256(data).hexdigest()
+        if not self.exists(image_hash):
+            writer = self.writer()
+            try:
+                await writer.write(data)
+            except Exception:
+                await writer.abort()
+                raise
+            await writer.commit()
+        return image_hash
+
+    async def read_data_url(self, image_hash: str) -> str:
+        """读取图片并编码为data URL，用于构建提供商请求"""
+        data_url = self.input_cache.get(image_hash)
+        if data_url is None:
+            data = await asyncio.to_thread(self._read_file, image_hash)
+            encoded = base64.b64encode(data).decode("ascii")
+            data_url = f"data:{sniff_media_type(data[:12])};base64,{encoded}"
+            self.input_cache.put(image_hash, data_url)
+        return data_url
+
+    def _read_file(self, image_hash: str) -> bytes:
+        with open(self.path_for(image_hash), "rb") as file:
+            return file.read()
+
+    async def fetch_url(self, url: str) -> str:
+        """流式下载图片URL并保存，返回哈希"""
+        if url.startswith("data:"):
+            return await self.put_bytes(base64.b64decode(url.split(",", 1)[1]))
+
+        writer = self.writer()
+        try:
+            async with get_shared_client().stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    await writer.write(chunk)
+        except Exception:
+            await writer.abort()
+            raise
+        return await writer.commit()
+
+    async def save_result(self, item: Dict[str, Any]) -> Dict[str, Optional[str]]:
+        """
+        保存提供商返回的一张结果图片
+
+        Returns:
+            {"hash": 哈希, "url": None}；下载提供商URL失败时保留该URL: {"hash": None, "url": 原始URL}
+
+        Raises:
+            Exception: base64结果（或data URL）保存失败，图片数据不写入历史记录
+        """
+        if "b64_json" in item:
+            return {"hash": await self.put_bytes(base64.b64decode(item["b64_json"])), "url": None}
+        try:
+            return {"hash": await self.fetch_url(item["url"]), "url": None}
+        except Exception as e:
+            if item["url"].startswith("data:"):
+                raise
+            print(f"保存生成图片失败，保留提供商地址: {e}")
+            return {"hash": None, "url": item["url"]}
+
+    async def save_results(self, items: List[Dict[str, Any]]) -> List[Dict[str, Optional[str]]]:
+        """并发保存一次生成的全部结果图片，保持原有顺序"""
+        return list(await asyncio.gather(*(self.save_result(item) for item in items)))
+
+
+class ImageFileResponse(FileResponse):
+    """支持单个Range区间的文件响应"""
+
+    def __init__(self, path: str, file_range: Optional[Tuple[int, int]] = None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.file_range = file_range
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.file_range is None:
+            await super().__call__(scope, receive, send)
+            return
+
+        start, end = self.file_range
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        remaining = end - start + 1
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(start)
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                remaining -= len(chunk)
+                more_body = remaining > 0 and len(chunk) > 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                if not chunk:
+                    break
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析 bytes=start-end 形式的单个区间
+
+    Returns:
+        (start, end) 闭区间；格式不支持时返回None（按完整文件响应）
+
+    Raises:
+        ValueError: 区间超出文件范围
+    """
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[6:].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            # bytes=-N 表示最后N个字节
+            start = max(size - int(end_text), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("区间超出文件范围")
+    return start, min(end, size - 1)
+
+
+def _stat_and_head(path: str) -> Tuple[os.stat_result, bytes]:
+    """文件信息和用于判断类型的文件头"""
+    with open(path, "rb") as file:
+        return os.fstat(file.fileno()), file.read(12)
+
+
+async def image_response(store: ImageStore, image_hash: str, headers: Dict[str, str],
+                         method: str = "GET") -> Response:
+    """
+    构建图片响应：强ETag、永久缓存，支持 If-None-Match 和 Range
+
+    Args:
+        store: 图片存储
+        image_hash: 图片哈希（调用方已校验格式）
+        headers: 请求头（小写键）
+        method: 请求方法，HEAD时只返回响应头
+
+    Raises:
+        FileNotFoundError: 图片不存在
+    """
+    path = store.path_for(image_hash)
+    # 文件操作在线程中执行，不阻塞事件循环
+    stat_result, head = await asyncio.to_thread(_stat_and_head, path)
+    etag = f'"{image_hash}"'
+    response_headers = {
+        "etag": etag,
+        "cache-control": IMMUTABLE_CACHE_CONTROL,
+        "accept-ranges": "bytes",
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True)
+    }
+
+    if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=response_headers)
+
+    media_type = sniff_media_type(head)
+
+    range_header = headers.get("range")
+    if_range = headers.get("if-range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            file_range = parse_range(range_header, stat_result.st_size)
+        except ValueError:
+            response_headers["content-range"] = f"bytes */{stat_result.st_size}"
+            return Response(status_code=416, headers=response_headers)
+        if file_range is not None:
+            start, end = file_range
+            response_headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+            response_headers["content-length"] = str(end - start + 1)
+            return ImageFileResponse(path, file_range=file_range, status_code=206,
+                                     headers=response_headers, media_type=media_type,
+                                     method=method)
+
+    return ImageFileResponse(path, headers=response_headers, media_type=media_type,
+                             stat_result=stat_result, method=method)
@@ -0,0 +1,473 @@
+"""
+异步生成任务队列
+提交后立即返回任务ID，任务的状态、请求和结果保存在 generation_jobs 表中，部署或崩溃后不会丢失。
+每个进程按并发上限从表中认领任务并加租约，执行期间定期续约；租约过期的任务由任意进程重新入队，
+记录了提供商任务ID的（Qwen）重新执行时直接继续等待原任务，不会重复提交。
+客户端可以轮询任务状态或订阅事件流，生成结果与连接无关，客户端断开后仍会保存到图片存储和历史记录
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import socket
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+import database
+
+# 每个进程同时执行的生成任务数
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# 排队任务上限（所有进程合计），超过时拒绝提交
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "10000"))
+# 租约时长和续约间隔（秒）：进程崩溃后其任务最迟在租约到期后被重新入队
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+# 没有本进程提交的新任务时，检查其他进程提交或重新入队的任务的间隔（秒）
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# 单个任务最多执行次数（租约过期重新入队计一次）
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# 关闭时等待执行中的任务完成的时间（秒），超时的任务交还租约，重启后重新执行
+JOB_SHUTDOWN_GRACE_SECONDS = float(os.getenv("JOB_SHUTDOWN_GRACE_SECONDS", "30"))
+# 已结束的任务在数据库中保留的时间（秒）
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+# 事件记录在内存中保留的时间（秒），之后只能从数据库查询状态和结果
+JOB_EVENTS_RETENTION_SECONDS = float(os.getenv("JOB_EVENTS_RETENTION_SECONDS", "300"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELED = "canceled"
+JOB_FINISHED_STATUSES = {JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELED}
+
+
+class JobQueueFull(Exception):
+    """排队任务已达上限"""
+
+
+class Job:
+    """一个生成任务：请求、状态和按顺序记录的事件（事件只在提交或执行它的进程中记录）"""
+
+    def __init__(self, job_id: str, request: Dict[str, Any], created_at: Optional[float] = None):
+        self.id = job_id
+        self.request = request
+        self.status = JOB_QUEUED
+        self.error: Optional[str] = None
+        self.created_at = created_at or time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.attempts = 0
+        # 提供商的异步任务ID（Qwen），重新执行时据此继续等待
+        self.provider_task_id: Optional[str] = None
+        # 生成事件，订阅方按序号续读
+        self.events: List[Dict[str, Any]] = []
+        # complete 事件中的结果图片
+        self.result: Optional[Dict[str, Any]] = None
+        # 本进程已不再跟踪（租约丢失），订阅方应改为从数据库查询
+        self.detached = False
+        self._task: Optional[asyncio.Task] = None
+        self._updated = asyncio.Event()
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> "Job":
+        """由 generation_jobs 的一行（JOB_COLUMNS）创建"""
+        job_id, status, request, provider_task_id, result, error, attempts, created_at, started_at, finished_at = row
+        job = cls(job_id, json.loads(request), created_at)
+        job.status = status
+        job.provider_task_id = provider_task_id
+        job.result = json.loads(result) if result else None
+        job.error = error
+        job.attempts = attempts
+        job.started_at = started_at
+        job.finished_at = finished_at
+        return job
+
+    @property
+    def finished(self) -> bool:
+        return self.status in JOB_FINISHED_STATUSES
+
+    def add_event(self, event: Dict[str, Any]) -> None:
+        """记录一个事件并唤醒订阅方"""
+        self.events.append(event)
+        self._notify()
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def subscribe(self, after: int = 0) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        从第 after 个事件开始逐个产出 (序号, 事件)，任务结束且事件读完后返回
+
+        Args:
+            after: 已读取的事件数（断线重连时从上次的位置继续）
+        """
+        position = max(after, 0)
+        while True:
+            updated = self._updated
+            while position < len(self.events):
+                yield position, self.events[position]
+                position += 1
+            if self.finished or self.detached:
+                return
+            await updated.wait()
+
+
+class JobQueue:
+    """持久化在数据库中的生成任务队列，每个进程按并发上限认领任务并按提交顺序执行"""
+
+    def __init__(self, runner: Callable[[Job], AsyncIterator[Dict[str, Any]]],
+                 workers: int = JOB_WORKERS, max_queue_size: int = JOB_QUEUE_SIZE,
+                 lease_seconds: float = JOB_LEASE_SECONDS,
+                 heartbeat_interval: float = JOB_HEARTBEAT_INTERVAL,
+                 poll_interval: float = JOB_POLL_INTERVAL,
+                 max_attempts: int = JOB_MAX_ATTEMPTS,
+                 shutdown_grace: float = JOB_SHUTDOWN_GRACE_SECONDS,
+                 retention: float = JOB_RETENTION_SECONDS,
+                 events_retention: float = JOB_EVENTS_RETENTION_SECONDS):
+        """
+        Args:
+            runner: 执行一个任务，逐个产出生成事件；task 事件的 resume（没有时为 task_id）作为提供商任务ID保存，
+                complete 事件作为任务结果保存；job.provider_task_id 不为空时应继续等待该任务
+            workers: 本进程同时执行的任务数
+            max_queue_size: 排队任务上限（所有进程合计）
+            lease_seconds: 租约时长（秒）
+            heartbeat_interval: 续约和回收过期租约的间隔（秒）
+            poll_interval: 检查其他进程提交的任务的间隔（秒）
+            max_attempts: 单个任务最多执行次数
+            shutdown_grace: 关闭时等待执行中的任务完成的时间（秒）
+            retention: 已结束的任务在数据库中的保留时间（秒）
+            events_retention: 事件记录在内存中的保留时间（秒）
+        """
+        self.runner = runner
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.shutdown_grace = shutdown_grace
+        self.retention = retention
+        self.events_retention = events_retention
+        # 租约持有者标识，每次启动都不同
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        # 本进程提交或执行的任务（带事件记录）
+        self._jobs: Dict[str, Job] = {}
+        self._running: Dict[str, Job] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._claiming = False
+        self._stopping = False
+        self._queued_estimate = 0
+
+        # 统计
+        self.submitted = 0
+        self.rejected = 0
+        self.claimed = 0
+        self.resumed = 0
+        self.reclaimed = 0
+        self.lost_leases = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.canceled = 0
+        self._claim_batches = 0
+        self._total_claim_ms = 0.0
+        self._total_wait_ms = 0.0
+        self._total_run_ms = 0.0
+
+    def start(self) -> None:
+        """启动认领和续约协程；续约协程首先回收上次运行遗留的过期租约"""
+        if self._dispatcher is not None:
+            return
+        self._claiming = True
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self) -> None:
+        """
+        停止认领新任务，等待执行中的任务完成（最多 shutdown_grace 秒）；
+        仍未完成的任务取消并交还租约，重启后（或由其他进程）立即继续执行
+        """
+        if self._dispatcher is None:
+            return
+        # wait_for 在超时的同时被取消时可能吞掉取消（Python 3.11），认领循环同时检查标志
+        self._claiming = False
+        self._wakeup.set()
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+
+        tasks = [job._task for job in self._running.values() if job._task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.shutdown_grace)
+
+        self._stopping = True
+        self._heartbeat.cancel()
+        tasks = [job._task for job in self._running.values() if job._task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(self._heartbeat, *tasks, return_exceptions=True)
+        self._dispatcher = self._heartbeat = None
+        released = await database.release_job_leases(self.owner)
+        if released:
+            print(f"已交还 {released} 个执行中的生成任务")
+        self._running.clear()
+
+    async def submit(self, request: Dict[str, Any]) -> Job:
+        """
+        提交一个任务，写入数据库后返回，不等待执行
+
+        Raises:
+            JobQueueFull: 排队任务已达上限
+        """
+        if self._queued_estimate >= self.max_queue_size:
+            # 估计值可能过时，超限时再查一次
+            self._queued_estimate = (await database.fetch_job_counts())[0]
+            if self._queued_estimate >= self.max_queue_size:
+                self.rejected += 1
+                raise JobQueueFull("任务队列已满，请稍后再试")
+
+        job = Job(secrets.token_urlsafe(16), request)
+        await database.insert_job(job.id, request, job.created_at)
+        self._queued_estimate += 1
+        self._jobs[job.id] = job
+        self.submitted += 1
+        job.add_event({"type": "queued", "job_id": job.id})
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        """本进程中的任务直接返回（带事件），否则从数据库读取"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        row = await database.fetch_job(job_id)
+        return Job.from_row(row) if row else None
+
+    async def recent(self, limit: int = 50) -> List[Job]:
+        """最近提交的任务，新的在前"""
+        return [self._jobs.get(row[0]) or Job.from_row(row)
+                for row in await database.fetch_recent_jobs(limit)]
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        """取消排队中或执行中的任务，已结束的任务不变；其他进程执行的任务在其下次续约时停止"""
+        job = self._running.get(job_id)
+        if job is not None and job._task is not None:
+            task = job._task
+            task.cancel()
+            await asyncio.wait({task})
+            return job
+
+        if await database.cancel_job(job_id, "任务已取消", time.time()):
+            self.canceled += 1
+            local = self._jobs.get(job_id)
+            if local is not None and not local.finished:
+                self._mark_finished(local, JOB_CANCELED, "任务已取消")
+        return await self.get(job_id)
+
+    async def subscribe(self, job: Job, after: int = 0) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        订阅任务事件。本进程中的任务逐个转发事件记录；
+        其他进程执行（或事件记录已过期）的任务轮询数据库，状态变化时产出对应事件
+        """
+        local = self._jobs.get(job.id)
+        if local is not None:
+            async for item in local.subscribe(after):
+                yield item
+            if not local.detached:
+                return
+            after = max(after, len(local.events))
+            job = await self.get(job.id) or local
+
+        position = 0
+        status = None
+        while True:
+            if job.status != status:
+                status = job.status
+                for event in self._status_events(job):
+                    if position >= after:
+                        yield position, event
+                    position += 1
+            if job.finished:
+                return
+            await asyncio.sleep(self.poll_interval)
+            refreshed = await self.get(job.id)
+            if refreshed is None:
+                return
+            job = refreshed
+
+    @staticmethod
+    def _status_events(job: Job) -> List[Dict[str, Any]]:
+        """由数据库中的任务状态生成对应的事件"""
+        if job.status == JOB_SUCCEEDED:
+            return [job.result] if job.result else []
+        if job.status == JOB_FAILED:
+            return [{"type": "error", "error": job.error}]
+        if job.status == JOB_CANCELED:
+            return [{"type": "canceled", "error": job.error}]
+        return [{"type": job.status, "job_id": job.id}]
+
+    async def _dispatch_loop(self) -> None:
+        """有空闲名额时从数据库认领任务"""
+        while self._claiming:
+            free = self.workers - len(self._running)
+            claimed = []
+            if free > 0:
+                self._wakeup.clear()
+                try:
+                    claimed = await self._claim(free)
+                except Exception as e:
+                    print(f"认领生成任务失败: {e}")
+            if free > 0 and len(claimed) == free:
+                # 可能还有排队中的任务，立即继续认领
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self, limit: int) -> List[Job]:
+        """在一个事务中认领最多 limit 个任务并开始执行"""
+        started = time.perf_counter()
+        rows = await database.claim_jobs(self.owner, limit, self.lease_seconds, time.time())
+        self._claim_batches += 1
+        self._total_claim_ms += (time.perf_counter() - started) * 1000
+        self._queued_estimate = max(self._queued_estimate - len(rows), 0)
+
+        jobs = []
+        for row in rows:
+            claimed = Job.from_row(row)
+            # 本进程提交的任务沿用已有的事件记录
+            job = self._jobs.get(claimed.id) or claimed
+            job.status = JOB_RUNNING
+            job.attempts = claimed.attempts
+            job.started_at = claimed.started_at
+            job.provider_task_id = claimed.provider_task_id
+            self._jobs[job.id] = job
+            self._running[job.id] = job
+            self.claimed += 1
+            if job.provider_task_id:
+                self.resumed += 1
+            self._total_wait_ms += max(time.time() - job.created_at, 0) * 1000
+            job.add_event({"type": "running", "job_id": job.id, "attempt": job.attempts})
+            job._task = asyncio.create_task(self._execute(job))
+            jobs.append(job)
+        return jobs
+
+    async def _execute(self, job: Job) -> None:
+        started = time.perf_counter()
+        status, error = JOB_SUCCEEDED, None
+        try:
+            async for event in self.runner(job):
+                if event.get("type") == "task":
+                    # 先记录提供商任务ID，之后崩溃也能继续等待而不是重新提交
+                    job.provider_task_id = event.get("resume") or event["task_id"]
+                    await database.set_job_provider_task(job.id, self.owner, job.provider_task_id)
+                elif event.get("type") == "complete":
+                    job.result = event
+                job.add_event(event)
+        except asyncio.CancelledError:
+            if self._stopping or job.id not in self._running:
+                # 服务关闭（租约在 stop 中交还）或租约已丢失，不写入结果
+                return
+            status, error = JOB_CANCELED, "任务已取消"
+        except Exception as e:
+            status, error = JOB_FAILED, getattr(e, "detail", None) or str(e) or "生成失败"
+            job.add_event({"type": "error", "error": error})
+        finally:
+            job._task = None
+            self._total_run_ms += (time.perf_counter() - started) * 1000
+
+        self._running.pop(job.id, None)
+        try:
+            written = await database.finish_job(job.id, self.owner, status, job.result, error, time.time())
+        except Exception as e:
+            # 写入失败时租约会过期，任务由其他进程或重启后重新执行
+            print(f"保存生成任务 {job.id} 结果失败: {e}")
+            written = False
+        if written:
+            setattr(self, status, getattr(self, status) + 1)
+        self._mark_finished(job, status, error)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _mark_finished(self, job: Job, status: str, error: Optional[str]) -> None:
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        if status == JOB_CANCELED:
+            job.add_event({"type": "canceled", "error": error})
+        else:
+            job._notify()
+
+    async def _heartbeat_loop(self) -> None:
+        """续约、停止租约已丢失的任务、回收过期租约并清理旧任务"""
+        while True:
+            try:
+                await self._heartbeat_once()
+            except Exception as e:
+                print(f"生成任务续约失败: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _heartbeat_once(self) -> None:
+        now = time.time()
+        if self._running:
+            held = set(await database.renew_job_leases(self.owner, self.lease_seconds, now))
+            for job_id, job in list(self._running.items()):
+                if job_id in held or job._task is None:
+                    continue
+                # 任务被其他进程取消，或续约太晚租约已被回收
+                self.lost_leases += 1
+                self._running.pop(job_id, None)
+                job._task.cancel()
+                row = await database.fetch_job(job_id)
+                if row is not None and row[1] == JOB_CANCELED:
+                    self._mark_finished(job, JOB_CANCELED, row[5])
+                else:
+                    # 已由其他进程重新执行，订阅方改为查询数据库
+                    self._jobs.pop(job_id, None)
+                    job.detached = True
+                    job._notify()
+
+        reclaimed = await database.reclaim_expired_jobs(self.max_attempts, "任务多次执行中断", now)
+        if reclaimed:
+            self.reclaimed += len(reclaimed)
+            self._queued_estimate += sum(1 for _, status in reclaimed if status == JOB_QUEUED)
+            print(f"回收了 {len(reclaimed)} 个租约过期的生成任务")
+            self._wakeup.set()
+
+        await database.delete_finished_jobs(now - self.retention)
+        expired_before = now - self.events_retention
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < expired_before]:
+            del self._jobs[job_id]
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """队列深度、执行数和耗时统计"""
+        queued, running = await database.fetch_job_counts()
+        finished = self.succeeded + self.failed + self.canceled
+        return {
+            "owner": self.owner,
+            "workers": self.workers,
+            "queue_depth": queued,
+            "max_queue_size": self.max_queue_size,
+            "running": len(self._running),
+            "running_all_processes": running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "claimed": self.claimed,
+            "resumed": self.resumed,
+            "reclaimed": self.reclaimed,
+            "lost_leases": self.lost_leases,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "canceled": self.canceled,
+            "avg_claim_ms": round(self._total_claim_ms / self._claim_batches, 2) if self._claim_batches else 0.0,
+            "avg_wait_ms": round(self._total_wait_ms / self.claimed, 2) if self.claimed else 0.0,
+            "avg_run_ms": round(self._total_run_ms / finished, 2) if finished else 0.0
+        }
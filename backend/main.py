@@ -1,12 +1,30 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple
+from datetime import datetime
+import asyncio
+import base64
+import hashlib
 import json
-import sqlite3
+import os
 import secrets
+import time
+import database
 from doubao_api import DoubaoAPIClient, DoubaoImageRequest, validate_image_size, resize_image_for_api
+from qwen_api import AsyncQwenAPIClient, QwenImageRequest, task_poller
+from http_client import init_shared_clients, close_shared_clients
+from client_registry import ClientRegistry, PROVIDER_QWEN, config_from_row
+from coalescer import RequestCoalescer, canonical_hash
+from history_writer import HistoryWriter
+from image_store import ImageStore, image_response, is_image_hash, parse_image_handle
+from image_executor import image_executor
+from job_queue import Job, JobQueue, JobQueueFull
+from result_cache import ResultCache
+from routing import ROUTING_POLICIES, Router
+from thumbnails import ThumbnailPipeline
 
 # 创建FastAPI应用
 app = FastAPI(title="AI绘画聊天API", version="1.0.0")
@@ -29,52 +47,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 数据库初始化
-def init_database():
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    # 创建API配置表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_configs (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            url TEXT NOT NULL,
-            api_key TEXT NOT NULL,
-            headers TEXT,
-            model TEXT,
-            is_active BOOLEAN DEFAULT 0
-        )
-    ''')
-    
-    # 删除旧表并重新创建
-    cursor.execute('DROP TABLE IF EXISTS chat_history')
-    
-    # 创建聊天历史表
-    cursor.execute('''
-        CREATE TABLE chat_history (
-            id TEXT PRIMARY KEY,
-            prompt TEXT NOT NULL,
-            result_images TEXT,
-            parameters TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-# 初始化数据库
-init_database()
-
-# 数据库连接
-conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-cursor = conn.cursor()
-
 # 生成唯一ID
 def generate_id():
     return secrets.token_urlsafe(16)
 
+async def load_api_config(config_id: str) -> Optional[Dict[str, Any]]:
+    """从数据库加载单个API配置"""
+    row = await database.fetch_api_config(config_id)
+    return config_from_row(row) if row else None
+
+# API配置和客户端注册表
+client_registry = ClientRegistry(load_api_config)
+
+# 路由组：按策略在多个API配置之间分配生成请求并自动切换
+router = Router(client_registry, database.fetch_routing_groups)
+
+# 进行中的相同 /api/generate 请求共用一次提供商调用
+coalescer = RequestCoalescer()
+
+# 历史记录后台批量写入器
+history_writer = HistoryWriter()
+
+# 生成结果的本地内容寻址存储
+image_store = ImageStore()
+
+# 指定seed的 /api/generate 结果缓存
+result_cache = ResultCache(image_store)
+
+# 缩略图和占位图后台处理
+thumbnail_pipeline = ThumbnailPipeline(image_store.root)
+
+# 持久化的异步生成任务队列，每个任务按 generation_stream 执行（与 /api/generate-stream 相同的事件），
+# 重新执行已提交过Qwen任务的任务时在原配置上继续等待原任务
+job_queue = JobQueue(
+    lambda job: generation_stream(GenerationRequest(**job.request), job.provider_task_id)
+)
+
+# 流式生成长时间没有事件时发送保活注释的间隔（秒）
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+# 随应用启动的后台任务，关闭时取消
+background_tasks: set = set()
+
 # Pydantic模型
 class GenerationParameters(BaseModel):
     model: Optional[str] = None
@@ -99,14 +113,23 @@ class GenerationRequest(BaseModel):
     prompt: str
     parameters: GenerationParameters
     apiConfigId: str
-    input_images: Optional[List[str]] = []
+    input_images: Optional[List[str]] = []  # data URL，或 /api/upload 返回的图片句柄
+    # 之前生成的图片：image_ids 中的哈希，或 "历史记录ID:序号"（序号省略时为第一张）
+    input_history_images: Optional[List[str]] = []
     input_image_urls: Optional[List[str]] = []
     generation_type: Optional[str] = "text_to_image"
+    # 未指定 seed 时可设为false，不与进行中的相同请求合并（每次都重新生成）
+    coalesce: Optional[bool] = True
+
+class UploadCheckRequest(BaseModel):
+    hashes: List[str]
 
 class GenerationResponse(BaseModel):
     success: bool
     images: Optional[List[str]] = None
+    image_ids: Optional[List[Optional[str]]] = None  # 本地存储的图片哈希，未能保存时为null
     error: Optional[str] = None
+    cached: bool = False  # 指定seed的相同请求直接返回了之前保存的结果
 
 class ApiConfigRequest(BaseModel):
     name: str
@@ -115,6 +138,15 @@ class ApiConfigRequest(BaseModel):
     headers: Optional[Dict[str, str]] = None
     model: Optional[str] = None
 
+class RoutingMember(BaseModel):
+    configId: str
+    weight: Optional[float] = 1
+
+class RoutingGroupRequest(BaseModel):
+    name: str
+    policy: Optional[str] = "weighted"
+    members: List[RoutingMember]
+
 # API端点
 @app.get("/")
 async def root():
@@ -138,8 +170,7 @@ async def get_generation_types():
 @app.get("/api/configs")
 async def get_api_configs():
     """获取所有API配置"""
-    cursor.execute("SELECT * FROM api_configs")
-    rows = cursor.fetchall()
+    rows = await database.fetch_api_configs()
     
     configs = []
     for row in rows:
@@ -177,58 +208,45 @@ async def create_api_config(config: ApiConfigRequest):
     """创建新的API配置"""
     config_id = generate_id()
     
-    cursor.execute("""
-        INSERT INTO api_configs (id, name, url, api_key, headers, model, is_active)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (
+    await database.insert_api_config(
         config_id,
         config.name,
         config.url,
         config.apiKey,
-        json.dumps(config.headers) if config.headers else None,
+        config.headers,
         config.model,
         False
-    ))
-    conn.commit()
+    )
+    client_registry.invalidate(config_id)
     
     return {"id": config_id, "message": "配置创建成功"}
 
 @app.put("/api/configs/{config_id}")
 async def update_api_config(config_id: str, updates: Dict[str, Any]):
     """更新API配置"""
-    # 构建更新语句
-    update_fields = []
-    values = []
+    # 构建更新字段
+    update_fields = {}
     
     if "name" in updates:
-        update_fields.append("name = ?")
-        values.append(updates["name"])
+        update_fields["name"] = updates["name"]
     if "url" in updates:
-        update_fields.append("url = ?")
-        values.append(updates["url"])
+        update_fields["url"] = updates["url"]
     if "apiKey" in updates:
-        update_fields.append("api_key = ?")
-        values.append(updates["apiKey"])
+        update_fields["api_key"] = updates["apiKey"]
     if "headers" in updates:
-        update_fields.append("headers = ?")
-        values.append(json.dumps(updates["headers"]) if updates["headers"] else None)
+        update_fields["headers"] = json.dumps(updates["headers"]) if updates["headers"] else None
     if "model" in updates:
-        update_fields.append("model = ?")
-        values.append(updates["model"])
+        update_fields["model"] = updates["model"]
     if "isActive" in updates:
-        update_fields.append("is_active = ?")
-        values.append(updates["isActive"])
+        update_fields["is_active"] = updates["isActive"]
     
     if not update_fields:
         raise HTTPException(status_code=400, detail="没有提供更新字段")
     
-    values.append(config_id)
-    query = f"UPDATE api_configs SET {', '.join(update_fields)} WHERE id = ?"
+    rowcount = await database.update_api_config(config_id, update_fields)
+    client_registry.invalidate(config_id)
     
-    cursor.execute(query, values)
-    conn.commit()
-    
-    if cursor.rowcount == 0:
+    if rowcount == 0:
         raise HTTPException(status_code=404, detail="配置不存在")
     
     return {"message": "配置更新成功"}
@@ -236,10 +254,10 @@ async def update_api_config(config_id: str, updates: Dict[str, Any]):
 @app.delete("/api/configs/{config_id}")
 async def delete_api_config(config_id: str):
     """删除API配置"""
-    cursor.execute("DELETE FROM api_configs WHERE id = ?", (config_id,))
-    conn.commit()
+    rowcount = await database.delete_api_config(config_id)
+    client_registry.invalidate(config_id)
     
-    if cursor.rowcount == 0:
+    if rowcount == 0:
         raise HTTPException(status_code=404, detail="配置不存在")
     
     return {"message": "配置删除成功"}
@@ -258,10 +276,9 @@ async def test_api_config(config: Dict[str, Any]):
         
         if "dashscope" in api_url or "aliyuncs" in api_url:
             # 阿里Qwen API
-            from qwen_api import QwenAPIClient, QwenImageRequest
-            
-            client = QwenAPIClient(
-                api_key=config.get("apiKey", "")
+            client = AsyncQwenAPIClient(
+                api_key=config.get("apiKey", ""),
+                base_url=api_url
             )
             
             # 创建测试请求
@@ -274,7 +291,7 @@ async def test_api_config(config: Dict[str, Any]):
             
             # 测试API连接
             try:
-                result = client.text_to_image(test_request)
+                result = await client.text_to_image(test_request)
                 return {"success": True, "message": "API配置测试成功"}
             except Exception as e:
                 return {"success": False, "message": f"API配置测试失败: {str(e)}"}
@@ -299,157 +316,297 @@ async def test_api_config(config: Dict[str, Any]):
     except Exception as e:
         return {"success": False, "message": f"API配置测试失败: {str(e)}"}
 
-@app.post("/api/generate")
-async def generate_image(request: GenerationRequest):
-    """生成图片 - 支持多种生成模式"""
-    try:
-        # 获取API配置
-        cursor.execute("SELECT * FROM api_configs WHERE id = ? AND is_active = 1", (request.apiConfigId,))
-        config_row = cursor.fetchone()
+def routing_group_fields(group: RoutingGroupRequest) -> Tuple[str, List[Dict[str, Any]]]:
+    """校验路由组请求，返回策略和成员列表"""
+    policy = group.policy or "weighted"
+    if policy not in ROUTING_POLICIES:
+        raise HTTPException(status_code=400, detail=f"不支持的路由策略: {policy}")
+    if not group.members:
+        raise HTTPException(status_code=400, detail="路由组至少需要一个API配置")
+    if any(member.weight is None or member.weight <= 0 for member in group.members):
+        raise HTTPException(status_code=400, detail="路由组成员的权重必须大于0")
+    members = [{"config_id": member.configId, "weight": member.weight} for member in group.members]
+    return policy, members
+
+@app.get("/api/routing-groups")
+async def get_routing_groups():
+    """获取所有路由组"""
+    router.invalidate()
+    groups = await router.groups()
+    return {"groups": [group.to_dict() for group in groups.values()]}
+
+@app.post("/api/routing-groups")
+async def create_routing_group(group: RoutingGroupRequest):
+    """创建路由组，生成请求的 apiConfigId 可以使用返回的ID"""
+    policy, members = routing_group_fields(group)
+    group_id = generate_id()
+    await database.insert_routing_group(group_id, group.name, policy, members)
+    router.invalidate()
+    return {"id": group_id, "message": "路由组创建成功"}
+
+@app.put("/api/routing-groups/{group_id}")
+async def update_routing_group(group_id: str, group: RoutingGroupRequest):
+    """替换路由组的名称、策略和成员"""
+    policy, members = routing_group_fields(group)
+    rowcount = await database.update_routing_group(group_id, group.name, policy, members)
+    router.invalidate()
+
+    if rowcount == 0:
+        raise HTTPException(status_code=404, detail="路由组不存在")
+
+    return {"message": "路由组更新成功"}
+
+@app.delete("/api/routing-groups/{group_id}")
+async def delete_routing_group(group_id: str):
+    """删除路由组"""
+    rowcount = await database.delete_routing_group(group_id)
+    router.invalidate()
+
+    if rowcount == 0:
+        raise HTTPException(status_code=404, detail="路由组不存在")
+
+    return {"message": "路由组删除成功"}
+
+class PreparedGeneration:
+    """已解析配置和输入图片、可直接提交给提供商的生成请求"""
+    
+    def __init__(self, entry, provider_request: Any, generation_type: str, model: str):
+        self.entry = entry
+        self.provider_request = provider_request
+        self.generation_type = generation_type
+        self.model = model
+    
+    @property
+    def is_qwen(self) -> bool:
+        return self.entry.provider == PROVIDER_QWEN
+    
+    @property
+    def uses_qwen_image_edit(self) -> bool:
+        """Qwen只有提供了输入图片时才走图像编辑，否则按文生图处理"""
+        return self.generation_type == "image_to_image" and bool(self.provider_request.ref_image_url)
+
+def requested_model(entry, model: Optional[str]) -> Optional[str]:
+    """请求指定的模型属于另一个提供商时忽略（路由组切换提供商后使用该配置的默认模型）"""
+    if not model:
+        return None
+    is_qwen_model = model.startswith(("wanx", "qwen"))
+    return model if is_qwen_model == (entry.provider == PROVIDER_QWEN) else None
+
+def resolved_model(request: GenerationRequest, entry) -> str:
+    """配置实际使用的模型：配置指定的模型，其次为请求指定的同一提供商的模型，最后为提供商的默认模型"""
+    model = entry.model or requested_model(entry, request.parameters.model)
+    if model:
+        return model
+    return "wanx-v1" if entry.provider == PROVIDER_QWEN else "doubao-seedream-4-0-250828"
+
+async def route_generation(request: GenerationRequest) -> List[Any]:
+    """按尝试顺序排列的注册项：apiConfigId 为单个配置或路由组"""
+    generation_type = request.generation_type or "text_to_image"
+    entries = await router.candidates(request.apiConfigId, generation_type)
+    if not entries:
+        raise HTTPException(status_code=404, detail="API配置不存在或未激活")
+    return entries
+
+async def prepare_generation(request: GenerationRequest, entry) -> PreparedGeneration:
+    """解析输入图片并构建指定配置的提供商请求（尺寸按提供商的格式拼接）"""
+    # 获取模型
+    model = resolved_model(request, entry)
+    generation_type = request.generation_type or "text_to_image"
+    
+    if entry.provider == PROVIDER_QWEN:
+        # 阿里Qwen API（异步提交任务，由共享轮询器等待结果，不阻塞事件循环）
         
-        if not config_row:
-            raise HTTPException(status_code=404, detail="API配置不存在或未激活")
+        # 构建尺寸字符串 (Qwen使用 * 分隔符)
+        size = f"{request.parameters.width}*{request.parameters.height}"
+        if not validate_image_size(size.replace('*', 'x')):  # 验证时转换为标准格式
+            size = "1024*1024"  # 默认尺寸
         
-        # 根据URL判断API类型
-        api_url = config_row[2]  # url
-        api_key = config_row[3]  # api_key
+        # 构建请求
+        qwen_request = QwenImageRequest(
+            model=model,
+            prompt=request.prompt,
+            negative_prompt=request.parameters.negative_prompt,
+            size=size,
+            n=request.parameters.batch_size or 1,
+            steps=request.parameters.steps,
+            cfg_scale=request.parameters.cfg_scale,
+            seed=request.parameters.seed
+        )
         
-        # 获取模型
-        model = config_row[5] or request.parameters.model
+        # 处理输入图像 (图生图)
+        if request.input_history_images:
+            # Qwen只支持单张图片，只解析用到的第一张
+            qwen_request.ref_image_url = await resolve_history_image(request.input_history_images[0])
+        elif request.input_images:
+            qwen_request.ref_image_url = (await resolve_input_images(request.input_images[:1]))[0]
+        elif request.input_image_urls:
+            qwen_request.ref_image_url = request.input_image_urls[0]
         
-        if "dashscope" in api_url or "aliyuncs" in api_url:
-            # 阿里Qwen API
-            from qwen_api import QwenAPIClient, QwenImageRequest
-            
-            # 创建API客户端
-            client = QwenAPIClient(api_key=api_key)
-            
-            # 构建尺寸字符串 (Qwen使用 * 分隔符)
-            size = f"{request.parameters.width}*{request.parameters.height}"
-            if not validate_image_size(size.replace('*', 'x')):  # 验证时转换为标准格式
-                size = "1024*1024"  # 默认尺寸
-            
-            # 构建请求
-            qwen_request = QwenImageRequest(
-                model=model or "wanx-v1",
-                prompt=request.prompt,
-                negative_prompt=request.parameters.negative_prompt,
-                size=size,
-                n=request.parameters.batch_size or 1,
-                steps=request.parameters.steps,
-                cfg_scale=request.parameters.cfg_scale,
-                seed=request.parameters.seed
-            )
-            
-            # 处理输入图像 (图生图)
-            if request.input_images:
-                qwen_request.image = request.input_images[0]  # Qwen只支持单张图片
-            elif request.input_image_urls:
-                # 如果提供了URL，需要先下载图片并转换为base64
-                qwen_request.image_url = request.input_image_urls[0] if request.input_image_urls else None
-            
-            # 根据生成类型调用不同的API
-            generation_type = request.generation_type or "text_to_image"
-            
-            if generation_type == "text_to_image":
-                result = client.text_to_image(qwen_request)
-            elif generation_type == "image_to_image":
-                result = client.image_to_image(qwen_request)
-            else:
-                # 默认使用文生图
-                result = client.text_to_image(qwen_request)
-                
-        else:
-            # 默认使用豆包API
-            client = DoubaoAPIClient(
-                api_key=api_key,
-                base_url=api_url
-            )
-            
-            # 构建尺寸字符串
-            size = f"{request.parameters.width}x{request.parameters.height}"
-            if not validate_image_size(size):
-                size = "1024x1024"  # 默认尺寸
-            
-            doubao_request = DoubaoImageRequest(
-                model=model or "doubao-seedream-4-0-250828",
-                prompt=request.prompt,
-                negative_prompt=request.parameters.negative_prompt,
-                size=size,
-                n=request.parameters.batch_size or 1,
-                quality=request.parameters.quality or "standard",
-                style=request.parameters.style,
-                seed=request.parameters.seed,
-                steps=request.parameters.steps,
-                cfg_scale=request.parameters.cfg_scale,
-                strength=request.parameters.strength,
-                response_format="url",
-                watermark=request.parameters.watermark
+        return PreparedGeneration(entry, qwen_request, generation_type, qwen_request.model)
+    
+    # 默认使用豆包API（复用按base_url共享的长连接客户端）
+    # 构建尺寸字符串
+    size = f"{request.parameters.width}x{request.parameters.height}"
+    if not validate_image_size(size):
+        size = "1024x1024"  # 默认尺寸
+    
+    doubao_request = DoubaoImageRequest(
+        model=model,
+        prompt=request.prompt,
+        negative_prompt=request.parameters.negative_prompt,
+        size=size,
+        n=request.parameters.batch_size or 1,
+        quality=request.parameters.quality or "standard",
+        style=request.parameters.style,
+        seed=request.parameters.seed,
+        steps=request.parameters.steps,
+        cfg_scale=request.parameters.cfg_scale,
+        strength=request.parameters.strength,
+        response_format="url",
+        watermark=request.parameters.watermark
+    )
+    
+    # 处理输入图像
+    if request.input_images or request.input_history_images:
+        # 历史图片在前，其后为本次上传的图片
+        input_images = await asyncio.gather(
+            *(resolve_history_image(reference) for reference in request.input_history_images or [])
+        )
+        input_images = list(input_images) + await resolve_input_images(request.input_images)
+        doubao_request.images = input_images
+        if len(input_images) == 1:
+            doubao_request.image = input_images[0]
+    elif request.input_image_urls:
+        doubao_request.image_url = request.input_image_urls[0] if request.input_image_urls else None
+    
+    return PreparedGeneration(entry, doubao_request, generation_type, doubao_request.model)
+
+async def call_provider(prepared: PreparedGeneration) -> Dict[str, Any]:
+    """按生成类型调用提供商，返回完整结果"""
+    client = prepared.entry.client
+    if prepared.is_qwen:
+        if prepared.uses_qwen_image_edit:
+            return await client.image_to_image(prepared.provider_request)
+        return await client.text_to_image(prepared.provider_request)
+    return await client.generate(prepared.provider_request, prepared.generation_type)
+
+def result_items(result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """从豆包（data）或Qwen（output.results）的响应中取出图片"""
+    items = []
+    if "data" in result:
+        items = result["data"]
+    elif "output" in result:
+        # 处理Qwen API响应格式
+        items = result["output"].get("results", [])
+    return [item for item in items if "url" in item or "b64_json" in item]
+
+async def record_generation(request: GenerationRequest, prepared: PreparedGeneration,
+                            stored_images: List[Dict[str, Optional[str]]], latency_ms: int) -> None:
+    """提交缩略图处理并写入历史记录"""
+    for image in stored_images:
+        if image["hash"]:
+            thumbnail_pipeline.submit(image["hash"])
+    
+    # 记录实际使用的模型和生成类型，供历史记录筛选
+    parameters = request.parameters.dict()
+    parameters["model"] = prepared.model
+    parameters["generation_type"] = prepared.generation_type
+    
+    # 保存到历史记录（后台批量写入，不等待提交）
+    await history_writer.write({
+        "id": generate_id(),
+        "prompt": request.prompt,
+        "images": stored_images,
+        "parameters": parameters,
+        "provider": prepared.entry.provider,
+        "api_config_id": prepared.entry.config["id"],
+        "latency_ms": latency_ms
+    })
+
+async def generation_key(request: GenerationRequest) -> str:
+    """
+    请求的规范化哈希：提示词、参数（含模型）、配置ID和输入图片
+
+    输入图片按内容哈希：句柄、/api/images 地址、历史图片引用和data URL指向同一张图片时键相同；
+    历史图片在前，与 prepare_generation 的顺序一致
+    """
+    payload = request.dict(exclude={"coalesce", "input_images", "input_history_images"})
+    hashes = await asyncio.gather(
+        *(history_image_hash(reference) for reference in request.input_history_images or [])
+    )
+    payload["input_images"] = list(hashes) + [input_image_hash(value) for value in request.input_images or []]
+    return canonical_hash(payload)
+
+def result_cache_key(key: str, request: GenerationRequest, entry) -> str:
+    """
+    结果缓存的键：请求键加上实际执行的配置、提供商和模型
+
+    修改配置的模型或路由组切换到其他配置后不会命中之前的结果
+    """
+    return canonical_hash({
+        "request": key,
+        "api_config_id": entry.config["id"],
+        "provider": entry.provider,
+        "model": resolved_model(request, entry)
+    })
+
+async def cached_generation(request: GenerationRequest, key: str) -> Optional[List[Dict[str, Optional[str]]]]:
+    """查找本次路由首先尝试的配置缓存的结果（路由组中其他配置的结果不返回）"""
+    entry = (await route_generation(request))[0]
+    return await result_cache.get(result_cache_key(key, request, entry))
+
+async def run_generation(request: GenerationRequest,
+                         cache_key: Optional[str] = None) -> List[Dict[str, Optional[str]]]:
+    """
+    调用提供商（路由组失败时切换配置），保存图片并写入历史记录，返回存储结果；
+    指定 cache_key（请求键）时按实际执行的配置写入结果缓存
+    """
+    entries = await route_generation(request)
+    for position, entry in enumerate(entries):
+        prepared = await prepare_generation(request, entry)
+        try:
+            started = time.perf_counter()
+            with router.track(entry):
+                result = await call_provider(prepared)
+            latency_ms = int((time.perf_counter() - started) * 1000)
+            break
+        except Exception as e:
+            if position == len(entries) - 1:
+                raise
+            router.record_failover(entry, e)
+    
+    # 保存到本地图片存储，提供商URL会过期，base64也不再写入历史和响应
+    stored_images = await image_store.save_results(result_items(result))
+    await record_generation(request, prepared, stored_images, latency_ms)
+    if cache_key:
+        await result_cache.put(result_cache_key(cache_key, request, prepared.entry), stored_images)
+    return stored_images
+
+@app.post("/api/generate")
+async def generate_image(request: GenerationRequest, http_request: Request):
+    """
+    生成图片 - 支持多种生成模式
+    
+    进行中的相同请求（见 generation_key）共用一次提供商调用和同一条历史记录，
+    未指定 seed 且 coalesce 为false的请求除外；指定 seed 的请求先查结果缓存，命中时 cached 为true
+    """
+    try:
+        seeded = request.parameters.seed is not None
+        key = await generation_key(request)
+        stored_images = await cached_generation(request, key) if seeded else None
+        cached = stored_images is not None
+        if not cached and (request.coalesce or seeded):
+            stored_images = await coalescer.run(
+                key, lambda: run_generation(request, key if seeded else None)
             )
-            
-            # 处理输入图像
-            if request.input_images:
-                doubao_request.images = request.input_images
-                if len(request.input_images) == 1:
-                    doubao_request.image = request.input_images[0]
-            elif request.input_image_urls:
-                doubao_request.image_url = request.input_image_urls[0] if request.input_image_urls else None
-            
-            # 根据生成类型调用不同的API
-            generation_type = request.generation_type or "text_to_image"
-            
-            if generation_type == "text_to_image":
-                result = await client.text_to_image(doubao_request)
-            elif generation_type == "image_to_image":
-                result = await client.image_to_image(doubao_request)
-            elif generation_type == "multi_image_fusion":
-                result = await client.multi_image_fusion(doubao_request)
-            elif generation_type == "batch_generation":
-                result = await client.batch_generation(doubao_request)
-            elif generation_type == "text_to_batch":
-                result = await client.text_to_batch(doubao_request)
-            elif generation_type == "image_to_batch":
-                result = await client.image_to_batch(doubao_request)
-            elif generation_type == "multi_reference_batch":
-                result = await client.multi_reference_batch(doubao_request)
-            else:
-                result = await client.text_to_image(doubao_request)
-        
-        # 解析响应
-        images = []
-        if "data" in result:
-            for item in result["data"]:
-                if "url" in item:
-                    images.append(item["url"])
-                elif "b64_json" in item:
-                    # 如果返回base64，可以选择保存或转换为URL
-                    images.append(f"data:image/png;base64,{item['b64_json']}")
-        elif "output" in result:
-            # 处理Qwen API响应格式
-            output = result["output"]
-            if "results" in output:
-                for item in output["results"]:
-                    if "url" in item:
-                        images.append(item["url"])
-                    elif "b64_json" in item:
-                        images.append(f"data:image/png;base64,{item['b64_json']}")
-        
-        # 保存到历史记录
-        history_id = generate_id()
-        cursor.execute('''
-            INSERT INTO chat_history (id, prompt, result_images, parameters, timestamp)
-            VALUES (?, ?, ?, ?, datetime('now'))
-        ''', (
-            history_id,
-            request.prompt,
-            json.dumps(images),
-            json.dumps(request.parameters.dict())
-        ))
-        conn.commit()
+        elif not cached:
+            stored_images = await run_generation(request)
         
         return GenerationResponse(
             success=True,
-            images=images
+            images=[image_url(http_request, image) for image in stored_images],
+            image_ids=[image["hash"] for image in stored_images],
+            cached=cached
         )
         
     except Exception as e:
@@ -458,107 +615,654 @@ async def generate_image(request: GenerationRequest):
             error=str(e)
         )
 
+async def generation_events(request: GenerationRequest, prepared: PreparedGeneration,
+                            provider_task_id: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    调用提供商的流式接口，逐个产出生成事件，结束后写入历史记录
+    
+    豆包转发 stream_generation 的事件，每张图片完成时立即保存并产出；
+    Qwen产出任务ID和任务状态变化，任务成功后逐张保存并产出，
+    指定 provider_task_id 时不再提交，直接继续等待该任务。
+    图片事件为 {"type": "image", "index", "stored": {"hash", "url"}}
+    """
+    client = prepared.entry.client
+    started = time.perf_counter()
+    stored_images: List[Dict[str, Optional[str]]] = []
+    
+    if prepared.is_qwen:
+        if provider_task_id:
+            task_id = provider_task_id
+        elif prepared.uses_qwen_image_edit:
+            task_id = await client.submit_image_to_image(prepared.provider_request)
+        else:
+            task_id = await client.submit_text_to_image(prepared.provider_request)
+        yield {"type": "task", "task_id": task_id}
+        
+        last_status = None
+        async for result in client.watch_task(task_id):
+            output = result.get("output", {})
+            status = output.get("task_status")
+            if status == "SUCCEEDED":
+                for item in result_items(result):
+                    stored = await image_store.save_result(item)
+                    yield {"type": "image", "index": len(stored_images), "stored": stored}
+                    stored_images.append(stored)
+            elif (status, output.get("task_metrics")) != last_status:
+                last_status = (status, output.get("task_metrics"))
+                yield {"type": "status", "status": status, "metrics": output.get("task_metrics")}
+    else:
+        async for event in client.stream_generation(prepared.provider_request, prepared.generation_type):
+            event_type = event.get("type")
+            if event.get("error") and event_type != "image_generation.partial_failed":
+                raise Exception(f"API调用失败: {event['error'].get('message') or event['error']}")
+            if event_type == "image_generation.partial_succeeded":
+                if "url" not in event and "b64_json" not in event:
+                    continue
+                stored = await image_store.save_result(event)
+                yield {"type": "image", "index": event.get("image_index", len(stored_images)),
+                       "stored": stored}
+                stored_images.append(stored)
+            elif event_type == "image_generation.partial_failed":
+                error = event.get("error") or {}
+                yield {"type": "image_error", "index": event.get("image_index"),
+                       "error": error.get("message") or str(error)}
+    
+    latency_ms = int((time.perf_counter() - started) * 1000)
+    await record_generation(request, prepared, stored_images, latency_ms)
+    yield {"type": "complete", "stored": stored_images, "latency_ms": latency_ms}
+
+async def generation_stream(request: GenerationRequest,
+                            resume: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    准备请求后产出 start 事件和全部生成事件（/api/generate-stream 和任务队列共用）
+    
+    apiConfigId 为路由组时依次尝试组内的配置：还没有产出任务或图片时失败则产出 failover 事件，
+    换下一个配置重新产出 start 事件；已提交的任务可能仍会完成，不再切换。
+    resume 为 task 事件中的 "配置ID/任务ID" 时在该配置上继续等待原任务
+    """
+    if resume:
+        config_id, _, provider_task_id = resume.rpartition("/")
+        entries = await route_generation(request.copy(update={"apiConfigId": config_id})
+                                         if config_id else request)
+        entries = entries[:1]
+    else:
+        provider_task_id = None
+        entries = await route_generation(request)
+    
+    for position, entry in enumerate(entries):
+        prepared = await prepare_generation(request, entry)
+        yield {
+            "type": "start",
+            "provider": prepared.entry.provider,
+            "model": prepared.model,
+            "generation_type": prepared.generation_type
+        }
+        submitted = False
+        try:
+            with router.track(entry) as tracking:
+                async for event in generation_events(request, prepared, provider_task_id):
+                    if event["type"] == "task":
+                        submitted = True
+                        event["resume"] = f"{entry.config['id']}/{event['task_id']}"
+                    elif event["type"] == "image":
+                        submitted = True
+                    # 等待调用方读取事件的时间不计入配置的耗时和进行中的请求数
+                    with tracking.paused():
+                        yield event
+            return
+        except Exception as e:
+            if submitted or position == len(entries) - 1:
+                raise
+            router.record_failover(entry, e)
+            yield {"type": "failover", "config": entry.config["name"], "error": error_message(e)}
+
+def error_message(error: Exception) -> str:
+    message = error.detail if isinstance(error, HTTPException) else str(error)
+    return message or "生成失败"
+
+def public_event(http_request: Request, event: Dict[str, Any]) -> Dict[str, Any]:
+    """把内部事件中的存储结果换成图片地址和哈希（返回新的字典，任务事件会被多次读取）"""
+    event = dict(event)
+    event.pop("resume", None)
+    if event["type"] == "image":
+        stored = event.pop("stored")
+        event["image"] = image_url(http_request, stored)
+        event["image_id"] = stored["hash"]
+    elif event["type"] == "complete":
+        stored_images = event.pop("stored")
+        event["images"] = [image_url(http_request, image) for image in stored_images]
+        event["image_ids"] = [image["hash"] for image in stored_images]
+    return event
+
+def format_sse(event: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    data = f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    return data if event_id is None else f"id: {event_id}\n{data}"
+
+def sse_response(chunks: AsyncIterator[str]) -> StreamingResponse:
+    """text/event-stream 响应，长时间没有数据时发送注释行保持连接，客户端断开时停止读取 chunks"""
+    
+    async def pump(queue: asyncio.Queue) -> None:
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+        except Exception as e:
+            print(f"事件流出错: {e}")
+        await queue.put(None)
+    
+    async def stream():
+        # 队列容量很小：客户端读取慢时生产方等待
+        queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+        producer = asyncio.create_task(pump(queue))
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/generate-stream")
-async def generate_image_stream(request: Dict[str, Any]):
-    """流式生成图片"""
-    from fastapi.responses import StreamingResponse
-    import asyncio
+async def generate_image_stream(request: GenerationRequest, http_request: Request):
+    """
+    流式生成图片（text/event-stream），请求体与 /api/generate 相同
+    
+    每个事件为一行 data: JSON，type 依次为 start、task/status（Qwen）、image、image_error、
+    complete 或 error；apiConfigId 为路由组时，切换配置前还有 failover 事件；客户端断开时停止生成
+    """
     
-    async def generate():
+    async def events():
         try:
-            # 发送开始信号
-            yield f"data: {json.dumps({'type': 'start', 'message': '开始生成图片'})}\n\n"
-            
-            # 模拟进度更新
-            for progress in [10, 25, 50, 75, 90]:
-                await asyncio.sleep(0.5)
-                yield f"data: {json.dumps({'type': 'progress', 'progress': progress})}\n\n"
-            
-            # 转换为标准请求格式
-            gen_request = GenerationRequest(
-                prompt=request.get("prompt", ""),
-                parameters=GenerationParameters(**request.get("parameters", {})),
-                apiConfigId=request.get("apiConfigId", ""),
-                input_images=request.get("parameters", {}).get("input_images", []),
-                generation_type=request.get("parameters", {}).get("generation_type", "text_to_image")
-            )
-            
-            # 调用普通生成API
-            result = await generate_image(gen_request)
-            
-            if result.success:
-                for image in result.images or []:
-                    yield f"data: {json.dumps({'type': 'image', 'image': image})}\n\n"
-                
-                yield f"data: {json.dumps({'type': 'complete', 'message': '生成完成'})}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'error', 'error': result.error or '生成失败'})}\n\n"
-                
+            async for event in generation_stream(request):
+                yield format_sse(public_event(http_request, event))
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+            yield format_sse({"type": "error", "error": error_message(e)})
     
-    return StreamingResponse(generate(), media_type="text/plain")
+    return sse_response(events())
 
-@app.get("/api/chat-history")
-async def get_chat_history_alt():
-    """获取聊天历史 - 备用路径"""
-    return await get_chat_history()
+def job_view(http_request: Request, job: Job) -> Dict[str, Any]:
+    """任务状态，成功后包含图片地址和哈希"""
+    view = {
+        "id": job.id,
+        "status": job.status,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "attempts": job.attempts,
+        "events": len(job.events),
+        "status_url": str(http_request.url_for("get_job", job_id=job.id)),
+        "events_url": str(http_request.url_for("get_job_events", job_id=job.id))
+    }
+    if job.result is not None:
+        result = public_event(http_request, job.result)
+        view.update({
+            "images": result["images"],
+            "image_ids": result["image_ids"],
+            "latency_ms": result["latency_ms"]
+        })
+    return view
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(request: GenerationRequest, http_request: Request):
+    """提交生成任务，立即返回任务ID；结果与客户端连接无关，完成后同样写入历史记录"""
+    try:
+        job = await job_queue.submit(request.dict())
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return job_view(http_request, job)
+
+@app.get("/api/jobs")
+async def list_jobs(http_request: Request, limit: int = Query(50, ge=1, le=200)):
+    """最近的生成任务"""
+    return {"jobs": [job_view(http_request, job) for job in await job_queue.recent(limit)]}
 
+@app.get("/api/jobs/{job_id}", name="get_job")
+async def get_job(job_id: str, http_request: Request):
+    """查询任务状态和结果"""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job_view(http_request, job)
+
+@app.get("/api/jobs/{job_id}/events", name="get_job_events")
+async def get_job_events(job_id: str, http_request: Request, after: Optional[int] = Query(None, ge=-1)):
+    """
+    订阅任务事件（text/event-stream），先补发已有事件，任务结束后关闭
+    
+    每个事件带序号 id，断线重连时通过 Last-Event-ID 请求头或 after 参数从下一个事件继续
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    last_event_id = http_request.headers.get("last-event-id")
+    if after is None and last_event_id and last_event_id.isdigit():
+        after = int(last_event_id)
+    
+    async def events():
+        async for position, event in job_queue.subscribe(job, after + 1 if after is not None else 0):
+            yield format_sse(public_event(http_request, event), position)
+    
+    return sse_response(events())
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str, http_request: Request):
+    """取消排队中或执行中的任务"""
+    job = await job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job_view(http_request, job)
+
+def encode_history_cursor(timestamp: str, history_id: str) -> str:
+    """将分页位置编码为不透明的游标"""
+    raw = json.dumps([timestamp, history_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_history_cursor(cursor: str) -> Tuple[str, str]:
+    """解析游标，格式错误时返回400"""
+    try:
+        timestamp, history_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(timestamp), str(history_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+def parse_history_time(value: Optional[str], end_of_day: bool = False) -> Optional[str]:
+    """解析日期筛选条件，转换为与timestamp列相同的格式"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"无效的日期: {value}")
+    if end_of_day and len(value) == 10:
+        # 只有日期时包含当天全部记录
+        parsed = parsed.replace(hour=23, minute=59, second=59)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+def image_url(http_request: Request, image: Dict[str, Optional[str]]) -> str:
+    """本地存储的图片返回 /api/images/{hash} 的地址，未保存的返回原始URL"""
+    if image["hash"]:
+        return str(http_request.url_for("get_image", image_hash=image["hash"]))
+    return image["url"]
+
+def history_images(value: Optional[str]) -> List[Dict[str, Any]]:
+    """解析数据库返回的 [image_hash, url, width, height, placeholder, thumbnails] 数组"""
+    if not value:
+        return []
+    rows = json.loads(value)
+    if rows and not isinstance(rows[0], list):
+        # 单张图片（缩略图列）
+        rows = [rows]
+    return [
+        {"hash": image_hash, "url": url, "width": width, "height": height,
+         "placeholder": placeholder, "thumbnails": thumbnails or {}}
+        for image_hash, url, width, height, placeholder, thumbnails in rows
+    ]
+
+def image_layout(http_request: Request, image: Dict[str, Any]) -> Dict[str, Any]:
+    """图片的布局元数据：宽高、占位图和各尺寸WebP缩略图地址，缩略图未生成时只有原图地址"""
+    return {
+        "id": image["hash"],
+        "url": image_url(http_request, image),
+        "width": image["width"],
+        "height": image["height"],
+        "placeholder": image["placeholder"],
+        "thumbnails": {
+            size: str(http_request.url_for("get_image", image_hash=thumbnail_hash))
+            for size, thumbnail_hash in image["thumbnails"].items()
+        }
+    }
+
+def preview_url(layout: Dict[str, Any]) -> str:
+    """列表预览使用最小的缩略图"""
+    if layout["thumbnails"]:
+        return layout["thumbnails"][min(layout["thumbnails"], key=int)]
+    return layout["url"]
+
+def build_history_filters(model: Optional[str], generation_type: Optional[str],
+                          provider: Optional[str], size: Optional[str],
+                          since: Optional[str], until: Optional[str]) -> Dict[str, Any]:
+    """将查询参数转换为历史记录筛选条件"""
+    filters: Dict[str, Any] = {
+        "model": model,
+        "generation_type": generation_type,
+        "provider": provider,
+        "since": parse_history_time(since),
+        "until": parse_history_time(until, end_of_day=True)
+    }
+    if size:
+        try:
+            width, height = map(int, size.replace('*', 'x').split('x'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"无效的尺寸: {size}")
+        filters["width"] = width
+        filters["height"] = height
+    return filters
+
+@app.get("/api/chat-history")
 @app.get("/api/history")
-async def get_chat_history():
-    """获取聊天历史"""
-    cursor.execute("SELECT * FROM chat_history ORDER BY timestamp DESC LIMIT 50")
-    rows = cursor.fetchall()
+async def get_chat_history(
+    http_request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    model: Optional[str] = None,
+    generation_type: Optional[str] = None,
+    provider: Optional[str] = None,
+    size: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    view: str = "full",
+    offset: Optional[int] = None
+):
+    """获取聊天历史 - 按时间倒序游标分页，支持按模型、生成类型、提供商、尺寸和日期筛选"""
+    if offset:
+        # 旧版按偏移分页的请求，忽略 offset 会一直返回第一页
+        raise HTTPException(status_code=400, detail="历史记录已改为游标分页，下一页请传入上一页返回的 next_cursor 作为 cursor")
+    filters = build_history_filters(model, generation_type, provider, size, since, until)
+    
+    summary = view == "summary"
+    rows = await database.fetch_history(
+        limit=limit,
+        cursor=decode_history_cursor(cursor) if cursor else None,
+        filters=filters,
+        summary=summary
+    )
     
     history = []
     for row in rows:
-        item = {
+        if summary:
+            thumbnail = history_images(row[3])
+            preview = image_layout(http_request, thumbnail[0]) if thumbnail else None
+            item = {
+                "id": row[0],
+                "prompt": row[1],
+                "timestamp": row[2],
+                "thumbnail": preview_url(preview) if preview else None,
+                "preview": preview
+            }
+        else:
+            layouts = [image_layout(http_request, image) for image in history_images(row[2])]
+            item = {
+                "id": row[0],
+                "prompt": row[1],
+                "images": [layout["url"] for layout in layouts],
+                "image_ids": [layout["id"] for layout in layouts],
+                "image_details": layouts,
+                "parameters": json.loads(row[3]) if row[3] else {},
+                "timestamp": row[4]
+            }
+        history.append(item)
+    
+    # 不足一页说明已经到底
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_history_cursor(history[-1]["timestamp"], history[-1]["id"])
+    
+    return {"history": history, "next_cursor": next_cursor}
+
+@app.get("/api/history/stats")
+async def get_history_stats(
+    group_by: str = "model",
+    model: Optional[str] = None,
+    generation_type: Optional[str] = None,
+    provider: Optional[str] = None,
+    size: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None
+):
+    """生成记录统计 - 按模型、提供商、生成类型、尺寸或日期汇总次数、图片数和平均耗时"""
+    if group_by not in database.HISTORY_STATS_GROUPS:
+        raise HTTPException(status_code=400, detail=f"不支持的统计维度: {group_by}")
+    
+    filters = build_history_filters(model, generation_type, provider, size, since, until)
+    rows = await database.fetch_history_stats(group_by, filters)
+    
+    return {
+        "group_by": group_by,
+        "stats": [
+            {
+                "key": row[0],
+                "generations": row[1],
+                "images": row[2] or 0,
+                "avg_latency_ms": round(row[3], 1) if row[3] is not None else None
+            }
+            for row in rows
+        ]
+    }
+
+def build_fts_query(q: str) -> str:
+    """将用户输入转换为FTS5 MATCH表达式：每个词作为短语，多个词同时匹配"""
+    # trigram分词至少需要3个字符才能命中索引
+    terms = [term for term in q.split() if len(term) >= 3]
+    if not terms:
+        raise HTTPException(status_code=400, detail="搜索词至少需要3个字符")
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+@app.get("/api/history/search")
+async def search_chat_history(
+    http_request: Request,
+    q: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None
+):
+    """全文检索历史提示词 - 按相关度排序，匹配片段用 <mark> 标出"""
+    search_cursor = None
+    if cursor:
+        rank, rowid = decode_history_cursor(cursor)
+        try:
+            search_cursor = (float(rank), int(rowid))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+    
+    rows = await database.search_history(build_fts_query(q), limit=limit, cursor=search_cursor)
+    
+    results = []
+    for row in rows:
+        thumbnail = history_images(row[3])
+        preview = image_layout(http_request, thumbnail[0]) if thumbnail else None
+        results.append({
             "id": row[0],
             "prompt": row[1],
-            "images": json.loads(row[2]) if row[2] else [],
-            "parameters": json.loads(row[3]) if row[3] else {},
-            "timestamp": row[4]
-        }
-        history.append(item)
+            "timestamp": row[2],
+            "thumbnail": preview_url(preview) if preview else None,
+            "preview": preview,
+            "highlight": {
+                "prompt": row[4],
+                "negative_prompt": row[5]
+            },
+            "score": -row[6]
+        })
+    
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_history_cursor(repr(rows[-1][6]), str(rows[-1][7]))
     
-    return {"history": history}
+    return {"results": results, "next_cursor": next_cursor}
+
+@app.api_route("/api/images/{image_hash}", methods=["GET", "HEAD"], name="get_image")
+async def get_image(image_hash: str, http_request: Request):
+    """获取本地存储的图片 - 内容不变，使用强ETag和永久缓存，支持Range请求"""
+    if not is_image_hash(image_hash):
+        raise HTTPException(status_code=404, detail="图片不存在")
+    try:
+        return await image_response(image_store, image_hash, http_request.headers, http_request.method)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="图片不存在")
+
+@app.get("/api/status")
+async def get_status():
+    """获取系统状态"""
+    return {
+        "status": "running",
+        "client_registry": client_registry.get_stats(),
+        "rate_limits": client_registry.get_rate_limit_stats(),
+        "retries": client_registry.get_retry_stats(),
+        "routing": router.get_stats(),
+        "coalescing": coalescer.get_stats(),
+        "result_cache": await result_cache.get_stats(),
+        "history_writer": history_writer.get_stats(),
+        "image_executor": image_executor.get_stats(),
+        "thumbnails": thumbnail_pipeline.get_stats(),
+        "jobs": await job_queue.get_stats(),
+        "input_image_cache": image_store.input_cache.get_stats(),
+        "qwen_pending_tasks": task_poller.pending_count
+    }
+
+# 上传文件逐块写入图片存储的块大小
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 @app.post("/api/upload")
-async def upload_image(file: UploadFile = File(...)):
-    """上传图片"""
-    if not file.content_type or not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="文件必须是图片格式")
+@app.post("/api/upload-image")
+async def upload_image(http_request: Request, file: UploadFile = File(...)):
+    """
+    上传图片 - 逐块写入内容寻址存储，返回图片句柄（哈希），生成时在 input_images 中引用
     
+    按文件内容（Pillow能识别的格式）而不是声明的Content-Type判断是否为图片
+    """
+    writer = image_store.writer()
     try:
-        # 读取文件内容
-        content = await file.read()
-        
-        # 转换为base64
-        import base64
-        base64_image = base64.b64encode(content).decode('utf-8')
-        data_url = f"data:{file.content_type};base64,{base64_image}"
-        
-        return {"success": True, "image": data_url}
-        
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        while chunk:
+            await writer.write(chunk)
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        media_type = await writer.verify()
+        image_hash = await writer.commit()
+    except ValueError as e:
+        # 超过大小限制或无法识别的图片格式
+        await writer.abort()
+        print(f"拒绝上传的文件 {file.filename}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        await writer.abort()
         raise HTTPException(status_code=500, detail=f"上传失败: {str(e)}")
+    
+    url = str(http_request.url_for("get_image", image_hash=image_hash))
+    return {
+        "success": True,
+        "id": image_hash,
+        "image": url,  # 可直接用于预览，也可作为 input_images 的值
+        "size": writer.size,
+        "media_type": media_type,
+        "duplicate": writer.duplicate
+    }
+
+@app.post("/api/upload/check")
+async def check_uploads(request: UploadCheckRequest):
+    """按SHA-256检查图片是否已上传，已存在的无需重复上传，直接使用哈希作为句柄"""
+    existing = [image_hash for image_hash in request.hashes if image_store.exists(image_hash)]
+    return {
+        "existing": existing,
+        "missing": [image_hash for image_hash in request.hashes if image_hash not in existing]
+    }
+
+async def history_image_hash(reference: str) -> str:
+    """将历史图片引用解析为图片存储的哈希，本地没有的图片先下载到图片存储"""
+    image_hash = parse_image_handle(reference)
+    if image_hash is None:
+        history_id, _, position = reference.partition(":")
+        try:
+            row = await database.fetch_generation_image(history_id, int(position or 0))
+        except ValueError:
+            row = None
+        if row is None:
+            raise ValueError(f"历史图片不存在: {reference}")
+        image_hash, url = row
+        if image_hash is None or not image_store.exists(image_hash):
+            # 旧记录或保存失败的图片只有原始地址
+            image_hash = await image_store.fetch_url(url)
+    elif not image_store.exists(image_hash):
+        raise ValueError(f"历史图片不存在: {reference}")
+    return image_hash
+
+async def resolve_history_image(reference: str) -> str:
+    """将历史图片引用解析为data URL"""
+    return await image_store.read_data_url(await history_image_hash(reference))
+
+def input_image_hash(value: str) -> str:
+    """输入图片的内容哈希（与图片存储的哈希一致），句柄取存储中的哈希，data URL解码后计算，其他值原样返回"""
+    image_hash = parse_image_handle(value)
+    if image_hash is not None:
+        if not image_store.exists(image_hash):
+            raise ValueError(f"输入图片不存在: {image_hash}")
+        return image_hash
+    if value.startswith("data:"):
+        try:
+            data = base64.b64decode(value.split(",", 1)[1])
+        except (IndexError, ValueError):
+            data = value.encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+    return value
+
+async def resolve_input_images(values: Optional[List[str]]) -> List[str]:
+    """将图片句柄解析为提供商可用的data URL，其他值原样传递"""
+    resolved = []
+    for value in values or []:
+        image_hash = parse_image_handle(value)
+        if image_hash is None:
+            resolved.append(value)
+        elif image_store.exists(image_hash):
+            resolved.append(await image_store.read_data_url(image_hash))
+        else:
+            raise ValueError(f"输入图片不存在: {image_hash}")
+    return resolved
 
 def load_additional_endpoints():
     """加载额外的端点"""
     try:
-        # 尝试导入额外端点，如果不存在就跳过
-        pass  # 暂时禁用额外端点加载
+        from additional_endpoints import add_advanced_endpoints
+        add_advanced_endpoints(app, client_registry)
     except Exception as e:
         print(f"❌ 加载额外端点时出错：{e}")
 
 # 在应用启动时加载
 @app.on_event("startup")
 async def startup_event():
+    await database.init_database()
+    
+    # 预先为已配置的API地址创建共享连接池
+    init_shared_clients(await database.fetch_api_config_urls())
+    task_poller.start()
+    history_writer.start()
+    image_executor.start()
+    thumbnail_pipeline.start()
+    job_queue.start()
+    
+    # 后台分批迁移旧版历史记录
+    background_tasks.add(asyncio.create_task(database.migrate_legacy_history()))
+    
     try:
         load_additional_endpoints()
     except Exception as e:
         print(f"Warning: Could not load additional endpoints: {e}")
 
+# 在应用关闭时释放连接池
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    
+    await job_queue.stop()
+    await task_poller.stop()
+    await thumbnail_pipeline.stop()
+    await image_executor.stop()
+    await history_writer.stop()
+    await close_shared_clients()
+    await database.dispose()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -3,13 +3,26 @@
 支持阿里通义万象图像生成API
 """
 
+import asyncio
 import base64
 import mimetypes
 import os
-from typing import Optional, List, Dict, Any
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
 from http import HTTPStatus
+import httpx
 from dashscope import ImageSynthesis
 from pydantic import BaseModel
+from http_client import get_shared_client
+from circuit_breaker import CircuitBreaker
+from rate_limiter import ProviderRateLimiter
+from retry_policy import RetryPolicy, send_request
+
+# DashScope REST API默认地址
+DEFAULT_QWEN_BASE_URL = "https://dashscope.aliyuncs.com/api/v1"
+
+# 异步任务的终止状态
+TASK_TERMINAL_STATUSES = {"SUCCEEDED", "FAILED", "CANCELED", "UNKNOWN"}
 
 class QwenImageRequest(BaseModel):
     """Qwen图像生成请求模型"""
@@ -34,9 +47,9 @@ class QwenAPIClient:
             base_url: API基础URL（可选）
         """
         self.api_key = api_key
-        # 设置API密钥
-        import dashscope
-        dashscope.api_key = api_key
+        # 密钥和地址随每次调用传递，不写入dashscope模块级全局变量，
+        # 不同配置的客户端可以在多个线程或协程中并发使用
+        self.base_url = normalize_qwen_base_url(base_url) if base_url else None
         
         # 支持的模型列表
         self.supported_models = [
@@ -108,8 +121,14 @@ class QwenAPIClient:
             if request.ref_image_url:
                 kwargs["ref_image_url"] = request.ref_image_url
             
-            # 发送请求
-            response = ImageSynthesis.call(**kwargs)
+            credentials = {"api_key": self.api_key}
+            if self.base_url:
+                credentials["base_address"] = self.base_url
+            
+            # 发送请求：提交任务后等待结果，查询时使用同一组凭据
+            response = ImageSynthesis.async_call(**kwargs, **credentials)
+            if response.status_code == HTTPStatus.OK:
+                response = ImageSynthesis.wait(response, **credentials)
             
             return {
                 "status_code": response.status_code,
@@ -198,4 +217,387 @@ class QwenAPIClient:
         with open(file_path, "rb") as image_file:
             encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
         
-        return f"data:{mime_type};base64,{encoded_string}"
\ No newline at end of file
+        return f"data:{mime_type};base64,{encoded_string}"
+
+
+def normalize_qwen_base_url(base_url: Optional[str]) -> str:
+    """从配置的URL中提取DashScope的 /api/v1 基础地址"""
+    if base_url and "/api/v1" in base_url:
+        return base_url.split("/api/v1")[0] + "/api/v1"
+    return DEFAULT_QWEN_BASE_URL
+
+
+def response_error_message(response: httpx.Response) -> str:
+    """DashScope错误响应中的 message（或 code），不是JSON时返回响应文本"""
+    try:
+        body = response.json()
+    except ValueError:
+        return response.text
+    if isinstance(body, dict):
+        return body.get("message") or body.get("code") or response.text
+    return response.text
+
+
+class _PendingTask:
+    """轮询器跟踪的单个异步任务"""
+    
+    def __init__(self, task_id: str, base_url: str, api_key: str,
+                 http_client: Optional[httpx.AsyncClient],
+                 future: asyncio.Future, interval: float, deadline: float):
+        self.task_id = task_id
+        self.base_url = base_url
+        self.api_key = api_key
+        self.http_client = http_client
+        self.future = future
+        self.interval = interval
+        self.next_poll_at = time.monotonic() + interval
+        self.deadline = deadline
+        # 每次查询到未结束的状态时调用，参数为任务查询结果
+        self.listeners: List[Callable[[Dict[str, Any]], None]] = []
+        # 等待该任务的调用方数量，全部离开后才停止轮询
+        self.watchers = 0
+
+
+class QwenTaskPoller:
+    """
+    共享的异步任务轮询器
+    
+    单个后台协程跟踪所有未完成的DashScope任务，按指数退避查询任务状态，
+    任务结束后解析对应请求的future，不需要为每个请求占用一个线程。
+    """
+    
+    def __init__(self, initial_interval: float = 1.0, max_interval: float = 10.0,
+                 backoff: float = 1.5, task_timeout: float = 600.0):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.task_timeout = task_timeout
+        self._tasks: Dict[str, _PendingTask] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+    
+    @property
+    def pending_count(self) -> int:
+        """未完成的任务数量"""
+        return len(self._tasks)
+    
+    def start(self) -> None:
+        """启动后台轮询协程（需在事件循环中调用）"""
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """停止轮询并取消所有等待中的请求"""
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        for task in self._tasks.values():
+            if not task.future.done():
+                task.future.cancel()
+        self._tasks.clear()
+    
+    def track(self, task_id: str, base_url: str, api_key: str,
+              http_client: Optional[httpx.AsyncClient] = None,
+              on_status: Optional[Callable[[Dict[str, Any]], None]] = None) -> asyncio.Future:
+        """
+        登记一个已提交的任务，返回任务结束时解析的future
+        
+        同一任务的所有调用方共用同一个future，不应直接取消它：调用方结束等待时调用 release，
+        最后一个调用方离开时才停止轮询
+        
+        on_status: 每次查询到未结束的任务状态时以查询结果调用
+        """
+        self.start()
+        existing = self._tasks.get(task_id)
+        if existing is not None:
+            existing.watchers += 1
+            if on_status is not None:
+                existing.listeners.append(on_status)
+            return existing.future
+        
+        future = asyncio.get_running_loop().create_future()
+        task = self._tasks[task_id] = _PendingTask(
+            task_id=task_id,
+            base_url=base_url,
+            api_key=api_key,
+            http_client=http_client,
+            future=future,
+            interval=self.initial_interval,
+            deadline=time.monotonic() + self.task_timeout
+        )
+        task.watchers = 1
+        if on_status is not None:
+            task.listeners.append(on_status)
+        self._wakeup.set()
+        return future
+    
+    def release(self, task_id: str, future: asyncio.Future,
+                on_status: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """调用方不再等待 track 返回的future，没有其他调用方时取消任务的轮询"""
+        task = self._tasks.get(task_id)
+        if task is None or task.future is not future:
+            return
+        if on_status is not None and on_status in task.listeners:
+            task.listeners.remove(on_status)
+        task.watchers -= 1
+        if task.watchers <= 0:
+            self._tasks.pop(task_id, None)
+            if not future.done():
+                future.cancel()
+    
+    async def _run(self) -> None:
+        """轮询主循环"""
+        while True:
+            if not self._tasks:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            now = time.monotonic()
+            due = [task for task in self._tasks.values() if task.next_poll_at <= now]
+            if due:
+                await asyncio.gather(*(self._poll(task) for task in due), return_exceptions=True)
+                continue
+            
+            # 等待到最早的下一次轮询，期间有新任务登记时提前醒来
+            delay = min(task.next_poll_at for task in self._tasks.values()) - now
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _poll(self, task: _PendingTask) -> None:
+        """查询单个任务状态，任务未结束时总是按退避间隔安排下一次查询"""
+        try:
+            if task.future.done():
+                # 等待方已取消
+                self._tasks.pop(task.task_id, None)
+                return
+            
+            http_client = task.http_client or get_shared_client(task.base_url)
+            response = await http_client.get(
+                f"{task.base_url}/tasks/{task.task_id}",
+                headers={"Authorization": f"Bearer {task.api_key}"}
+            )
+            if response.status_code == 200:
+                result = response.json()
+                status = result.get("output", {}).get("task_status")
+                if status in TASK_TERMINAL_STATUSES:
+                    self._resolve(task, result, status)
+                    return
+                for listener in task.listeners:
+                    listener(result)
+            elif 400 <= response.status_code < 500 and response.status_code != 429:
+                # 密钥无效、任务不存在等，继续查询也不会成功
+                self._fail(task, Exception(
+                    f"查询任务失败: {response.status_code} - {response_error_message(response)}"
+                ))
+                return
+        except Exception as e:
+            # 网络抖动或异常的响应不终止任务，按退避间隔继续查询
+            print(f"查询Qwen任务 {task.task_id} 状态失败: {e}")
+        finally:
+            if self._tasks.get(task.task_id) is task:
+                self._reschedule(task)
+    
+    def _reschedule(self, task: _PendingTask) -> None:
+        """超过任务时限时失败，否则按退避间隔安排下一次查询"""
+        if time.monotonic() >= task.deadline:
+            self._fail(task, Exception(f"图像生成超时: 任务 {task.task_id}"))
+            return
+        
+        task.interval = min(task.interval * self.backoff, self.max_interval)
+        task.next_poll_at = time.monotonic() + task.interval
+    
+    def _fail(self, task: _PendingTask, error: Exception) -> None:
+        self._tasks.pop(task.task_id, None)
+        if not task.future.done():
+            task.future.set_exception(error)
+    
+    def _resolve(self, task: _PendingTask, result: Dict[str, Any], status: str) -> None:
+        """任务结束，解析等待方的future"""
+        self._tasks.pop(task.task_id, None)
+        if task.future.done():
+            return
+        if status == "SUCCEEDED":
+            task.future.set_result(result)
+        else:
+            output = result.get("output", {})
+            message = output.get("message") or output.get("code") or status
+            task.future.set_exception(Exception(f"图像生成失败: {message}"))
+
+
+# 进程内共享的轮询器
+task_poller = QwenTaskPoller()
+
+
+class AsyncQwenAPIClient:
+    """阿里Qwen异步API客户端 - 通过REST接口异步提交任务，由共享轮询器等待结果"""
+    
+    def __init__(self, api_key: str, base_url: Optional[str] = None,
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 poller: Optional[QwenTaskPoller] = None,
+                 limiter: Optional[ProviderRateLimiter] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        初始化Qwen异步API客户端
+        
+        Args:
+            api_key: 阿里云API密钥
+            base_url: API基础URL（可选）
+            http_client: HTTP客户端（可选，默认使用共享连接池）
+            poller: 任务轮询器（可选，默认使用进程内共享轮询器）
+            limiter: 任务提交的限流器（可选，按API配置共享，默认不限流）
+            retry_policy: 任务提交的重试策略（可选，按API配置共享，默认不重试）
+            breaker: 任务提交的熔断器（可选，按API配置共享，默认不熔断）
+        """
+        self.api_key = api_key
+        self.base_url = normalize_qwen_base_url(base_url)
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "X-DashScope-Async": "enable"
+        }
+        self._http_client = http_client
+        self.poller = poller or task_poller
+        self.limiter = limiter
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+    
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """请求使用的HTTP客户端"""
+        return self._http_client or get_shared_client(self.base_url)
+    
+    async def submit_task(self, endpoint: str, payload: Dict[str, Any]) -> str:
+        """
+        异步提交任务
+        
+        Args:
+            endpoint: 任务提交地址
+            payload: 请求体
+            
+        Returns:
+            任务ID
+        """
+        http_request = self.http_client.build_request("POST", endpoint, json=payload, headers=self.headers)
+        response = await send_request(self.http_client, http_request,
+                                      self.limiter, self.retry_policy, self.breaker)
+        if response.status_code != 200:
+            raise Exception(f"API调用失败: {response.status_code} - {response.text}")
+        
+        task_id = response.json().get("output", {}).get("task_id")
+        if not task_id:
+            raise Exception(f"API调用失败: 未返回任务ID - {response.text}")
+        return task_id
+    
+    async def wait_task(self, task_id: str) -> Dict[str, Any]:
+        """等待任务结束并返回任务结果"""
+        future = self.poller.track(task_id, self.base_url, self.api_key, self._http_client)
+        try:
+            # 被取消时不取消共享的future，其他调用方可能仍在等待同一任务
+            return await asyncio.shield(future)
+        finally:
+            self.poller.release(task_id, future)
+    
+    async def watch_task(self, task_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        跟踪任务直到结束，逐个产出轮询到的任务查询结果
+        
+        未结束时产出 PENDING/RUNNING 等状态的查询结果，最后产出成功的任务结果；任务失败或超时时抛出异常
+        """
+        updates: asyncio.Queue = asyncio.Queue()
+        on_status = updates.put_nowait
+        future = self.poller.track(task_id, self.base_url, self.api_key, self._http_client,
+                                   on_status=on_status)
+        try:
+            while True:
+                getter = asyncio.ensure_future(updates.get())
+                try:
+                    await asyncio.wait({getter, future}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if not getter.done():
+                        getter.cancel()
+                if getter.done() and not getter.cancelled():
+                    yield getter.result()
+                elif future.done():
+                    yield future.result()
+                    return
+        finally:
+            # 调用方提前停止时移除自己的监听，没有其他调用方时不再轮询该任务
+            self.poller.release(task_id, future, on_status)
+    
+    async def text_to_image(self, request: QwenImageRequest) -> Dict[str, Any]:
+        """
+        文本生成图像
+        
+        Args:
+            request: Qwen图像生成请求对象
+            
+        Returns:
+            任务结果，图像位于 output.results
+        """
+        return await self.wait_task(await self.submit_text_to_image(request))
+    
+    async def image_to_image(self, request: QwenImageRequest) -> Dict[str, Any]:
+        """
+        图像生成图像（图像编辑），输入图像取自 request.ref_image_url
+        
+        Args:
+            request: Qwen图像生成请求对象
+            
+        Returns:
+            任务结果，图像位于 output.results
+        """
+        return await self.wait_task(await self.submit_image_to_image(request))
+    
+    async def submit_text_to_image(self, request: QwenImageRequest) -> str:
+        """提交文生图任务，返回任务ID"""
+        endpoint = f"{self.base_url}/services/aigc/text2image/image-synthesis"
+        
+        input_data: Dict[str, Any] = {"prompt": request.prompt}
+        if request.negative_prompt:
+            input_data["negative_prompt"] = request.negative_prompt
+        if request.ref_image_url:
+            input_data["ref_img"] = request.ref_image_url
+        
+        parameters: Dict[str, Any] = {"size": request.size, "n": request.n}
+        if request.style:
+            parameters["style"] = request.style
+        if request.seed is not None:
+            parameters["seed"] = request.seed
+        
+        return await self.submit_task(endpoint, {
+            "model": request.model,
+            "input": input_data,
+            "parameters": parameters
+        })
+    
+    async def submit_image_to_image(self, request: QwenImageRequest) -> str:
+        """提交图像编辑任务，返回任务ID"""
+        if not request.ref_image_url:
+            raise ValueError("图像编辑需要提供输入图像")
+        
+        endpoint = f"{self.base_url}/services/aigc/image2image/image-synthesis"
+        
+        parameters: Dict[str, Any] = {"n": request.n}
+        if request.seed is not None:
+            parameters["seed"] = request.seed
+        
+        # 使用wanx2.1-imageedit模型进行图像编辑
+        return await self.submit_task(endpoint, {
+            "model": "wanx2.1-imageedit",
+            "input": {
+                "function": "description_edit",
+                "prompt": request.prompt,
+                "base_image_url": request.ref_image_url
+            },
+            "parameters": parameters
+        })
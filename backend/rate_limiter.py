@@ -0,0 +1,300 @@
+"""
+提供商限流
+每个API配置一个限流器：令牌桶限制请求速率，并发上限限制同时进行的请求数，等待的请求按到达顺序排队。
+提供商返回429（或带Retry-After的503）时按Retry-After暂停发放令牌，并按比例降低速率（并发已用满时还有并发上限）；
+之后随成功的请求逐步恢复，接近上次被限流时的速率后放慢增长，速率最终稳定在提供商实际允许的上限附近
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, Optional
+
+import httpx
+
+# 默认值，可按提供商覆盖（如 QWEN_RATE_LIMIT_RPS）
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "5"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "5"))
+RATE_LIMIT_CONCURRENCY = int(os.getenv("RATE_LIMIT_CONCURRENCY", "8"))
+# 自适应降速的下限（次/秒）
+RATE_LIMIT_MIN_RPS = float(os.getenv("RATE_LIMIT_MIN_RPS", "0.2"))
+# 排队等待的最长时间（秒），超过时请求失败
+RATE_LIMIT_QUEUE_TIMEOUT = float(os.getenv("RATE_LIMIT_QUEUE_TIMEOUT", "120"))
+# 被限流的请求重新排队的次数（429表示请求未被处理，重发不会重复生成）
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+# 没有Retry-After时的暂停时间和Retry-After的上限（秒）
+RATE_LIMIT_DEFAULT_PAUSE = float(os.getenv("RATE_LIMIT_DEFAULT_PAUSE", "1"))
+RATE_LIMIT_MAX_PAUSE = float(os.getenv("RATE_LIMIT_MAX_PAUSE", "60"))
+
+# 被限流时速率（并发已用满时还有并发上限）乘以该系数
+DECREASE_FACTOR = 0.7
+# 恢复速度：低于上次被限流时速率的90%时每秒增长约5%，接近时每秒只增长该速率的约0.5%
+RECOVERY_FACTOR = 0.05
+PROBE_FACTOR = 0.005
+CEILING_MARGIN = 0.9
+
+
+def limit_setting(provider: str, name: str, default: float) -> float:
+    """读取限流配置，提供商专属的环境变量（如 DOUBAO_RATE_LIMIT_RPS）优先"""
+    value = os.getenv(f"{provider.upper()}_{name}")
+    return float(value) if value else default
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After（秒数或HTTP日期），无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(response: httpx.Response) -> bool:
+    """提供商是否拒绝了请求并要求降速"""
+    return response.status_code == 429 or (
+        response.status_code == 503 and "retry-after" in response.headers
+    )
+
+
+class RateLimitTimeout(Exception):
+    """排队等待限流超时"""
+
+
+class ProviderRateLimiter:
+    """单个API配置的自适应令牌桶和并发上限，等待的请求先到先得"""
+
+    def __init__(self, rate: float = RATE_LIMIT_RPS, burst: int = RATE_LIMIT_BURST,
+                 concurrency: int = RATE_LIMIT_CONCURRENCY, min_rate: float = RATE_LIMIT_MIN_RPS,
+                 queue_timeout: float = RATE_LIMIT_QUEUE_TIMEOUT,
+                 max_retries: int = RATE_LIMIT_MAX_RETRIES):
+        """
+        Args:
+            rate: 每秒最多发出的请求数（自适应调整的上限）
+            burst: 令牌桶容量，空闲后最多连续发出的请求数
+            concurrency: 同时进行的请求数上限（自适应调整的上限）
+            min_rate: 自适应降速的下限
+            queue_timeout: 排队等待的最长时间（秒）
+            max_retries: 被限流的请求重新排队的次数
+        """
+        self.max_rate = rate
+        self.burst = max(burst, 1)
+        self.max_concurrency = max(concurrency, 1)
+        self.min_rate = min(min_rate, rate)
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+
+        self.rate = rate
+        self.concurrency = self.max_concurrency
+        # 上次被限流时的速率，恢复到其附近后放慢增长
+        self.ceiling: Optional[float] = None
+        self.in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        # 同一轮限流（同一批并发请求）只降速一次
+        self._hold_until = 0.0
+        self._successes = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        # 统计
+        self.granted = 0
+        self.throttled = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.max_wait_ms = 0.0
+        self._total_wait_ms = 0.0
+
+    @classmethod
+    def for_provider(cls, provider: str) -> "ProviderRateLimiter":
+        """按提供商的环境变量创建限流器"""
+        return cls(
+            rate=limit_setting(provider, "RATE_LIMIT_RPS", RATE_LIMIT_RPS),
+            burst=int(limit_setting(provider, "RATE_LIMIT_BURST", RATE_LIMIT_BURST)),
+            concurrency=int(limit_setting(provider, "RATE_LIMIT_CONCURRENCY", RATE_LIMIT_CONCURRENCY))
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    async def acquire(self, front: bool = False) -> None:
+        """
+        排队获取一个令牌和并发名额，之后必须调用 release
+
+        Args:
+            front: 排在队首（被限流后重新排队的请求已经排过一次）
+
+        Raises:
+            RateLimitTimeout: 等待超过 queue_timeout
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        if front:
+            self._waiters.appendleft(waiter)
+        else:
+            self._waiters.append(waiter)
+        started = time.perf_counter()
+        self._schedule()
+
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._discard(waiter)
+            raise RateLimitTimeout(f"等待提供商限流超时（{self.queue_timeout:g}秒）")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已获得名额但调用方被取消
+                self.release()
+            self._discard(waiter)
+            raise
+
+        wait_ms = (time.perf_counter() - started) * 1000
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        self._total_wait_ms += wait_ms
+
+    def release(self) -> None:
+        """归还并发名额"""
+        self.in_flight -= 1
+        self._schedule()
+
+    def record(self, response: httpx.Response) -> None:
+        """根据响应调整速率：被限流时降速并暂停，成功时逐步恢复"""
+        if is_throttled(response):
+            self.on_throttled(parse_retry_after(response.headers.get("retry-after")))
+        elif response.status_code < 400:
+            self.on_success()
+
+    def on_throttled(self, retry_after: Optional[float] = None) -> None:
+        """提供商返回429：暂停发放令牌，同一轮限流只降一次速"""
+        self.throttled += 1
+        now = time.monotonic()
+        pause = min(retry_after if retry_after is not None else RATE_LIMIT_DEFAULT_PAUSE,
+                    RATE_LIMIT_MAX_PAUSE)
+        self._paused_until = max(self._paused_until, now + pause)
+        self._tokens = 0.0
+        self._refilled_at = max(now, self._paused_until)
+
+        if now >= self._hold_until:
+            self.ceiling = self.rate
+            self.rate = max(self.rate * DECREASE_FACTOR, self.min_rate)
+            if self.in_flight >= self.concurrency:
+                # 并发已用满，提供商限制的可能是并发数
+                self.concurrency = max(int(self.concurrency * DECREASE_FACTOR), 1)
+            self._successes = 0
+            # 已经发出的请求仍可能返回429，等它们返回后再判断是否需要继续降速
+            self._hold_until = self._paused_until + 1 / self.rate
+        self._schedule()
+
+    def on_success(self) -> None:
+        """
+        请求被接受：速率逐步恢复，接近上次被限流的速率后缓慢试探；每轮并发全部成功后并发上限加一
+
+        每秒约有 rate 个成功请求，每次的增量按此折算，使恢复速度只与时间有关
+        """
+        if self.ceiling is not None and self.rate >= self.ceiling * CEILING_MARGIN:
+            self.rate += self.ceiling * PROBE_FACTOR / self.rate
+            if self.rate > self.ceiling / CEILING_MARGIN:
+                # 已明显超过上次被限流的速率，提供商的上限可能已提高
+                self.ceiling = None
+        else:
+            self.rate += RECOVERY_FACTOR
+        self.rate = min(self.rate, self.max_rate)
+
+        self._successes += 1
+        if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self._successes = 0
+        self._schedule()
+
+    async def open(self, http_client: httpx.AsyncClient, request: httpx.Request,
+                   stream: bool = False) -> httpx.Response:
+        """
+        经过限流发送请求，返回时仍占用并发名额，调用方处理完响应后调用 release
+
+        被限流的请求按Retry-After等待后排在队首重发，超过 max_retries 后返回最后的429响应
+        """
+        retries = 0
+        while True:
+            await self.acquire(front=retries > 0)
+            try:
+                response = await http_client.send(request, stream=stream)
+            except BaseException:
+                self.release()
+                raise
+            self.record(response)
+            if not is_throttled(response) or retries >= self.max_retries:
+                return response
+
+            if stream:
+                await response.aclose()
+            self.release()
+            retries += 1
+            self.retried += 1
+
+    async def send(self, http_client: httpx.AsyncClient, request: httpx.Request) -> httpx.Response:
+        """经过限流发送请求并读取完整响应"""
+        response = await self.open(http_client, request)
+        self.release()
+        return response
+
+    def _discard(self, waiter: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        self._schedule()
+
+    def _refill(self, now: float) -> None:
+        if now > self._refilled_at:
+            self._tokens = min(self._tokens + (now - self._refilled_at) * self.rate, self.burst)
+            self._refilled_at = now
+
+    def _schedule(self) -> None:
+        """按排队顺序发放令牌和并发名额，令牌不足时定时再次检查"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters and self.in_flight < self.concurrency:
+            if self._waiters[0].done():
+                self._waiters.popleft()
+                continue
+            if now < self._paused_until or self._tokens < 1:
+                delay = max(self._paused_until - now, (1 - self._tokens) / self.rate, 0.001)
+                self._timer = asyncio.get_running_loop().call_later(delay, self._schedule)
+                return
+            self._tokens -= 1
+            self.in_flight += 1
+            self.granted += 1
+            self._waiters.popleft().set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """当前速率、并发和排队统计"""
+        granted = self.granted or 1
+        return {
+            "rate": round(self.rate, 3),
+            "max_rate": self.max_rate,
+            "ceiling": round(self.ceiling, 3) if self.ceiling is not None else None,
+            "concurrency": self.concurrency,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "paused_for": round(max(self._paused_until - time.monotonic(), 0.0), 3),
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "retried": self.retried,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self._total_wait_ms / granted, 2) if self.granted else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 2)
+        }
+
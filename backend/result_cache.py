@@ -0,0 +1,97 @@
+"""
+指定seed的生成结果缓存
+seed固定时提供商的输出是确定的：按规范化请求的哈希把结果（本地图片存储中的哈希）保存在数据库中，
+相同的请求直接返回已保存的图片，不再调用提供商。超过有效期的结果失效，
+条数超过上限时按最近使用时间淘汰
+"""
+
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import database
+from image_store import ImageStore
+
+# 缓存有效期（秒）和条数上限，上限为0时不缓存
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+
+
+class ResultCache:
+    """持久化的生成结果缓存（多进程共用数据库中的同一张表）"""
+
+    def __init__(self, store: ImageStore, ttl: float = RESULT_CACHE_TTL,
+                 max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        """
+        Args:
+            store: 图片存储，命中时检查图片文件仍然存在
+            ttl: 有效期（秒）
+            max_entries: 条数上限
+        """
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    async def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """未过期且图片都还在时返回缓存的存储结果，否则返回None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            images = await database.fetch_cached_result(key, now - self.ttl, now)
+            if images is not None and not all(self.store.exists(image["hash"]) for image in images):
+                # 图片已从存储中删除
+                await database.delete_cached_result(key)
+                images = None
+        except Exception as e:
+            # 缓存不可用时照常生成
+            self.errors += 1
+            print(f"读取结果缓存失败: {e}")
+            images = None
+
+        if images is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return images
+
+    async def put(self, key: str, images: List[Dict[str, Any]]) -> None:
+        """保存生成结果，只缓存全部图片都已保存到本地的结果（提供商URL会过期）"""
+        if not self.enabled or not images or not all(image["hash"] for image in images):
+            return
+        now = time.time()
+        try:
+            self.evicted += await database.put_cached_result(
+                key, images, now, now - self.ttl, self.max_entries
+            )
+            self.stored += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"写入结果缓存失败: {e}")
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """命中率和缓存条数"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": await database.count_cached_results() if self.enabled else 0,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "stored": self.stored,
+            "evicted": self.evicted,
+            "errors": self.errors
+        }
@@ -0,0 +1,325 @@
+"""
+提供商请求重试与对冲
+按错误类型决定是否重试：连接未建立、服务不可用（503）和仍被限流（429）时提供商没有处理请求，
+任何请求都可以重发（经过限流器的请求被限流时只由限流器重新排队，这里不再重试）；
+读超时、连接中断、网关错误（502/504，上游可能已收到并在处理）和500等结果未知的错误只重试幂等请求（或显式允许时）。
+重试间隔为带随机抖动的指数退避，超过总时限后不再重试。
+可选的对冲请求：等待超过最近成功请求耗时的p95后再发出一个相同的请求，先成功的返回，较慢的被取消
+"""
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+import httpx
+
+from circuit_breaker import CircuitBreaker
+from rate_limiter import ProviderRateLimiter, is_throttled, limit_setting
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+# 从第一次请求开始计算的总时限（秒），超过后不再发起重试
+RETRY_DEADLINE = float(os.getenv("RETRY_DEADLINE", "180"))
+# 是否重试结果未知的非幂等请求（可能重复生成并计费）
+RETRY_UNSAFE = os.getenv("RETRY_UNSAFE", "0") != "0"
+# 对冲请求（生成接口没有幂等键，对冲会重复生成并计费，默认关闭）
+RETRY_HEDGE = os.getenv("RETRY_HEDGE", "0") != "0"
+RETRY_HEDGE_MIN_DELAY = float(os.getenv("RETRY_HEDGE_MIN_DELAY", "1"))
+# 计算p95需要的最少样本数和保留的样本数
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+# 提供商没有处理请求，重发是安全的（经过限流器的请求被限流时由限流器重试）
+SAFE_ERRORS = {"connect", "unavailable", "throttled"}
+# 请求可能已被处理
+AMBIGUOUS_ERRORS = {"timeout", "network", "gateway", "server"}
+# 熔断器记为失败的响应（429和带Retry-After的503由限流器处理，4xx是请求本身的问题）
+BREAKER_FAILURES = {"unavailable", "gateway", "server"}
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """按异常判断错误类型，不可重试的返回None"""
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return "connect"
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "network"
+    return None
+
+
+def classify_response(response: httpx.Response) -> Optional[str]:
+    """按响应状态判断错误类型，成功时返回None；带Retry-After的503与429一样是提供商要求降速"""
+    status = response.status_code
+    if status < 400:
+        return None
+    if is_throttled(response):
+        return "throttled"
+    if status == 503:
+        return "unavailable"
+    if status in (502, 504):
+        # 网关已把请求转给上游，上游可能仍在生成
+        return "gateway"
+    if status >= 500:
+        return "server"
+    return "client"
+
+
+class LatencyWindow:
+    """最近成功请求的耗时"""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class RetryPolicy:
+    """单个API配置的重试策略和耗时统计"""
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, deadline: float = RETRY_DEADLINE,
+                 retry_unsafe: bool = RETRY_UNSAFE, hedge: bool = RETRY_HEDGE,
+                 hedge_min_delay: float = RETRY_HEDGE_MIN_DELAY):
+        """
+        Args:
+            max_attempts: 最多请求次数（包括第一次）
+            base_delay: 第一次重试的退避上限（秒），之后每次翻倍
+            max_delay: 单次退避上限（秒）
+            deadline: 总时限（秒）
+            retry_unsafe: 是否重试结果未知的非幂等请求
+            hedge: 是否发出对冲请求
+            hedge_min_delay: 对冲前的最短等待（秒）
+        """
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_unsafe = retry_unsafe
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyWindow()
+
+        # 统计
+        self.requests = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.errors: Dict[str, int] = {}
+
+    @classmethod
+    def for_provider(cls, provider: str) -> "RetryPolicy":
+        """按提供商的环境变量（如 DOUBAO_RETRY_MAX_ATTEMPTS）创建重试策略"""
+        return cls(
+            max_attempts=int(limit_setting(provider, "RETRY_MAX_ATTEMPTS", RETRY_MAX_ATTEMPTS)),
+            base_delay=limit_setting(provider, "RETRY_BASE_DELAY", RETRY_BASE_DELAY),
+            max_delay=limit_setting(provider, "RETRY_MAX_DELAY", RETRY_MAX_DELAY),
+            deadline=limit_setting(provider, "RETRY_DEADLINE", RETRY_DEADLINE),
+            retry_unsafe=limit_setting(provider, "RETRY_UNSAFE", float(RETRY_UNSAFE)) != 0,
+            hedge=limit_setting(provider, "RETRY_HEDGE", float(RETRY_HEDGE)) != 0,
+            hedge_min_delay=limit_setting(provider, "RETRY_HEDGE_MIN_DELAY", RETRY_HEDGE_MIN_DELAY)
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次失败后的等待时间（全抖动：0到指数上限之间随机）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def hedge_delay(self) -> Optional[float]:
+        """发出对冲请求前的等待时间，样本不足时不对冲"""
+        if not self.hedge or len(self.latency) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.latency.percentile(0.95), self.hedge_min_delay)
+
+    def _retryable(self, error_class: Optional[str], idempotent: bool, limited: bool) -> bool:
+        if error_class == "throttled" and limited:
+            # 限流器已按Retry-After重新排队过，不再叠加重试
+            return False
+        if error_class in SAFE_ERRORS:
+            return True
+        return error_class in AMBIGUOUS_ERRORS and (idempotent or self.retry_unsafe)
+
+    async def run(self, attempt: Callable[[], Awaitable[httpx.Response]], idempotent: bool = False,
+                  hedge: bool = True,
+                  discard: Optional[Callable[[httpx.Response], Awaitable[None]]] = None,
+                  limited: bool = False) -> httpx.Response:
+        """
+        按策略执行请求
+
+        Args:
+            attempt: 发出一次请求的协程函数
+            idempotent: 请求是否幂等
+            hedge: 是否允许对冲（流式请求不对冲）
+            discard: 放弃一个失败的响应时调用（流式响应需要关闭）
+            limited: 请求经过限流器，被限流的响应由限流器重试，这里直接返回
+
+        Returns:
+            成功的响应，或不再重试时的最后一个失败响应；不再重试的异常直接抛出
+        """
+        self.requests += 1
+        started = time.monotonic()
+        number = 0
+        while True:
+            number += 1
+            attempt_started = time.monotonic()
+            error = response = None
+            try:
+                response = await (self._hedged(attempt) if hedge else attempt())
+            except Exception as e:
+                error_class = classify_error(e)
+                if error_class is None:
+                    raise
+                error = e
+            else:
+                error_class = classify_response(response)
+                if error_class is None:
+                    self.latency.add(time.monotonic() - attempt_started)
+                    return response
+            self.errors[error_class] = self.errors.get(error_class, 0) + 1
+
+            delay = self.backoff(number)
+            if (number >= self.max_attempts or not self._retryable(error_class, idempotent, limited)
+                    or time.monotonic() + delay - started >= self.deadline):
+                if error_class != "client":
+                    self.gave_up += 1
+                if error is not None:
+                    raise error
+                return response
+
+            if response is not None and discard is not None:
+                await discard(response)
+            self.retries += 1
+            print(f"提供商请求失败（{error_class}），{delay:.2f}秒后第{number + 1}次请求")
+            await asyncio.sleep(delay)
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """超过p95仍未返回时再发出一个相同的请求，返回先成功的一个，取消另一个"""
+        delay = self.hedge_delay()
+        if delay is None:
+            return await attempt()
+
+        first = asyncio.ensure_future(attempt())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+
+            self.hedged += 1
+            second = asyncio.ensure_future(attempt())
+            tasks.append(second)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and classify_response(task.result()) is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # 两个请求都失败，按原请求的结果处理
+            return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """重试和对冲统计"""
+        p50 = self.latency.percentile(0.5)
+        p95 = self.latency.percentile(0.95)
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "gave_up": self.gave_up,
+            "errors": dict(self.errors),
+            "hedge": self.hedge,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 2) if p95 is not None else None
+        }
+
+
+async def guarded(call: Callable[[], Awaitable[httpx.Response]],
+                  breaker: Optional[CircuitBreaker] = None) -> httpx.Response:
+    """经过熔断器执行一次调用（包括全部重试），连接失败、超时和5xx记为失败"""
+    if breaker is None:
+        return await call()
+    probe = breaker.acquire()
+    started = time.monotonic()
+    try:
+        response = await call()
+    except asyncio.CancelledError:
+        breaker.abandon(probe)
+        raise
+    except Exception as e:
+        breaker.record(time.monotonic() - started, classify_error(e) is not None, probe)
+        raise
+    breaker.record(time.monotonic() - started, classify_response(response) in BREAKER_FAILURES, probe)
+    return response
+
+
+async def send_request(http_client: httpx.AsyncClient, request: httpx.Request,
+                       limiter: Optional[ProviderRateLimiter] = None,
+                       policy: Optional[RetryPolicy] = None,
+                       breaker: Optional[CircuitBreaker] = None,
+                       idempotent: bool = False) -> httpx.Response:
+    """发送请求：指定限流器时经过限流，指定重试策略时按策略重试和对冲，指定熔断器时打开期间直接失败"""
+    async def attempt() -> httpx.Response:
+        if limiter is None:
+            return await http_client.send(request)
+        return await limiter.send(http_client, request)
+
+    async def call() -> httpx.Response:
+        if policy is None:
+            return await attempt()
+        return await policy.run(attempt, idempotent=idempotent, limited=limiter is not None)
+
+    return await guarded(call, breaker)
+
+
+@asynccontextmanager
+async def open_stream(http_client: httpx.AsyncClient, request: httpx.Request,
+                      limiter: Optional[ProviderRateLimiter] = None,
+                      policy: Optional[RetryPolicy] = None,
+                      breaker: Optional[CircuitBreaker] = None) -> AsyncIterator[httpx.Response]:
+    """
+    发送流式请求，读取响应期间一直占用限流器的并发名额
+
+    只在收到响应头之前重试，开始读取响应体后出错不再重发；熔断器按收到响应头为止的结果记录
+    """
+    async def attempt() -> httpx.Response:
+        if limiter is None:
+            return await http_client.send(request, stream=True)
+        return await limiter.open(http_client, request, stream=True)
+
+    async def close(response: httpx.Response) -> None:
+        await response.aclose()
+        if limiter is not None:
+            limiter.release()
+
+    async def call() -> httpx.Response:
+        if policy is None:
+            return await attempt()
+        return await policy.run(attempt, hedge=False, discard=close, limited=limiter is not None)
+
+    response = await guarded(call, breaker)
+    try:
+        yield response
+    finally:
+        await close(response)
@@ -0,0 +1,206 @@
+"""
+多配置路由
+路由组是一个逻辑端点，包含多个豆包和Qwen配置：生成请求的 apiConfigId 为路由组ID时，
+按组的策略排列可用的配置，依次尝试，前一个失败时自动切换到下一个。策略：
+- weighted：按权重随机
+- least_outstanding：进行中的请求数（按权重折算）最少的优先
+- latency：最近成功生成的耗时（指数加权平均）最低的优先，少量请求按权重随机以便重新测量
+"""
+
+import json
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence
+
+from client_registry import REGISTRY_TTL, ClientRegistry, PROVIDER_QWEN, RegistryEntry
+
+POLICY_WEIGHTED = "weighted"
+POLICY_LEAST_OUTSTANDING = "least_outstanding"
+POLICY_LATENCY = "latency"
+ROUTING_POLICIES = (POLICY_WEIGHTED, POLICY_LEAST_OUTSTANDING, POLICY_LATENCY)
+
+# latency 策略中按权重随机选择的比例
+EXPLORE_RATE = 0.05
+# 耗时指数加权平均中新样本的权重
+LATENCY_EWMA_ALPHA = 0.3
+
+# Qwen只支持文生图和单图编辑，其他生成类型只路由到豆包配置
+QWEN_GENERATION_TYPES = {"text_to_image", "image_to_image"}
+
+
+class RoutingGroup:
+    """路由组：名称、策略和成员配置的权重"""
+
+    def __init__(self, group_id: str, name: str, policy: str, members: Sequence[Dict[str, Any]]):
+        self.id = group_id
+        self.name = name
+        self.policy = policy if policy in ROUTING_POLICIES else POLICY_WEIGHTED
+        self.members = [(member["config_id"], max(float(member.get("weight", 1)), 0.0))
+                        for member in members]
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> "RoutingGroup":
+        return cls(row[0], row[1], row[2], json.loads(row[3]) if row[3] else [])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "policy": self.policy,
+            "members": [{"configId": config_id, "weight": weight} for config_id, weight in self.members]
+        }
+
+
+def supports(entry: RegistryEntry, generation_type: str) -> bool:
+    """配置的提供商是否支持该生成类型"""
+    return entry.provider != PROVIDER_QWEN or generation_type in QWEN_GENERATION_TYPES
+
+
+def weighted_order(items: List[Any], weights: List[float]) -> List[Any]:
+    """按权重随机排列（权重越大越可能靠前），权重必须大于0"""
+    keys = [random.random() ** (1 / weight) for weight in weights]
+    return [item for _, item in sorted(zip(keys, items), key=lambda pair: pair[0], reverse=True)]
+
+
+class Tracking:
+    """一次生成的统计：计入进行中的请求数并累计耗时，暂停期间（等待调用方读取事件）都不计入"""
+
+    def __init__(self, outstanding: Dict[str, int], config_id: str):
+        self._outstanding = outstanding
+        self._config_id = config_id
+        self.elapsed = 0.0
+        self._started: Optional[float] = None
+
+    def resume(self) -> None:
+        self._outstanding[self._config_id] = self._outstanding.get(self._config_id, 0) + 1
+        self._started = time.monotonic()
+
+    def pause(self) -> None:
+        if self._started is None:
+            return
+        self._outstanding[self._config_id] -= 1
+        self.elapsed += time.monotonic() - self._started
+        self._started = None
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+
+class Router:
+    """解析生成请求的配置ID或路由组ID，按策略给出依次尝试的配置"""
+
+    def __init__(self, registry: ClientRegistry,
+                 loader: Callable[[], Awaitable[List[Any]]], ttl: float = REGISTRY_TTL):
+        """
+        Args:
+            registry: API配置注册表
+            loader: 从数据库加载全部路由组行的协程函数
+            ttl: 路由组缓存有效期（秒）
+        """
+        self._registry = registry
+        self._loader = loader
+        self._ttl = ttl
+        self._groups: Dict[str, RoutingGroup] = {}
+        self._loaded_at: Optional[float] = None
+        # 按配置ID统计进行中的请求数和成功生成的耗时
+        self._outstanding: Dict[str, int] = {}
+        self._latency: Dict[str, float] = {}
+        self.failovers = 0
+
+    async def groups(self) -> Dict[str, RoutingGroup]:
+        """全部路由组（路由组很少，整表缓存）"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self._ttl:
+            rows = await self._loader()
+            self._groups = {row[0]: RoutingGroup.from_row(row) for row in rows}
+            self._loaded_at = time.monotonic()
+        return self._groups
+
+    def invalidate(self) -> None:
+        """路由组增删改后重新加载"""
+        self._loaded_at = None
+
+    async def candidates(self, config_id: str, generation_type: str) -> List[RegistryEntry]:
+        """
+        按尝试顺序排列的配置
+
+        config_id 为单个配置时只返回该配置；为路由组时返回组内已激活且支持该生成类型的配置，
+        熔断器打开的排在最后（会直接失败）
+        """
+        group = (await self.groups()).get(config_id)
+        if group is None:
+            entry = await self._registry.get(config_id)
+            return [entry] if entry is not None and entry.is_active else []
+
+        entries, weights = [], []
+        for member_id, weight in group.members:
+            if weight <= 0:
+                continue
+            entry = await self._registry.get(member_id)
+            if entry is not None and entry.is_active and supports(entry, generation_type):
+                entries.append(entry)
+                weights.append(weight)
+
+        ordered = self._order(group.policy, entries, weights)
+        return ([entry for entry in ordered if self._available(entry)]
+                + [entry for entry in ordered if not self._available(entry)])
+
+    def _order(self, policy: str, entries: List[RegistryEntry], weights: List[float]) -> List[RegistryEntry]:
+        ordered = weighted_order(entries, weights)
+        if policy == POLICY_LEAST_OUTSTANDING:
+            # 权重大的配置可以承担更多进行中的请求；同样空闲时保持按权重随机的顺序
+            weight_of = {id(entry): weight for entry, weight in zip(entries, weights)}
+            ordered.sort(key=lambda entry: self._outstanding.get(entry.config["id"], 0)
+                         / weight_of[id(entry)])
+        elif policy == POLICY_LATENCY and random.random() >= EXPLORE_RATE:
+            # 还没有耗时记录的配置排在前面，先测量一次
+            ordered.sort(key=lambda entry: self._latency.get(entry.config["id"], 0.0))
+        return ordered
+
+    @staticmethod
+    def _available(entry: RegistryEntry) -> bool:
+        return entry.controls is None or entry.controls.breaker.available
+
+    @contextmanager
+    def track(self, entry: RegistryEntry) -> Iterator[Tracking]:
+        """
+        统计一次生成：进行期间计入进行中的请求数，成功结束时更新耗时
+
+        流式生成在产出事件时用 Tracking.paused 暂停，读取慢的客户端不影响配置的耗时
+        """
+        config_id = entry.config["id"]
+        tracking = Tracking(self._outstanding, config_id)
+        tracking.resume()
+        try:
+            yield tracking
+        finally:
+            tracking.pause()
+        latency = tracking.elapsed
+        previous = self._latency.get(config_id)
+        self._latency[config_id] = (latency if previous is None
+                                    else previous + LATENCY_EWMA_ALPHA * (latency - previous))
+
+    def record_failover(self, entry: RegistryEntry, error: Exception) -> None:
+        self.failovers += 1
+        print(f"API配置 {entry.config['name']} 生成失败，切换到路由组中的下一个配置: {error}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各路由组成员的进行中请求数、耗时和熔断状态"""
+        groups = {}
+        for group in self._groups.values():
+            members = []
+            for config_id, weight in group.members:
+                latency = self._latency.get(config_id)
+                members.append({
+                    "config_id": config_id,
+                    "weight": weight,
+                    "outstanding": self._outstanding.get(config_id, 0),
+                    "latency_ms": round(latency * 1000, 2) if latency is not None else None
+                })
+            groups[group.id] = {"name": group.name, "policy": group.policy, "members": members}
+        return {"groups": groups, "failovers": self.failovers}
@@ -0,0 +1,231 @@
+"""
+缩略图后台处理
+新保存的生成图片进入有界队列，在图片处理进程池中生成多种尺寸的WebP缩略图、读取宽高并生成极小的LQIP占位图，
+结果按图片哈希写入 image_metadata 表，历史记录接口据此返回可直接用于布局的元数据。
+队列满时被丢弃的和进程退出时未处理完的图片，由启动时和定期执行的补全在队列空闲时重新提交
+"""
+
+import asyncio
+import base64
+import io
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from PIL import Image
+
+import database
+from image_executor import ImageExecutor, image_executor
+from image_store import image_path, store_bytes
+
+# 缩略图最长边（像素），逗号分隔
+THUMBNAIL_SIZES = [int(size) for size in os.getenv("THUMBNAIL_SIZES", "256,512").split(",") if size.strip()]
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+# 同时处理的图片数，小于图片处理进程池的进程数时不会占满全部进程
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", str(min(2, os.cpu_count() or 1))))
+THUMBNAIL_QUEUE_SIZE = int(os.getenv("THUMBNAIL_QUEUE_SIZE", "1000"))
+# 补全缺失缩略图的间隔（秒），0为只在启动时补全
+THUMBNAIL_BACKFILL_INTERVAL = float(os.getenv("THUMBNAIL_BACKFILL_INTERVAL", "600"))
+# 补全时每次从数据库读取的图片数
+BACKFILL_BATCH_SIZE = 100
+# 补全等待队列空闲时的检查间隔（秒）
+BACKFILL_IDLE_CHECK = 1.0
+
+# 占位图最长边，编码后通常只有一两百字节，可直接内嵌在历史记录中
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 30
+
+_STOP = object()
+
+
+def _encode_webp(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def render_thumbnails(root: str, image_hash: str, sizes: Sequence[int],
+                      quality: int = THUMBNAIL_QUALITY) -> Dict[str, Any]:
+    """
+    生成缩略图和占位图（在图片处理进程池中执行）
+
+    Args:
+        root: 图片存储目录
+        image_hash: 原图哈希
+        sizes: 缩略图最长边列表，不小于原图的尺寸会被跳过
+        quality: WebP质量
+
+    Returns:
+        {"width", "height", "placeholder": data URL, "thumbnails": {最长边: 缩略图哈希}}
+    """
+    with Image.open(image_path(root, image_hash)) as image:
+        width, height = image.size
+        # JPEG可在解码时直接按比例缩小，减少解码开销
+        image.draft("RGB", (max(sizes, default=PLACEHOLDER_SIZE),) * 2)
+        mode = "RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB"
+        image = image.convert(mode)
+
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        if size >= max(width, height):
+            continue
+        # 从上一级缩略图继续缩小，避免每次都从原图重采样
+        image.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+        thumbnails[str(size)] = store_bytes(root, _encode_webp(image, quality))
+
+    image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.BILINEAR)
+    placeholder = base64.b64encode(_encode_webp(image, PLACEHOLDER_QUALITY)).decode("ascii")
+
+    return {
+        "width": width,
+        "height": height,
+        "placeholder": f"data:image/webp;base64,{placeholder}",
+        "thumbnails": thumbnails
+    }
+
+
+class ThumbnailPipeline:
+    """后台缩略图处理队列，CPU密集的图片处理在图片处理进程池中执行，不占用事件循环"""
+
+    def __init__(self, root: str, sizes: Sequence[int] = THUMBNAIL_SIZES,
+                 workers: int = THUMBNAIL_WORKERS,
+                 max_queue_size: int = THUMBNAIL_QUEUE_SIZE,
+                 executor: ImageExecutor = image_executor,
+                 backfill_interval: float = THUMBNAIL_BACKFILL_INTERVAL):
+        """
+        Args:
+            root: 图片存储目录
+            sizes: 缩略图最长边列表
+            workers: 同时处理的图片数
+            max_queue_size: 队列上限，队列满时丢弃新任务（不阻塞生成请求），由补全重新提交
+            executor: 图片处理进程池
+            backfill_interval: 补全缺失缩略图的间隔（秒），0为只在启动时补全
+        """
+        self.root = root
+        self.sizes = list(sizes)
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.backfill_interval = backfill_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor = executor
+        self._runners: List[asyncio.Task] = []
+        self._backfill: Optional[asyncio.Task] = None
+        # 本进程中处理失败的图片，补全时不再重复提交
+        self._failed_hashes: Set[str] = set()
+
+        # 统计
+        self.processed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.dropped = 0
+        self.backfilled = 0
+        self._total_ms = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self) -> None:
+        """启动后台处理协程"""
+        if self._runners:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._runners = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        self._backfill = asyncio.create_task(self._backfill_loop())
+
+    async def stop(self) -> None:
+        """停止补全，处理完队列中剩余的图片后停止"""
+        if not self._runners:
+            return
+        self._backfill.cancel()
+        await asyncio.gather(self._backfill, return_exceptions=True)
+        self._backfill = None
+        for _ in self._runners:
+            await self._queue.put(_STOP)
+        await asyncio.gather(*self._runners)
+        self._runners = []
+
+    def submit(self, image_hash: str) -> None:
+        """提交一张图片，不等待处理完成"""
+        if not self._runners:
+            return
+        try:
+            self._queue.put_nowait(image_hash)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self) -> None:
+        while True:
+            image_hash = await self._queue.get()
+            if image_hash is _STOP:
+                return
+
+            try:
+                # 相同内容的图片只处理一次
+                if await database.image_metadata_exists(image_hash):
+                    self.skipped += 1
+                    continue
+                started = time.perf_counter()
+                metadata = await self._executor.run(
+                    render_thumbnails, self.root, image_hash, self.sizes
+                )
+                await database.upsert_image_metadata(image_hash, metadata)
+            except Exception as e:
+                print(f"生成缩略图失败 {image_hash}: {e}")
+                self.failed += 1
+                self._failed_hashes.add(image_hash)
+                continue
+
+            self.processed += 1
+            self._total_ms += (time.perf_counter() - started) * 1000
+
+    async def _backfill_loop(self) -> None:
+        while True:
+            try:
+                await self.backfill()
+            except Exception as e:
+                print(f"补全缩略图失败: {e}")
+            if self.backfill_interval <= 0:
+                return
+            await asyncio.sleep(self.backfill_interval)
+
+    async def backfill(self) -> int:
+        """
+        提交所有还没有缩略图和元数据的结果图片，返回提交的数量
+
+        每批等队列空闲后再提交，不与新生成的图片争抢队列
+        """
+        submitted = 0
+        after = ""
+        while True:
+            while self.queue_depth:
+                await asyncio.sleep(BACKFILL_IDLE_CHECK)
+            batch = await database.fetch_images_without_metadata(
+                after, min(BACKFILL_BATCH_SIZE, self.max_queue_size)
+            )
+            for image_hash in batch:
+                if image_hash not in self._failed_hashes:
+                    await self._queue.put(image_hash)
+                    submitted += 1
+            if len(batch) < min(BACKFILL_BATCH_SIZE, self.max_queue_size):
+                break
+            after = batch[-1]
+
+        if submitted:
+            self.backfilled += submitted
+            print(f"补交 {submitted} 张缺少缩略图的图片")
+        return submitted
+
+    def get_stats(self) -> Dict[str, Any]:
+        """队列深度和处理耗时统计"""
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "backfilled": self.backfilled,
+            "avg_ms": round(self._total_ms / self.processed, 2) if self.processed else 0.0
+        }
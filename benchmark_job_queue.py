@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+基准测试脚本 - 持久化生成任务队列的入队和出队吞吐量
+在临时的SQLite（WAL）数据库上提交一批空任务，再由任务队列认领并执行，
+分别统计每分钟入队和完成的任务数：
+
+    python benchmark_job_queue.py [--jobs N] [--workers N] [--concurrency N]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append('backend')
+
+
+async def noop_runner(job):
+    """不调用提供商，只产出一个完成事件"""
+    yield {"type": "complete", "stored": [], "latency_ms": 0}
+
+
+async def run(jobs: int, workers: int, concurrency: int) -> None:
+    import database
+    from job_queue import JobQueue
+
+    await database.init_database()
+    queue = JobQueue(noop_runner, workers=workers, max_queue_size=jobs, poll_interval=0.05)
+    request = {"prompt": "benchmark", "apiConfigId": "benchmark", "parameters": {}}
+
+    # 入队：concurrency 个协程同时提交，认领协程尚未启动
+    pending = iter(range(jobs))
+
+    async def submitter():
+        for _ in pending:
+            await queue.submit(request)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(submitter() for _ in range(concurrency)))
+    enqueue_seconds = time.perf_counter() - started
+
+    # 出队：启动认领协程直到全部完成
+    started = time.perf_counter()
+    queue.start()
+    while queue.succeeded < jobs:
+        await asyncio.sleep(0.01)
+    drain_seconds = time.perf_counter() - started
+    stats = await queue.get_stats()
+    await queue.stop()
+    await database.dispose()
+
+    print(f"任务数: {jobs}  并发提交: {concurrency}  每进程并发执行: {workers}")
+    print(f"入队: {enqueue_seconds:.2f}s  {jobs / enqueue_seconds * 60:,.0f} 个/分钟")
+    print(f"认领并完成: {drain_seconds:.2f}s  {jobs / drain_seconds * 60:,.0f} 个/分钟"
+          f"  （平均每批认领 {stats['avg_claim_ms']}ms）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=5000, help="任务数")
+    parser.add_argument("--workers", type=int, default=16, help="同时执行的任务数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同时提交的协程数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(temp_dir, 'jobs.db')}"
+        asyncio.run(run(args.jobs, args.workers, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
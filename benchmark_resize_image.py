@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+基准测试脚本 - 对比 resize_image_for_api 优化前后的单张耗时和峰值内存
+默认生成一组典型手机照片尺寸的语料，也可以传入包含真实照片的目录：
+
+    python benchmark_resize_image.py [照片目录] [--rounds N]
+
+每种实现处理每张图片都在独立的子进程中运行，峰值内存为处理期间相对于处理前的RSS增量（需要Linux的 /proc）
+"""
+
+import argparse
+import base64
+import io
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.append('backend')
+
+# 典型手机照片：12MP/48MP 横竖拍摄的JPEG、截图PNG，以及已经很小的JPEG
+CORPUS_SPECS = [
+    ("12mp_landscape.jpg", (4032, 3024), "JPEG"),
+    ("12mp_portrait.jpg", (3024, 4032), "JPEG"),
+    ("48mp_landscape.jpg", (8064, 6048), "JPEG"),
+    ("screenshot.png", (1179, 2556), "PNG"),
+    ("small.jpg", (960, 720), "JPEG"),
+]
+
+
+def legacy_resize_image_for_api(image_data: bytes, max_size: int = 1024) -> str:
+    """优化前的实现"""
+    image = Image.open(io.BytesIO(image_data))
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def synthesize_photo(size, image_format) -> bytes:
+    """生成带噪声和渐变的图片，压缩率接近真实照片"""
+    noise = [Image.effect_noise(size, 40) for _ in range(3)]
+    gradient = Image.linear_gradient("L").resize(size)
+    channels = [Image.blend(channel, gradient, 0.5) for channel in noise]
+    image = Image.merge("RGB", channels)
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=92)
+    else:
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def build_corpus(directory: str) -> None:
+    for name, size, image_format in CORPUS_SPECS:
+        with open(os.path.join(directory, name), "wb") as file:
+            file.write(synthesize_photo(size, image_format))
+
+
+def _status_kb(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def reset_peak_rss() -> float:
+    """重置峰值RSS（VmHWM），返回当前RSS（MB）"""
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+    return _status_kb("VmRSS:") / 1024
+
+
+def peak_rss_mb() -> float:
+    return _status_kb("VmHWM:") / 1024
+
+
+def run_benchmark(implementation: str, path: str, rounds: int, results) -> None:
+    """在子进程中用一种实现处理一张图片"""
+    if implementation == "legacy":
+        resize = legacy_resize_image_for_api
+    else:
+        from doubao_api import resize_image_for_api as resize
+
+    with open(path, "rb") as file:
+        data = file.read()
+
+    samples = []
+    baseline = reset_peak_rss()
+    for _ in range(rounds):
+        started = time.perf_counter()
+        resize(data)
+        samples.append((time.perf_counter() - started) * 1000)
+
+    results.put((len(data), statistics.median(samples), peak_rss_mb() - baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", nargs="?", help="照片目录（默认生成语料）")
+    parser.add_argument("--rounds", type=int, default=5, help="每张图片的运行次数（取中位数）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = args.directory
+        if directory is None:
+            directory = temp_dir
+            build_corpus(directory)
+        paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
+        )
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        report = {"legacy": {}, "current": {}}
+        for path in paths:
+            for implementation in report:
+                process = context.Process(target=run_benchmark,
+                                          args=(implementation, path, args.rounds, results))
+                process.start()
+                report[implementation][os.path.basename(path)] = results.get()
+                process.join()
+
+    print(f"{'图片':<22}{'大小(KB)':>9}{'优化前(ms)':>11}{'优化后(ms)':>11}{'加速':>7}"
+          f"{'优化前峰值(MB)':>15}{'优化后峰值(MB)':>15}")
+    for name, (size, legacy_ms, legacy_peak) in report["legacy"].items():
+        _, current_ms, current_peak = report["current"][name]
+        print(f"{name:<22}{size / 1024:>9.0f}{legacy_ms:>11.1f}{current_ms:>11.1f}"
+              f"{legacy_ms / current_ms:>6.1f}x{legacy_peak:>15.1f}{current_peak:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
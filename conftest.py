@@ -0,0 +1,60 @@
+"""
+测试共用的假时钟和临时数据库
+"""
+
+import asyncio
+import sys
+
+import pytest
+
+sys.path.append('backend')
+
+
+class FakeClock:
+    """替换被测模块的 time，只有 advance 时时间才会前进"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock():
+    """假时钟，用 monkeypatch.setattr(模块, "time", fake_clock) 替换模块中的 time"""
+    return FakeClock()
+
+
+@pytest.fixture
+def run_with_database(monkeypatch, tmp_path):
+    """
+    把数据库换成临时文件，返回 run(scenario)：建表后执行协程函数 scenario，结束时关闭连接池
+
+    引擎的连接属于创建它的事件循环，scenario 中的全部数据库操作都在同一个 asyncio.run 中执行
+    """
+    import database
+
+    monkeypatch.setattr(database, "DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(database, "engine", database._create_engine())
+
+    def run(scenario):
+        async def main():
+            await database.init_database()
+            try:
+                await scenario()
+            finally:
+                await database.dispose()
+
+        asyncio.run(main())
+
+    return run
@@ -64,4 +64,9 @@ export interface ChatHistoryResponse {
   images: string[]
   parameters: GenerationParameters
   timestamp: string
-}
\ No newline at end of file
+}
+
+export interface ChatHistoryPage {
+  history: ChatHistoryResponse[]
+  next_cursor: string | null
+}
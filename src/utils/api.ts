@@ -1,5 +1,5 @@
 import axios from 'axios'
-import { ApiConfig, GenerationResponse, ChatHistoryResponse } from '../types'
+import { ApiConfig, GenerationResponse, ChatHistoryPage } from '../types'
 
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000'
 
@@ -75,9 +75,13 @@ export const generationService = {
 
 // 聊天历史相关
 export const historyService = {
-  // 获取聊天历史
-  getHistory: async (limit = 20, offset = 0): Promise<ChatHistoryResponse[]> => {
-    const response = await api.get(`/api/chat-history?limit=${limit}&offset=${offset}`)
+  // 获取聊天历史（游标分页：下一页传入上一页返回的 next_cursor，为null时已到底）
+  getHistory: async (limit = 20, cursor?: string | null): Promise<ChatHistoryPage> => {
+    const params: Record<string, string | number> = { limit }
+    if (cursor) {
+      params.cursor = cursor
+    }
+    const response = await api.get('/api/chat-history', { params })
     return response.data
   },
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证批量上传
+检查逐行返回的结果不包含内部错误细节，以及客户端断开后停止处理且不留下共享内存段
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+import pytest
+from fastapi import FastAPI
+from PIL import Image
+from starlette.datastructures import Headers, UploadFile
+
+sys.path.append('backend')
+
+import additional_endpoints
+from image_executor import ImageExecutor
+
+SHM_DIR = "/dev/shm"
+
+
+def png(width, height, noise=False):
+    image = Image.effect_noise((width, height), 64).convert("RGB") if noise else Image.new("RGB", (width, height))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def upload_file(data, filename="upload.png", content_type="image/png"):
+    return UploadFile(io.BytesIO(data), filename=filename, headers=Headers({"content-type": content_type}))
+
+
+def batch_upload_endpoint():
+    """在新的应用上注册端点（main 在启动时才注册），返回 /api/batch-upload 的处理函数"""
+    app = FastAPI()
+    additional_endpoints.add_advanced_endpoints(app, client_registry=None)
+    for route in app.routes:
+        if getattr(route, "path", None) == "/api/batch-upload":
+            return route.endpoint
+    raise AssertionError("没有 /api/batch-upload")
+
+
+def shared_segments():
+    if not os.path.isdir(SHM_DIR):
+        pytest.skip("没有 /dev/shm")
+    return {name for name in os.listdir(SHM_DIR) if name.startswith("psm_")}
+
+
+def test_errors_do_not_leak_internals(monkeypatch):
+    """无法解码的文件返回简短的错误信息，不包含异常中的对象表示"""
+    executor = ImageExecutor(workers=1, max_queue_size=2, task_timeout=30)
+    monkeypatch.setattr(additional_endpoints, "image_executor", executor)
+    endpoint = batch_upload_endpoint()
+
+    async def run():
+        try:
+            response = await endpoint([upload_file(b"not an image"), upload_file(png(64, 64))])
+            return [json.loads(line) async for line in response.body_iterator]
+        finally:
+            await executor.stop()
+
+    lines = asyncio.run(run())
+    results = {line["index"]: line for line in lines if "index" in line}
+    assert results[0] == {"index": 0, "filename": "upload.png", "success": False, "error": "无法识别的图片格式"}
+    assert results[1]["success"]
+    assert lines[-1]["done"] and (lines[-1]["succeeded"], lines[-1]["failed"]) == (1, 1)
+
+
+def test_disconnect_cancels_remaining_files(monkeypatch):
+    """客户端读到第一行后断开：剩余文件不再处理，已提交的缩放结束后丢弃输出共享内存"""
+    before = shared_segments()
+    executor = ImageExecutor(workers=2, max_queue_size=4, task_timeout=30)
+    monkeypatch.setattr(additional_endpoints, "image_executor", executor)
+    monkeypatch.setattr(additional_endpoints, "BATCH_UPLOAD_WORKERS", 2)
+    endpoint = batch_upload_endpoint()
+    files = [upload_file(png(1600, 1600, noise=True), filename=f"{number}.png") for number in range(4)]
+
+    async def run():
+        try:
+            response = await endpoint(files)
+            first = json.loads(await response.body_iterator.__anext__())
+            assert first["success"]
+            # StreamingResponse 在客户端断开时关闭生成器
+            await response.body_iterator.aclose()
+            deadline = time.monotonic() + 30
+            while executor.in_flight and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            assert executor.in_flight == 0
+        finally:
+            await executor.stop()
+        return executor.get_stats()
+
+    stats = asyncio.run(run())
+    assert stats["completed"] < len(files)
+    assert shared_segments() - before == set()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证提供商熔断器
+用假时钟（见 conftest.py）代替熔断器模块中的 time，检查失败率和慢调用触发打开、半开探测、打开时长翻倍和上限
+"""
+
+import asyncio
+import sys
+
+import httpx
+import pytest
+
+sys.path.append('backend')
+
+import circuit_breaker
+from circuit_breaker import (STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker,
+                             CircuitOpenError)
+from retry_policy import send_request
+
+
+def call(breaker, failed=False, latency=0.1):
+    """完成一次经过熔断器的调用"""
+    probe = breaker.acquire()
+    breaker.record(latency, failed, probe)
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        call(breaker, failed=True)
+    assert breaker.state == STATE_OPEN
+
+
+def test_opens_on_error_rate(monkeypatch, fake_clock):
+    """窗口内调用数达到下限且失败率超过阈值时打开，打开期间直接拒绝"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(min_calls=4, error_rate=0.5, open_seconds=30)
+
+    call(breaker, failed=True)
+    call(breaker, failed=True)
+    call(breaker, failed=True)
+    # 调用数不足时不判断
+    assert breaker.state == STATE_CLOSED
+    call(breaker)
+    assert breaker.state == STATE_OPEN
+    assert not breaker.available
+
+    fake_clock.advance(10)
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.acquire()
+    assert error.value.retry_after == 20
+    assert breaker.rejected == 1
+
+
+def test_old_calls_leave_the_window(monkeypatch, fake_clock):
+    """超出统计窗口的调用不再计入失败率"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(window_seconds=60, min_calls=4, error_rate=0.5)
+
+    for _ in range(3):
+        call(breaker, failed=True)
+    fake_clock.advance(61)
+    call(breaker, failed=True)
+    call(breaker)
+    call(breaker)
+    call(breaker)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.get_stats()["calls"] == 4
+
+
+def test_opens_on_slow_calls(monkeypatch, fake_clock):
+    """慢调用比例超过阈值时同样打开"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(min_calls=4, slow_call_seconds=5, slow_call_rate=0.75)
+
+    for _ in range(3):
+        call(breaker, latency=6)
+    call(breaker, latency=1)
+    assert breaker.state == STATE_OPEN
+    assert breaker.opened_reason.startswith("慢调用比例")
+
+
+def test_half_open_admits_limited_probes(monkeypatch, fake_clock):
+    """到期后进入半开状态，只放行 half_open_calls 个探测调用，全部成功后关闭"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(min_calls=2, open_seconds=30, half_open_calls=2)
+    open_breaker(breaker)
+
+    fake_clock.advance(30)
+    assert breaker.available
+    first = breaker.acquire()
+    second = breaker.acquire()
+    assert first and second
+    assert breaker.state == STATE_HALF_OPEN
+    assert not breaker.available
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+    breaker.record(0.1, False, first)
+    assert breaker.state == STATE_HALF_OPEN
+    breaker.record(0.1, False, second)
+    assert breaker.state == STATE_CLOSED
+    # 关闭后清空统计，之前的失败不再计入
+    assert breaker.get_stats()["calls"] == 0
+    assert breaker.acquire() is False
+
+
+def test_abandoned_probe_frees_its_slot(monkeypatch, fake_clock):
+    """被取消的探测调用归还名额，不记录结果"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(min_calls=2, open_seconds=30)
+    open_breaker(breaker)
+
+    fake_clock.advance(30)
+    probe = breaker.acquire()
+    breaker.abandon(probe)
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.acquire()
+
+
+def test_failed_probe_doubles_open_time_up_to_cap(monkeypatch, fake_clock):
+    """探测失败后重新打开，打开时长翻倍，不超过上限；探测成功后恢复初始时长"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(min_calls=2, open_seconds=30, max_open_seconds=100)
+    open_breaker(breaker)
+
+    durations = []
+    for _ in range(3):
+        fake_clock.advance(breaker.open_seconds)
+        call(breaker, failed=True)
+        assert breaker.state == STATE_OPEN
+        durations.append(breaker.open_seconds)
+    assert durations == [60, 100, 100]
+
+    fake_clock.advance(99)
+    assert not breaker.available
+    fake_clock.advance(1)
+    call(breaker)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.open_seconds == 30
+
+    open_breaker(breaker)
+    assert breaker.open_seconds == 30
+
+
+def test_slow_probe_reopens(monkeypatch, fake_clock):
+    """探测调用过慢同样重新打开"""
+    monkeypatch.setattr(circuit_breaker, "time", fake_clock)
+    breaker = CircuitBreaker(min_calls=2, open_seconds=30, slow_call_seconds=5)
+    open_breaker(breaker)
+
+    fake_clock.advance(30)
+    call(breaker, latency=6)
+    assert breaker.state == STATE_OPEN
+    assert breaker.opened_reason == "探测调用过慢"
+
+
+def test_throttled_responses_are_not_failures():
+    """429和带Retry-After的503由限流器处理，不计入熔断失败；不带Retry-After的503计入"""
+    responses = iter([httpx.Response(429), httpx.Response(503, headers={"Retry-After": "1"}),
+                      httpx.Response(503)])
+    transport = httpx.MockTransport(lambda request: next(responses))
+    breaker = CircuitBreaker(min_calls=100)
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            for _ in range(3):
+                await send_request(client, client.build_request("POST", "http://provider.local/"),
+                                   breaker=breaker)
+
+    asyncio.run(run())
+    stats = breaker.get_stats()
+    assert stats["calls"] == 3
+    assert stats["failures"] == 1
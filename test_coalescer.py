@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证相同生成请求合并
+检查进行中的相同请求共用一次调用和同一个错误、等待方断开不影响其他等待方，
+以及生成请求的键按输入图片内容计算
+"""
+
+import asyncio
+import base64
+import io
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.append('backend')
+
+from coalescer import RequestCoalescer, canonical_hash
+from image_store import ImageStore
+
+
+def test_canonical_hash_ignores_field_order():
+    """字段顺序不同的相同请求得到相同的哈希"""
+    assert canonical_hash({"a": 1, "b": [1, 2]}) == canonical_hash({"b": [1, 2], "a": 1})
+    assert canonical_hash({"a": 1}) != canonical_hash({"a": 2})
+
+
+def test_same_key_shares_one_call():
+    """进行中的相同请求只调用一次，所有等待方得到同一个结果"""
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return ["image"]
+
+    async def run():
+        coalescer = RequestCoalescer()
+        results = await asyncio.gather(*(coalescer.run("key", generate) for _ in range(5)),
+                                       coalescer.run("other", generate))
+        assert coalescer.get_stats() == {"leaders": 2, "coalesced": 4, "in_flight": 0}
+        # 调用结束后相同的请求重新调用
+        await coalescer.run("key", generate)
+        return results
+
+    results = asyncio.run(run())
+    assert all(result == ["image"] for result in results)
+    assert len(calls) == 3
+
+
+def test_waiters_share_the_error():
+    """调用失败时所有等待方得到同一个错误"""
+    async def generate():
+        await asyncio.sleep(0.01)
+        raise ValueError("provider failed")
+
+    async def run():
+        coalescer = RequestCoalescer()
+        return await asyncio.gather(*(coalescer.run("key", generate) for _ in range(3)),
+                                    return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert errors[0] is errors[1] is errors[2]
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    """发起调用的等待方断开后，调用继续进行，其他等待方仍得到结果"""
+    async def generate():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run():
+        coalescer = RequestCoalescer()
+        leader = asyncio.create_task(coalescer.run("key", generate))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(coalescer.run("key", generate))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == "done"
+
+
+def png(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_generation_key_uses_input_image_content(monkeypatch, tmp_path):
+    """句柄、图片地址、历史图片引用和data URL指向同一张图片时键相同，内容不同时键不同"""
+    import main
+
+    store = ImageStore(str(tmp_path))
+    monkeypatch.setattr(main, "image_store", store)
+    red = png((200, 0, 0))
+    image_hash = asyncio.run(store.put_bytes(red))
+
+    async def fetch_generation_image(history_id, position):
+        return (image_hash, None) if history_id == "history" else None
+
+    monkeypatch.setattr(main.database, "fetch_generation_image", fetch_generation_image)
+
+    def key(**inputs):
+        request = main.GenerationRequest(prompt="猫", parameters={}, apiConfigId="config", **inputs)
+        return asyncio.run(main.generation_key(request))
+
+    data_url = "data:image/png;base64," + base64.b64encode(red).decode("ascii")
+    keys = {
+        key(input_images=[image_hash]),
+        key(input_images=[f"/api/images/{image_hash}"]),
+        key(input_images=[data_url]),
+        key(input_history_images=["history:0"]),
+        key(input_history_images=[image_hash])
+    }
+    assert len(keys) == 1
+
+    green = "data:image/png;base64," + base64.b64encode(png((0, 200, 0))).decode("ascii")
+    assert key(input_images=[green]) not in keys
+    # 请求是否参与合并不影响键
+    assert key(input_images=[image_hash], coalesce=False) in keys
+
+    with pytest.raises(ValueError):
+        key(input_images=["0" * 64])
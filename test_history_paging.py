@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证历史记录的游标分页和筛选
+在临时数据库中写入历史记录，通过 /api/chat-history 逐页读取，检查不重复、不遗漏和筛选条件
+"""
+
+import sys
+
+import httpx
+
+sys.path.append('backend')
+
+import database
+
+
+def record(number, timestamp, model="doubao-seedream-4-0-250828"):
+    return {
+        "id": f"record-{number:02d}",
+        "prompt": f"提示词 {number}",
+        "images": [{"hash": None, "url": f"https://provider.local/{number}.png"}],
+        "parameters": {"model": model, "generation_type": "text_to_image", "width": 1024, "height": 1024},
+        "provider": "doubao",
+        "api_config_id": "config",
+        "latency_ms": 100,
+        "timestamp": timestamp
+    }
+
+
+async def read_pages(client, **params):
+    """按 next_cursor 读完所有页，返回每页的记录ID"""
+    pages = []
+    cursor = None
+    while True:
+        query = dict(params, cursor=cursor) if cursor else params
+        response = await client.get("/api/chat-history", params=query)
+        assert response.status_code == 200
+        body = response.json()
+        pages.append([item["id"] for item in body["history"]])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_cover_history_once(run_with_database):
+    """时间相同的记录按ID排序，逐页读取不重复、不遗漏"""
+    import main
+
+    async def scenario():
+        # 每两条记录时间相同，跨页时需要按 (timestamp, id) 继续
+        await database.insert_history_batch([
+            record(number, f"2024-01-01 00:00:{number // 2:02d}",
+                   model="wanx-v1" if number % 3 == 0 else "doubao-seedream-4-0-250828")
+            for number in range(11)
+        ])
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            pages = await read_pages(client, limit=3)
+            assert [len(page) for page in pages] == [3, 3, 3, 2]
+            assert [item for page in pages for item in page] == [f"record-{number:02d}" for number in range(10, -1, -1)]
+
+            pages = await read_pages(client, limit=2, model="wanx-v1")
+            assert [item for page in pages for item in page] == ["record-09", "record-06", "record-03", "record-00"]
+
+            summary = (await client.get("/api/chat-history", params={"limit": 1, "view": "summary"})).json()
+            assert set(summary["history"][0]) == {"id", "prompt", "timestamp", "thumbnail", "preview"}
+
+    run_with_database(scenario)
+
+
+def test_offset_paging_is_rejected(run_with_database):
+    """旧版按偏移分页的请求返回400，而不是一直返回第一页"""
+    import main
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.get("/api/chat-history", params={"offset": 20})
+            assert response.status_code == 400
+            assert "next_cursor" in response.json()["detail"]
+            assert (await client.get("/api/chat-history", params={"cursor": "invalid"})).status_code == 400
+
+    run_with_database(scenario)
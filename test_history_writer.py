@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证历史记录批量写入器
+检查按数量和时间攒批、停止时写完剩余记录、直写模式，以及批量写入一直失败时逐条写入
+"""
+
+import asyncio
+import sys
+
+sys.path.append('backend')
+
+import database
+import history_writer
+from history_writer import HistoryWriter
+
+
+def record(number):
+    return {
+        "id": f"record-{number}",
+        "prompt": f"提示词 {number}",
+        "images": [{"hash": None, "url": f"https://provider.local/{number}.png"}],
+        "parameters": {"model": "doubao-seedream-4-0-250828", "width": 1024, "height": 1024},
+        "provider": "doubao",
+        "api_config_id": "config",
+        "latency_ms": 100
+    }
+
+
+def recording_inserts(monkeypatch, fail_ids=()):
+    """替换批量写入，记录每个事务写入的记录ID；包含 fail_ids 中的记录的事务失败"""
+    batches = []
+
+    async def insert_history_batch(records):
+        if any(item["id"] in fail_ids for item in records):
+            raise RuntimeError("database is locked")
+        batches.append([item["id"] for item in records])
+
+    monkeypatch.setattr(history_writer.database, "insert_history_batch", insert_history_batch)
+    return batches
+
+
+def test_batches_by_size_and_drains_on_stop(monkeypatch):
+    """攒满 batch_size 条即写入，停止时写完队列和未满的批次"""
+    batches = recording_inserts(monkeypatch)
+
+    async def run():
+        writer = HistoryWriter(batch_size=3, flush_interval=10)
+        writer.start()
+        for number in range(7):
+            await writer.write(record(number))
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(run())
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [item for batch in batches for item in batch] == [f"record-{number}" for number in range(7)]
+    assert writer.records_written == 7
+    assert writer.batches_flushed == 3
+
+
+def test_flushes_after_interval(monkeypatch):
+    """不足一批的记录在 flush_interval 后写入，不等待停止"""
+    batches = recording_inserts(monkeypatch)
+
+    async def run():
+        writer = HistoryWriter(batch_size=100, flush_interval=0.05)
+        writer.start()
+        await writer.write(record(1))
+        await writer.write(record(2))
+        await asyncio.sleep(0.3)
+        written = list(batches)
+        await writer.stop()
+        return written
+
+    assert asyncio.run(run()) == [["record-1", "record-2"]]
+
+
+def test_write_through_commits_before_returning(monkeypatch):
+    """直写模式不启动后台协程，write 返回时已经提交"""
+    batches = recording_inserts(monkeypatch)
+
+    async def run():
+        writer = HistoryWriter(mode="write_through")
+        writer.start()
+        await writer.write(record(1))
+        assert batches == [["record-1"]]
+        assert writer.queue_depth == 0
+
+    asyncio.run(run())
+
+
+def test_bad_record_does_not_drop_the_batch(monkeypatch):
+    """批量写入一直失败时逐条写入，只丢弃写不进去的记录"""
+    batches = recording_inserts(monkeypatch, fail_ids={"record-2"})
+
+    async def run():
+        writer = HistoryWriter(batch_size=5, flush_interval=10)
+        writer.start()
+        for number in range(5):
+            await writer.write(record(number))
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(run())
+    assert batches == [["record-0"], ["record-1"], ["record-3"], ["record-4"]]
+    assert writer.records_written == 4
+    assert writer.records_failed == 1
+
+
+def test_records_reach_the_database(run_with_database):
+    """写入的记录和图片可以按时间倒序查询到"""
+    async def scenario():
+        writer = HistoryWriter(batch_size=10, flush_interval=0.01)
+        writer.start()
+        for number in range(3):
+            item = record(number)
+            item["timestamp"] = f"2024-01-0{number + 1} 00:00:00"
+            await writer.write(item)
+        await writer.stop()
+
+        rows = await database.fetch_history(limit=10)
+        assert [row[0] for row in rows] == ["record-2", "record-1", "record-0"]
+        assert writer.get_stats()["records_written"] == 3
+
+    run_with_database(scenario)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证图片处理进程池
+检查共享内存传入和传出的数据、任务超时或被取消后名额和共享内存的释放，以及提交数量上限
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append('backend')
+
+from image_executor import ImageExecutor, ImageTaskTimeout
+
+SHM_DIR = "/dev/shm"
+
+
+def reverse_bytes(view, suffix):
+    """在工作进程中执行：输入以memoryview传入，返回bytes"""
+    return bytes(view[::-1]) + suffix
+
+
+def slow_bytes(seconds):
+    time.sleep(seconds)
+    return b"x" * 4096
+
+
+def slow_copy(view, seconds):
+    """在工作进程中执行：读完输入后等待，输出经共享内存传回"""
+    time.sleep(seconds)
+    return bytes(view) * 1024
+
+
+def shared_segments():
+    """本机当前的Python共享内存段"""
+    if not os.path.isdir(SHM_DIR):
+        pytest.skip("没有 /dev/shm")
+    return {name for name in os.listdir(SHM_DIR) if name.startswith("psm_")}
+
+
+async def wait_idle(executor, timeout=10):
+    """等待已提交的任务在进程中真正结束"""
+    deadline = time.monotonic() + timeout
+    while executor.in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    assert executor.in_flight == 0
+
+
+def test_shared_memory_round_trip():
+    """输入和输出都经过共享内存，结束后不留下共享内存段"""
+    before = shared_segments()
+
+    async def run():
+        executor = ImageExecutor(workers=1, max_queue_size=2, task_timeout=30)
+        try:
+            result = await executor.run(reverse_bytes, b"!", data=bytearray(b"abc" * 1000))
+            value = await executor.run(len, "no data")
+        finally:
+            await executor.stop()
+        return result, value, executor.get_stats()
+
+    result, value, stats = asyncio.run(run())
+    assert result == b"cba" * 1000 + b"!"
+    assert value == 7
+    assert stats["completed"] == 2
+    assert shared_segments() - before == set()
+
+
+def test_timeout_releases_slot_and_output():
+    """超时的任务仍占用名额直到进程中真正结束，结束后丢弃它的输出共享内存"""
+    before = shared_segments()
+
+    async def run():
+        executor = ImageExecutor(workers=1, max_queue_size=1, task_timeout=30)
+        try:
+            with pytest.raises(ImageTaskTimeout):
+                await executor.run(slow_copy, 0.5, data=b"input", timeout=0.1)
+            assert executor.in_flight == 1
+            await wait_idle(executor)
+            # 名额已归还，下一个任务可以提交
+            assert await executor.run(reverse_bytes, b"", data=b"ok") == b"ko"
+        finally:
+            await executor.stop()
+        return executor.get_stats()
+
+    stats = asyncio.run(run())
+    assert stats["timeouts"] == 1
+    assert shared_segments() - before == set()
+
+
+def test_cancel_discards_output():
+    """调用方被取消（如客户端断开）时，任务在进程中结束后丢弃输出共享内存"""
+    before = shared_segments()
+
+    async def run():
+        executor = ImageExecutor(workers=1, max_queue_size=1, task_timeout=30)
+        try:
+            running = asyncio.ensure_future(executor.run(slow_copy, 0.5, data=b"input"))
+            await asyncio.sleep(0.1)
+            running.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await running
+            assert executor.in_flight == 1
+            await wait_idle(executor)
+            assert shared_segments() - before == set()
+        finally:
+            await executor.stop()
+        return executor.get_stats()
+
+    stats = asyncio.run(run())
+    assert (stats["completed"], stats["failed"], stats["timeouts"]) == (0, 0, 0)
+    assert shared_segments() - before == set()
+
+
+def test_queue_limit_times_out_waiters():
+    """提交数量达到上限时后来的调用等待，等待超过超时时间则失败"""
+    async def run():
+        executor = ImageExecutor(workers=1, max_queue_size=1, task_timeout=30)
+        try:
+            running = asyncio.ensure_future(executor.run(slow_bytes, 0.5))
+            await asyncio.sleep(0.05)
+            with pytest.raises(ImageTaskTimeout):
+                await executor.run(slow_bytes, 0, timeout=0.1)
+            assert len(await running) == 4096
+        finally:
+            await executor.stop()
+        return executor.get_stats()
+
+    stats = asyncio.run(run())
+    assert stats["timeouts"] == 1
+    assert stats["completed"] == 1
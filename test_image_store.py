@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证本地图片存储
+检查保存失败时历史记录中只保留提供商地址、/api/images 的ETag和Range响应，以及按内容校验上传的图片格式
+"""
+
+import asyncio
+import base64
+import io
+import sys
+
+import httpx
+import pytest
+from PIL import Image
+
+sys.path.append('backend')
+
+import image_store
+from image_store import ImageStore
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+
+def test_failed_saves_never_store_image_data(monkeypatch, tmp_path):
+    """下载失败时保留提供商地址；base64结果保存失败时报错，不把data URL写入历史"""
+    store = ImageStore(str(tmp_path / "images"))
+
+    async def broken_fetch(url):
+        raise httpx.ConnectError("refused")
+
+    async def broken_put(data):
+        raise OSError("No space left on device")
+
+    async def run():
+        monkeypatch.setattr(store, "fetch_url", broken_fetch)
+        assert await store.save_result({"url": "https://provider.local/1.png"}) == {
+            "hash": None, "url": "https://provider.local/1.png"
+        }
+        monkeypatch.setattr(store, "put_bytes", broken_put)
+        with pytest.raises(OSError):
+            await store.save_result({"b64_json": base64.b64encode(PNG_HEADER).decode("ascii")})
+
+    asyncio.run(run())
+
+
+def test_image_endpoint_serves_etag_and_ranges(monkeypatch, tmp_path):
+    """图片按哈希返回，支持 If-None-Match 和 Range；不存在的图片返回404"""
+    import main
+
+    store = ImageStore(str(tmp_path / "images"))
+    monkeypatch.setattr(main, "image_store", store)
+    data = PNG_HEADER + bytes(range(100))
+
+    async def run():
+        image_hash = await store.put_bytes(data)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.get(f"/api/images/{image_hash}")
+            assert response.status_code == 200
+            assert response.content == data
+            assert response.headers["content-type"] == "image/png"
+            etag = response.headers["etag"]
+
+            cached = await client.get(f"/api/images/{image_hash}", headers={"If-None-Match": etag})
+            assert cached.status_code == 304
+
+            partial = await client.get(f"/api/images/{image_hash}", headers={"Range": "bytes=8-11"})
+            assert partial.status_code == 206
+            assert partial.content == bytes(range(4))
+
+            assert (await client.get(f"/api/images/{'0' * 64}")).status_code == 404
+            assert (await client.get("/api/images/not-a-hash")).status_code == 404
+
+    asyncio.run(run())
+
+
+def encode(image_format, **options):
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), (200, 80, 0)).save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def test_uploads_are_validated_by_content(monkeypatch, tmp_path):
+    """Pillow能识别的格式都可以上传（与声明的Content-Type无关），截断的图片和非图片返回400"""
+    import main
+
+    store = ImageStore(str(tmp_path / "images"))
+    monkeypatch.setattr(main, "image_store", store)
+    accepted = [(encode("BMP"), "image/bmp"), (encode("TIFF"), "image/tiff"), (encode("WEBP"), "image/webp")]
+    if not image_store.HEIF_DECODER:
+        # 没有HEIC解码器时按文件头接受
+        accepted.append((b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic", "image/heic"))
+    png = encode("PNG")
+
+    async def upload(client, data, content_type="application/octet-stream"):
+        return await client.post("/api/upload-image", files={"file": ("upload", data, content_type)})
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            for data, media_type in accepted:
+                response = await upload(client, data)
+                assert response.status_code == 200
+                assert response.json()["media_type"] == media_type
+                assert store.exists(response.json()["id"])
+
+            for data in (b"not an image", png[:len(png) // 2]):
+                response = await upload(client, data, "image/png")
+                assert response.status_code == 400
+                assert response.json()["detail"] == "无法识别的图片格式"
+
+    async def run_and_stop():
+        try:
+            await run()
+        finally:
+            # 校验在共享的图片进程池中执行
+            await main.image_executor.stop()
+
+    asyncio.run(run_and_stop())
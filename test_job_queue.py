@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证持久化任务队列的租约
+两个 JobQueue 模拟两个进程共用临时数据库，用假时钟推进时间，
+检查崩溃进程的任务在租约过期后被回收并继续等待原提供商任务、失去租约的进程停止执行、
+超过执行次数的任务失败，以及正常关闭时交还租约
+"""
+
+import asyncio
+import sys
+
+sys.path.append('backend')
+
+import database
+import job_queue
+from job_queue import JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JobQueue
+
+LEASE_SECONDS = 60
+
+
+def make_queue(runner, **options):
+    return JobQueue(runner, workers=1, lease_seconds=LEASE_SECONDS, **options)
+
+
+async def job_status(job_id):
+    row = await database.fetch_job(job_id)
+    return row[1], row[3], row[6]
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_expired_lease_is_reclaimed_and_resumed(monkeypatch, fake_clock, run_with_database):
+    """进程崩溃后租约过期，其他进程回收任务并继续等待已提交的提供商任务；原进程失去租约后停止"""
+    monkeypatch.setattr(job_queue, "time", fake_clock)
+    resumed_with = []
+
+    async def crashing_runner(job):
+        yield {"type": "task", "task_id": "t1", "resume": "config/t1"}
+        await asyncio.Event().wait()
+
+    async def resuming_runner(job):
+        resumed_with.append(job.provider_task_id)
+        yield {"type": "complete", "stored": [], "latency_ms": 1}
+
+    async def scenario():
+        crashed = make_queue(crashing_runner)
+        job = await crashed.submit({"prompt": "猫"})
+        await crashed._claim(1)
+        await settle()
+        assert await job_status(job.id) == (JOB_RUNNING, "config/t1", 1)
+
+        # 租约未过期时不回收
+        survivor = make_queue(resuming_runner)
+        survivor._wakeup = asyncio.Event()
+        fake_clock.advance(LEASE_SECONDS - 1)
+        await survivor._heartbeat_once()
+        assert survivor.reclaimed == 0
+
+        fake_clock.advance(2)
+        await survivor._heartbeat_once()
+        assert survivor.reclaimed == 1
+        assert (await job_status(job.id))[0] == JOB_QUEUED
+
+        [claimed] = await survivor._claim(1)
+        await claimed._task
+        assert resumed_with == ["config/t1"]
+        assert survivor.resumed == 1
+        assert await job_status(job.id) == (JOB_SUCCEEDED, "config/t1", 2)
+
+        # 原进程恢复后续约失败，停止执行且不覆盖结果
+        await crashed._heartbeat_once()
+        await settle()
+        assert crashed.lost_leases == 1
+        assert job.detached
+        assert (await job_status(job.id))[0] == JOB_SUCCEEDED
+
+    run_with_database(scenario)
+
+
+def test_job_fails_after_max_attempts(monkeypatch, fake_clock, run_with_database):
+    """每次租约过期计一次执行，超过 max_attempts 后任务失败而不是无限重试"""
+    monkeypatch.setattr(job_queue, "time", fake_clock)
+
+    async def hanging_runner(job):
+        await asyncio.Event().wait()
+        yield {}
+
+    async def scenario():
+        # 回收由另一个没有执行任务的进程完成，崩溃的进程不会再续约
+        observer = make_queue(hanging_runner, max_attempts=2)
+        observer._wakeup = asyncio.Event()
+        job = await observer.submit({"prompt": "猫"})
+        tasks = []
+        for attempt in range(2):
+            crashed = make_queue(hanging_runner, max_attempts=2)
+            [claimed] = await crashed._claim(1)
+            tasks.append(claimed._task)
+            fake_clock.advance(LEASE_SECONDS + 1)
+            await observer._heartbeat_once()
+
+        row = await database.fetch_job(job.id)
+        assert (row[1], row[5], row[6]) == (JOB_FAILED, "任务多次执行中断", 2)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert (await job_status(job.id))[0] == JOB_FAILED
+
+    run_with_database(scenario)
+
+
+def test_stop_returns_leases_without_counting_attempts(monkeypatch, fake_clock, run_with_database):
+    """正常关闭时执行中的任务交还租约，不计入执行次数，下一个进程立即执行"""
+    monkeypatch.setattr(job_queue, "time", fake_clock)
+
+    async def hanging_runner(job):
+        await asyncio.Event().wait()
+        yield {}
+
+    async def scenario():
+        queue = make_queue(hanging_runner, shutdown_grace=0.01, poll_interval=0.01)
+        queue.start()
+        job = await queue.submit({"prompt": "猫"})
+        for _ in range(100):
+            if job.status == JOB_RUNNING:
+                break
+            await asyncio.sleep(0.01)
+        assert (await job_status(job.id))[0] == JOB_RUNNING
+
+        await queue.stop()
+        assert await job_status(job.id) == (JOB_QUEUED, None, 0)
+
+    run_with_database(scenario)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证Qwen客户端按请求携带密钥
+多个配置的请求并发发送到本地桩服务，检查每个任务的提交和查询都使用了自己的密钥
+"""
+
+import asyncio
+import itertools
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.append('backend')
+
+from qwen_api import AsyncQwenAPIClient, QwenAPIClient, QwenImageRequest, QwenTaskPoller
+
+API_KEYS = ["sk-alpha", "sk-beta", "sk-gamma", "sk-delta"]
+
+
+class StubDashScopeHandler(BaseHTTPRequestHandler):
+    """模拟DashScope的任务提交和任务查询接口"""
+
+    task_ids = itertools.count()
+    task_keys = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _api_key(self):
+        return self.headers.get("Authorization", "").replace("Bearer ", "")
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        api_key = self._api_key()
+
+        # 提示词中带有发起方应使用的密钥，密钥不一致说明请求串号
+        if body["input"]["prompt"] != f"prompt for {api_key}":
+            self._send_json(401, {"code": "InvalidApiKey", "message": "key mismatch"})
+            return
+
+        with self.lock:
+            task_id = f"task-{next(self.task_ids)}"
+            self.task_keys[task_id] = api_key
+        self._send_json(200, {
+            "request_id": task_id,
+            "output": {"task_id": task_id, "task_status": "PENDING"}
+        })
+
+    def do_GET(self):
+        task_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        api_key = self.task_keys.get(task_id)
+        if api_key is None or api_key != self._api_key():
+            self._send_json(401, {"code": "InvalidApiKey", "message": "key mismatch"})
+            return
+
+        self._send_json(200, {
+            "request_id": task_id,
+            "output": {
+                "task_id": task_id,
+                "task_status": "SUCCEEDED",
+                "results": [{"url": f"https://stub.local/{api_key}/{task_id}.png"}]
+            },
+            "usage": {"image_count": 1}
+        })
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubDashScopeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v1"
+
+
+def test_sync_clients_use_their_own_keys_across_threads():
+    """线程池中并发使用不同密钥的同步客户端"""
+    import dashscope
+
+    original_api_key = dashscope.api_key
+    server, base_url = start_stub_server()
+    try:
+        clients = [QwenAPIClient(api_key=key, base_url=base_url) for key in API_KEYS]
+        jobs = [clients[i % len(clients)] for i in range(16)]
+
+        def run(client):
+            return client.api_key, client.text_to_image(
+                QwenImageRequest(prompt=f"prompt for {client.api_key}")
+            )
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(run, jobs))
+
+        for api_key, urls in results:
+            assert len(urls) == 1
+            assert f"/{api_key}/" in urls[0]
+        # 客户端不应修改dashscope的全局密钥
+        assert dashscope.api_key == original_api_key
+    finally:
+        server.shutdown()
+
+
+def test_async_clients_use_their_own_keys_concurrently():
+    """同一事件循环中并发使用不同密钥的异步客户端"""
+    server, base_url = start_stub_server()
+
+    async def run_all():
+        poller = QwenTaskPoller(initial_interval=0.01, max_interval=0.05)
+        async with httpx.AsyncClient() as http_client:
+            clients = [
+                AsyncQwenAPIClient(api_key=key, base_url=base_url,
+                                   http_client=http_client, poller=poller)
+                for key in API_KEYS
+            ]
+            jobs = [clients[i % len(clients)] for i in range(40)]
+            results = await asyncio.gather(*(
+                client.text_to_image(QwenImageRequest(prompt=f"prompt for {client.api_key}"))
+                for client in jobs
+            ))
+            await poller.stop()
+        return list(zip(jobs, results))
+
+    try:
+        for client, result in asyncio.run(run_all()):
+            urls = [item["url"] for item in result["output"]["results"]]
+            assert len(urls) == 1
+            assert f"/{client.api_key}/" in urls[0]
+    finally:
+        server.shutdown()
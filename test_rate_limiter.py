@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证提供商限流器
+用假时钟（见 conftest.py）代替限流器模块中的 time，手动推进时间后检查令牌桶、排队顺序、Retry-After暂停和降速
+"""
+
+import asyncio
+import sys
+
+import httpx
+
+sys.path.append('backend')
+
+import rate_limiter
+from rate_limiter import DECREASE_FACTOR, ProviderRateLimiter, parse_retry_after
+
+
+async def settle():
+    """让等待中的协程处理已发放的名额"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def granted(tasks):
+    return [task.done() for task in tasks]
+
+
+def test_token_bucket_limits_rate(monkeypatch, fake_clock):
+    """令牌用完后按速率补充，空闲时最多积累 burst 个"""
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+
+    async def run():
+        limiter = ProviderRateLimiter(rate=2, burst=2, concurrency=10)
+        tasks = [asyncio.create_task(limiter.acquire()) for _ in range(4)]
+        await settle()
+        assert granted(tasks) == [True, True, False, False]
+
+        fake_clock.advance(0.5)
+        limiter._schedule()
+        await settle()
+        assert granted(tasks) == [True, True, True, False]
+
+        # 空闲很久也只积累 burst 个令牌
+        fake_clock.advance(10)
+        limiter._schedule()
+        await settle()
+        assert all(granted(tasks))
+        more = [asyncio.create_task(limiter.acquire()) for _ in range(3)]
+        await settle()
+        assert granted(more) == [True, False, False]
+        for task in more[1:]:
+            task.cancel()
+        await asyncio.gather(*more, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_waiters_are_served_in_order(monkeypatch, fake_clock):
+    """并发名额按到达顺序发放，被限流后重新排队的请求排在队首"""
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+
+    async def run():
+        limiter = ProviderRateLimiter(rate=100, burst=100, concurrency=1)
+        order = []
+
+        async def worker(name, front=False):
+            await limiter.acquire(front=front)
+            order.append(name)
+
+        first = asyncio.create_task(worker("first"))
+        await settle()
+        tasks = [asyncio.create_task(worker(name)) for name in ("a", "b", "c")]
+        await settle()
+        tasks.append(asyncio.create_task(worker("retry", front=True)))
+        await settle()
+        assert order == ["first"]
+
+        for _ in range(4):
+            limiter.release()
+            await settle()
+        await asyncio.gather(first, *tasks)
+        assert order == ["first", "retry", "a", "b", "c"]
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_retry_after_pauses_tokens(monkeypatch, fake_clock):
+    """被限流后在Retry-After期间不发放令牌，之后按降低后的速率补充"""
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+
+    async def run():
+        limiter = ProviderRateLimiter(rate=10, burst=5, concurrency=10)
+        limiter.on_throttled(retry_after=2)
+        task = asyncio.create_task(limiter.acquire())
+        await settle()
+        assert not task.done()
+
+        fake_clock.advance(2)
+        limiter._schedule()
+        await settle()
+        assert not task.done()
+
+        # 暂停结束后令牌从0开始按新速率（7次/秒）补充
+        fake_clock.advance(0.1)
+        limiter._schedule()
+        await settle()
+        assert not task.done()
+
+        fake_clock.advance(0.1)
+        limiter._schedule()
+        await settle()
+        assert task.done()
+
+    asyncio.run(run())
+
+
+def test_throttled_round_decreases_rate_once(monkeypatch, fake_clock):
+    """同一轮的多个429只降一次速，下一轮再降"""
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+
+    async def run():
+        limiter = ProviderRateLimiter(rate=10, burst=5, concurrency=10)
+        for _ in range(3):
+            limiter.on_throttled(retry_after=1)
+        assert limiter.rate == 10 * DECREASE_FACTOR
+        assert limiter.ceiling == 10
+        assert limiter.throttled == 3
+
+        fake_clock.advance(1 + 1 / limiter.rate)
+        limiter.on_throttled(retry_after=1)
+        assert abs(limiter.rate - 10 * DECREASE_FACTOR ** 2) < 1e-9
+        assert limiter.concurrency == 10
+
+    asyncio.run(run())
+
+
+def test_concurrency_decreases_when_saturated(monkeypatch, fake_clock):
+    """并发已用满时被限流，并发上限也按比例降低"""
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+
+    async def run():
+        limiter = ProviderRateLimiter(rate=100, burst=100, concurrency=4)
+        await asyncio.gather(*(limiter.acquire() for _ in range(4)))
+        limiter.on_throttled(retry_after=0)
+        assert limiter.concurrency == int(4 * DECREASE_FACTOR)
+
+    asyncio.run(run())
+
+
+def test_open_requeues_throttled_requests(monkeypatch, fake_clock):
+    """429响应按Retry-After等待后重发，成功后返回最终响应"""
+    monkeypatch.setattr(rate_limiter, "time", fake_clock)
+    statuses = iter([429, 200])
+
+    def handler(request):
+        status = next(statuses)
+        return httpx.Response(status, headers={"Retry-After": "0"} if status == 429 else {})
+
+    async def run():
+        limiter = ProviderRateLimiter(rate=100, burst=5, concurrency=2)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            task = asyncio.create_task(limiter.send(client, client.build_request("GET", "http://stub/")))
+            # 重新排队的请求需要等待一个令牌
+            while not task.done():
+                fake_clock.advance(0.01)
+                await asyncio.sleep(0.002)
+            response = await task
+        assert response.status_code == 200
+        assert limiter.retried == 1
+        assert limiter.throttled == 1
+        assert limiter.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_parse_retry_after():
+    """Retry-After的秒数不小于0，无法解析时返回None"""
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
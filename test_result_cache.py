@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证指定seed的生成结果缓存
+使用临时数据库和图片存储（见 conftest.py），用假时钟代替缓存模块中的 time，
+检查命中、过期、按最近使用时间淘汰，只有指定seed的请求才读写缓存，以及按实际执行的配置区分结果
+"""
+
+import base64
+import io
+import sys
+
+from PIL import Image
+
+sys.path.append('backend')
+
+import database
+import result_cache
+from image_store import ImageStore
+from result_cache import ResultCache
+
+
+def png(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_hit_miss_and_expiry(monkeypatch, tmp_path, fake_clock, run_with_database):
+    """未过期且图片都在时命中，超过有效期后失效"""
+    store = ImageStore(str(tmp_path / "images"))
+    monkeypatch.setattr(result_cache, "time", fake_clock)
+    cache = ResultCache(store, ttl=60, max_entries=10)
+
+    async def scenario():
+        image_hash = await store.put_bytes(png((200, 0, 0)))
+        images = [{"hash": image_hash, "url": None}]
+        assert await cache.get("key") is None
+        await cache.put("key", images)
+        assert await cache.get("key") == images
+
+        fake_clock.advance(61)
+        assert await cache.get("key") is None
+        stats = await cache.get_stats()
+        assert (stats["hits"], stats["misses"], stats["stored"]) == (1, 2, 1)
+
+    run_with_database(scenario)
+
+
+def test_least_recently_used_is_evicted(monkeypatch, tmp_path, fake_clock, run_with_database):
+    """条数超过上限时淘汰最久没有使用的结果"""
+    store = ImageStore(str(tmp_path / "images"))
+    monkeypatch.setattr(result_cache, "time", fake_clock)
+    cache = ResultCache(store, ttl=3600, max_entries=2)
+
+    async def scenario():
+        results = {}
+        for name, color in (("a", (200, 0, 0)), ("b", (0, 200, 0)), ("c", (0, 0, 200))):
+            results[name] = [{"hash": await store.put_bytes(png(color)), "url": None}]
+        await cache.put("a", results["a"])
+        fake_clock.advance(1)
+        await cache.put("b", results["b"])
+        fake_clock.advance(1)
+        # 读取 a 后 b 成为最久没有使用的
+        assert await cache.get("a") == results["a"]
+        fake_clock.advance(1)
+        await cache.put("c", results["c"])
+
+        assert await cache.get("b") is None
+        assert await cache.get("a") == results["a"]
+        assert await cache.get("c") == results["c"]
+        stats = await cache.get_stats()
+        assert stats["entries"] == 2
+        assert stats["evicted"] == 1
+
+    run_with_database(scenario)
+
+
+def test_missing_images_and_unsaved_results(tmp_path, run_with_database):
+    """图片已从存储中删除时不命中；没有保存到本地的结果和关闭缓存时不写入"""
+    store = ImageStore(str(tmp_path / "images"))
+    cache = ResultCache(store, ttl=3600, max_entries=10)
+
+    async def scenario():
+        await cache.put("gone", [{"hash": "0" * 64, "url": None}])
+        assert await cache.get("gone") is None
+        assert await database.count_cached_results() == 0
+
+        await cache.put("remote", [{"hash": None, "url": "https://provider.local/a.png"}])
+        assert await database.count_cached_results() == 0
+
+        disabled = ResultCache(store, max_entries=0)
+        await disabled.put("key", [{"hash": await store.put_bytes(png((1, 2, 3))), "url": None}])
+        assert await database.count_cached_results() == 0
+        assert await disabled.get("key") is None
+
+    run_with_database(scenario)
+
+
+class StubHttpRequest:
+    def url_for(self, name, image_hash):
+        return f"/api/images/{image_hash}"
+
+
+class StubEntry:
+    def __init__(self, config_id="config", provider="doubao", model=None):
+        self.config = {"id": config_id, "name": config_id}
+        self.provider = provider
+        self.model = model
+
+
+def stub_generation(monkeypatch, tmp_path, entries, failing=()):
+    """
+    替换路由和提供商调用：按 entries 的顺序尝试配置，failing 中的配置调用失败；
+    返回 generate(seed) 和记录每次调用所用配置的列表
+    """
+    import main
+
+    store = ImageStore(str(tmp_path / "images"))
+    monkeypatch.setattr(main, "image_store", store)
+    monkeypatch.setattr(main, "result_cache", ResultCache(store, ttl=3600, max_entries=10))
+    calls = []
+
+    async def route_generation(request):
+        return list(entries)
+
+    async def call_provider(prepared):
+        calls.append(prepared.entry.config["id"])
+        if prepared.entry.config["id"] in failing:
+            raise RuntimeError("provider down")
+        image = base64.b64encode(png((len(calls) * 20, 0, 0))).decode("ascii")
+        return {"data": [{"b64_json": image}]}
+
+    async def record_generation(request, prepared, stored_images, latency_ms):
+        pass
+
+    monkeypatch.setattr(main, "route_generation", route_generation)
+    monkeypatch.setattr(main, "call_provider", call_provider)
+    monkeypatch.setattr(main, "record_generation", record_generation)
+
+    def generate(seed):
+        request = main.GenerationRequest(prompt="猫", parameters={"seed": seed}, apiConfigId="config")
+        return main.generate_image(request, StubHttpRequest())
+
+    return generate, calls
+
+
+def test_only_seeded_requests_are_cached(monkeypatch, tmp_path, run_with_database):
+    """指定seed的相同请求第二次直接返回缓存，未指定seed的每次都调用提供商"""
+    generate, calls = stub_generation(monkeypatch, tmp_path, [StubEntry()])
+
+    async def scenario():
+        first = await generate(42)
+        second = await generate(42)
+        assert (first.cached, second.cached) == (False, True)
+        assert first.image_ids == second.image_ids
+
+        other_seed = await generate(7)
+        assert not other_seed.cached
+        unseeded = [await generate(None), await generate(None)]
+        assert [response.cached for response in unseeded] == [False, False]
+        assert unseeded[0].image_ids != unseeded[1].image_ids
+        assert len(calls) == 4
+        assert await database.count_cached_results() == 2
+
+    run_with_database(scenario)
+
+
+def test_cache_is_keyed_on_the_resolved_config(monkeypatch, tmp_path, run_with_database):
+    """修改配置的模型或切换到其他配置后不命中之前的结果；失败切换后按实际执行的配置缓存"""
+    doubao, qwen = StubEntry("doubao"), StubEntry("qwen", provider="qwen")
+    entries = [doubao]
+    generate, calls = stub_generation(monkeypatch, tmp_path, entries, failing={"doubao-down"})
+
+    async def scenario():
+        await generate(42)
+        doubao.model = "doubao-seedream-3-0-t2i-250415"
+        assert not (await generate(42)).cached
+
+        # 路由组改为先尝试 Qwen
+        entries[:] = [qwen, doubao]
+        assert not (await generate(42)).cached
+        assert (await generate(42)).cached
+        assert calls == ["doubao", "doubao", "qwen"]
+
+        # 首选配置失败后由 doubao 生成，结果记在 doubao 名下
+        entries[:] = [StubEntry("doubao-down"), doubao]
+        response = await generate(7)
+        assert not response.cached
+        entries[:] = [doubao]
+        assert (await generate(7)).image_ids == response.image_ids
+        assert calls == ["doubao", "doubao", "qwen", "doubao-down", "doubao"]
+
+    run_with_database(scenario)
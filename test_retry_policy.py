@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证提供商请求的重试与对冲
+用 httpx.MockTransport 模拟提供商的各种错误，检查按错误类型重试、退避抖动、总时限和对冲请求
+"""
+
+import asyncio
+import sys
+
+import httpx
+
+sys.path.append('backend')
+
+import retry_policy
+from rate_limiter import ProviderRateLimiter
+from retry_policy import RetryPolicy, classify_error, classify_response, send_request
+
+URL = "http://provider.local/api/v3/images/generations"
+
+
+def scripted(outcomes):
+    """按顺序返回给定状态码（或抛出给定异常）的模拟传输，并记录请求次数"""
+    calls = []
+
+    def handler(request):
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(request)
+        if isinstance(outcome, Exception):
+            raise outcome
+        status, headers = outcome if isinstance(outcome, tuple) else (outcome, {})
+        return httpx.Response(status, headers=headers, json={})
+
+    return httpx.MockTransport(handler), calls
+
+
+def send(transport, policy, limiter=None, idempotent=False):
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            request = client.build_request("POST", URL, json={})
+            return await send_request(client, request, limiter=limiter, policy=policy,
+                                      idempotent=idempotent)
+
+    return asyncio.run(run())
+
+
+def test_error_classes():
+    """按异常和响应状态划分错误类型"""
+    request = httpx.Request("POST", URL)
+    assert classify_error(httpx.ConnectError("refused", request=request)) == "connect"
+    assert classify_error(httpx.PoolTimeout("pool", request=request)) == "connect"
+    assert classify_error(httpx.ReadTimeout("read", request=request)) == "timeout"
+    assert classify_error(httpx.RemoteProtocolError("closed", request=request)) == "network"
+    assert classify_error(ValueError("bad")) is None
+
+    assert classify_response(httpx.Response(200)) is None
+    assert classify_response(httpx.Response(429)) == "throttled"
+    assert classify_response(httpx.Response(503, headers={"Retry-After": "1"})) == "throttled"
+    assert classify_response(httpx.Response(503)) == "unavailable"
+    assert classify_response(httpx.Response(502)) == "gateway"
+    assert classify_response(httpx.Response(504)) == "gateway"
+    assert classify_response(httpx.Response(500)) == "server"
+    assert classify_response(httpx.Response(400)) == "client"
+
+
+def test_safe_errors_are_retried_for_any_request():
+    """连接失败和服务不可用时提供商没有处理请求，非幂等请求也重发"""
+    transport, calls = scripted([httpx.ConnectError("refused"), 503, 200])
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    assert send(transport, policy).status_code == 200
+    assert len(calls) == 3
+    assert policy.retries == 2
+    assert policy.errors == {"connect": 1, "unavailable": 1}
+
+
+def test_ambiguous_errors_only_retried_when_idempotent():
+    """500等结果未知的错误只重试幂等请求"""
+    transport, calls = scripted([500, 200])
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    assert send(transport, policy).status_code == 500
+    assert len(calls) == 1
+    assert policy.gave_up == 1
+
+    transport, calls = scripted([500, 200])
+    assert send(transport, policy, idempotent=True).status_code == 200
+    assert len(calls) == 2
+
+    transport, calls = scripted([500, 200])
+    unsafe = RetryPolicy(max_attempts=3, base_delay=0, retry_unsafe=True)
+    assert send(transport, unsafe).status_code == 200
+    assert len(calls) == 2
+
+
+def test_gateway_timeout_does_not_resend_post():
+    """504时上游可能仍在生成，非幂等的POST不重发，幂等请求照常重试"""
+    transport, calls = scripted([504, 200])
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    assert send(transport, policy).status_code == 504
+    assert len(calls) == 1
+    assert policy.errors == {"gateway": 1}
+
+    transport, calls = scripted([504, 200])
+    assert send(transport, policy, idempotent=True).status_code == 200
+    assert len(calls) == 2
+
+
+def test_client_errors_are_not_retried():
+    """4xx是请求本身的问题，直接返回且不计入放弃次数"""
+    transport, calls = scripted([400])
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    assert send(transport, policy).status_code == 400
+    assert len(calls) == 1
+    assert policy.gave_up == 0
+
+
+def test_throttled_requests_left_to_the_limiter():
+    """经过限流器的请求被限流时只由限流器重新排队，重试策略不再叠加"""
+    transport, calls = scripted([(429, {"Retry-After": "0"})])
+    limiter = ProviderRateLimiter(rate=1000, burst=10, max_retries=1)
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    assert send(transport, policy, limiter=limiter).status_code == 429
+    assert len(calls) == 2
+    assert policy.retries == 0
+
+    # 没有限流器时由重试策略重发
+    transport, calls = scripted([429, 200])
+    assert send(transport, policy).status_code == 200
+    assert len(calls) == 2
+
+
+def test_backoff_uses_full_jitter(monkeypatch):
+    """退避在0到指数上限之间随机，上限不超过 max_delay"""
+    policy = RetryPolicy(base_delay=0.5, max_delay=3)
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: high)
+    assert [policy.backoff(attempt) for attempt in range(1, 6)] == [0.5, 1, 2, 3, 3]
+    monkeypatch.undo()
+
+    samples = [policy.backoff(2) for _ in range(200)]
+    assert all(0 <= sample <= 1 for sample in samples)
+    assert len(set(samples)) > 1
+
+
+def test_deadline_stops_retries(monkeypatch, fake_clock):
+    """超过总时限后不再发起重试，返回最后一个失败响应"""
+    monkeypatch.setattr(retry_policy, "time", fake_clock)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        fake_clock.advance(10)
+        return httpx.Response(503)
+
+    policy = RetryPolicy(max_attempts=10, base_delay=0, deadline=15)
+    assert send(httpx.MockTransport(handler), policy).status_code == 503
+    assert len(calls) == 2
+    assert policy.gave_up == 1
+
+
+def test_hedge_returns_faster_request():
+    """原请求超过p95仍未返回时发出对冲请求，先成功的返回，较慢的被取消"""
+    policy = RetryPolicy(hedge=True, hedge_min_delay=0.05)
+    for _ in range(retry_policy.HEDGE_MIN_SAMPLES):
+        policy.latency.add(0.01)
+    cancelled = []
+    started = []
+
+    async def attempt():
+        started.append(len(started))
+        if len(started) == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+        return httpx.Response(200)
+
+    async def run():
+        return await policy.run(attempt)
+
+    assert asyncio.run(run()).status_code == 200
+    assert len(started) == 2
+    assert cancelled == [True]
+    assert policy.hedged == 1
+    assert policy.hedge_wins == 1
+
+
+def test_no_hedge_without_enough_samples():
+    """耗时样本不足或未开启时不对冲"""
+    policy = RetryPolicy(hedge=True)
+    for _ in range(retry_policy.HEDGE_MIN_SAMPLES - 1):
+        policy.latency.add(0.01)
+    assert policy.hedge_delay() is None
+    policy.latency.add(0.01)
+    assert policy.hedge_delay() == policy.hedge_min_delay
+    assert RetryPolicy(hedge=False).hedge_delay() is None
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证多配置路由
+用内存中的配置和路由组检查各策略的尝试顺序、被排除的成员、耗时统计，以及流式生成只在提交前切换配置
+"""
+
+import asyncio
+import json
+import sys
+
+import pytest
+
+sys.path.append('backend')
+
+import routing
+from circuit_breaker import CircuitBreaker
+from client_registry import PROVIDER_DOUBAO, PROVIDER_QWEN
+from routing import POLICY_LATENCY, POLICY_LEAST_OUTSTANDING, POLICY_WEIGHTED, Router
+
+
+class StubControls:
+    def __init__(self):
+        self.breaker = CircuitBreaker(min_calls=1)
+
+
+class StubEntry:
+    """只有路由用到的属性的注册项"""
+
+    def __init__(self, config_id, provider=PROVIDER_DOUBAO, is_active=True):
+        self.config = {"id": config_id, "name": config_id}
+        self.provider = provider
+        self.is_active = is_active
+        self.controls = StubControls()
+
+
+class StubRegistry:
+    def __init__(self, entries):
+        self._entries = {entry.config["id"]: entry for entry in entries}
+
+    async def get(self, config_id):
+        return self._entries.get(config_id)
+
+
+def make_router(entries, policy, weights):
+    members = [{"config_id": config_id, "weight": weight} for config_id, weight in weights.items()]
+    rows = [("group", "组", policy, json.dumps(members))]
+
+    async def loader():
+        return rows
+
+    return Router(StubRegistry(entries), loader)
+
+
+def candidate_ids(router, generation_type="text_to_image"):
+    entries = asyncio.run(router.candidates("group", generation_type))
+    return [entry.config["id"] for entry in entries]
+
+
+def test_single_config_is_not_a_group():
+    """配置ID不是路由组时只返回该配置，未激活时为空"""
+    router = make_router([StubEntry("a"), StubEntry("off", is_active=False)], POLICY_WEIGHTED, {"a": 1})
+    assert [entry.config["id"] for entry in asyncio.run(router.candidates("a", "text_to_image"))] == ["a"]
+    assert asyncio.run(router.candidates("off", "text_to_image")) == []
+    assert asyncio.run(router.candidates("missing", "text_to_image")) == []
+
+
+def test_members_are_filtered():
+    """排除未激活、权重为0和不支持该生成类型的成员"""
+    entries = [StubEntry("a"), StubEntry("off", is_active=False), StubEntry("zero"),
+               StubEntry("qwen", provider=PROVIDER_QWEN)]
+    router = make_router(entries, POLICY_WEIGHTED, {"a": 1, "off": 1, "zero": 0, "qwen": 1})
+    assert sorted(candidate_ids(router)) == ["a", "qwen"]
+    assert candidate_ids(router, "multi_image_fusion") == ["a"]
+
+
+def test_weighted_order_follows_weights():
+    """权重越大越常排在第一位"""
+    router = make_router([StubEntry("heavy"), StubEntry("light")], POLICY_WEIGHTED,
+                         {"heavy": 9, "light": 1})
+    first = [candidate_ids(router)[0] for _ in range(2000)]
+    share = first.count("heavy") / len(first)
+    assert 0.85 < share < 0.95
+
+
+def test_open_breaker_members_go_last():
+    """熔断器打开的成员排在最后"""
+    entries = [StubEntry("a"), StubEntry("b")]
+    router = make_router(entries, POLICY_WEIGHTED, {"a": 100, "b": 1})
+    entries[0].controls.breaker.record(0.1, True)
+    for _ in range(20):
+        assert candidate_ids(router) == ["b", "a"]
+
+
+def test_least_outstanding_prefers_idle_members():
+    """进行中的请求数（按权重折算）最少的成员优先"""
+    entries = [StubEntry("a"), StubEntry("b")]
+    router = make_router(entries, POLICY_LEAST_OUTSTANDING, {"a": 2, "b": 1})
+    with router.track(entries[0]):
+        with router.track(entries[0]):
+            assert candidate_ids(router) == ["b", "a"]
+        # a 的权重是 b 的两倍，一个进行中的请求折算后仍比 b 空闲
+        with router.track(entries[1]):
+            assert candidate_ids(router) == ["a", "b"]
+    assert router.get_stats()["groups"]["group"]["members"][0]["outstanding"] == 0
+
+
+def test_latency_prefers_fast_members(monkeypatch, fake_clock):
+    """latency 策略优先还没有耗时记录的成员，之后按耗时从低到高"""
+    monkeypatch.setattr(routing, "time", fake_clock)
+    monkeypatch.setattr(routing, "EXPLORE_RATE", 0)
+    entries = [StubEntry("slow"), StubEntry("fast")]
+    router = make_router(entries, POLICY_LATENCY, {"slow": 1, "fast": 1})
+
+    with router.track(entries[0]):
+        fake_clock.advance(5)
+    assert candidate_ids(router) == ["fast", "slow"]
+
+    with router.track(entries[1]):
+        fake_clock.advance(1)
+    assert candidate_ids(router) == ["fast", "slow"]
+
+
+def test_paused_time_is_not_counted(monkeypatch, fake_clock):
+    """暂停期间（等待调用方读取事件）不计入耗时和进行中的请求数"""
+    monkeypatch.setattr(routing, "time", fake_clock)
+    entry = StubEntry("a")
+    router = make_router([entry], POLICY_LATENCY, {"a": 1})
+    asyncio.run(router.groups())
+
+    with router.track(entry) as tracking:
+        fake_clock.advance(1)
+        with tracking.paused():
+            assert router.get_stats()["groups"]["group"]["members"][0]["outstanding"] == 0
+            fake_clock.advance(30)
+        fake_clock.advance(1)
+    assert router.get_stats()["groups"]["group"]["members"][0]["latency_ms"] == 2000
+
+
+def test_failed_call_does_not_update_latency():
+    """失败的调用不更新耗时"""
+    entry = StubEntry("a")
+    router = make_router([entry], POLICY_LATENCY, {"a": 1})
+    asyncio.run(router.groups())
+    with pytest.raises(RuntimeError):
+        with router.track(entry):
+            raise RuntimeError("provider failed")
+    member = router.get_stats()["groups"]["group"]["members"][0]
+    assert member["latency_ms"] is None
+    assert member["outstanding"] == 0
+
+
+def stream_with(monkeypatch, behaviours):
+    """用给定的各配置行为驱动 main.generation_stream，返回产出的事件类型"""
+    import main
+
+    entries = [StubEntry(name) for name in behaviours]
+
+    async def route_generation(request):
+        return entries
+
+    async def prepare_generation(request, entry):
+        return main.PreparedGeneration(entry, None, "text_to_image", "model")
+
+    async def generation_events(request, prepared, provider_task_id=None):
+        for event in behaviours[prepared.entry.config["id"]]:
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    monkeypatch.setattr(main, "route_generation", route_generation)
+    monkeypatch.setattr(main, "prepare_generation", prepare_generation)
+    monkeypatch.setattr(main, "generation_events", generation_events)
+
+    async def run():
+        events = []
+        try:
+            async for event in main.generation_stream(None):
+                events.append(event["type"])
+        except RuntimeError as e:
+            events.append(f"raised: {e}")
+        return events
+
+    return asyncio.run(run())
+
+
+def test_stream_fails_over_before_submit(monkeypatch):
+    """还没有产出任务或图片时失败，切换到下一个配置"""
+    events = stream_with(monkeypatch, {
+        "a": [RuntimeError("submit failed")],
+        "b": [{"type": "task", "task_id": "t1"}, {"type": "complete"}]
+    })
+    assert events == ["start", "failover", "start", "task", "complete"]
+
+
+def test_stream_does_not_fail_over_after_submit(monkeypatch):
+    """任务已提交后失败不再切换，避免重复生成"""
+    events = stream_with(monkeypatch, {
+        "a": [{"type": "task", "task_id": "t1"}, RuntimeError("task failed")],
+        "b": [{"type": "complete"}]
+    })
+    assert events == ["start", "task", "raised: task failed"]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 验证缩略图后台处理
+检查队列满时被丢弃的图片由补全重新提交，以及处理失败的图片不重复提交
+"""
+
+import asyncio
+import io
+import sys
+
+from PIL import Image
+
+sys.path.append('backend')
+
+import database
+import thumbnails
+from image_executor import ImageExecutor
+from image_store import ImageStore
+from thumbnails import ThumbnailPipeline
+
+
+def png(color, size=(600, 400)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def record(number, image_hashes):
+    return {
+        "id": f"record-{number}",
+        "prompt": f"提示词 {number}",
+        "images": [{"hash": image_hash, "url": None} for image_hash in image_hashes],
+        "parameters": {"model": "doubao-seedream-4-0-250828", "width": 600, "height": 400},
+        "provider": "doubao",
+        "api_config_id": "config",
+        "latency_ms": 100,
+        "timestamp": f"2024-01-01 00:00:0{number}"
+    }
+
+
+async def wait_processed(pipeline, count, timeout=30):
+    for _ in range(int(timeout / 0.05)):
+        if pipeline.processed + pipeline.failed >= count and not pipeline.queue_depth:
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError(pipeline.get_stats())
+
+
+def test_dropped_images_are_backfilled(monkeypatch, tmp_path, run_with_database):
+    """队列满时丢弃的图片没有元数据，补全在队列空闲时把它们重新提交，损坏的图片不重复提交"""
+    store = ImageStore(str(tmp_path / "images"))
+    executor = ImageExecutor(workers=1, max_queue_size=2, task_timeout=30)
+    monkeypatch.setattr(thumbnails, "BACKFILL_IDLE_CHECK", 0.05)
+    monkeypatch.setattr(thumbnails, "BACKFILL_BATCH_SIZE", 2)
+
+    async def scenario():
+        # 启动时还没有历史记录，补全不提交；backfill_interval=0 时只在启动时补全一次
+        pipeline = ThumbnailPipeline(store.root, sizes=[256], workers=1, max_queue_size=1,
+                                     executor=executor, backfill_interval=0)
+        pipeline.start()
+        try:
+            await pipeline._backfill
+            assert pipeline.backfilled == 0
+
+            hashes = [await store.put_bytes(png((number * 40, 0, 0))) for number in range(5)]
+            broken = await store.put_bytes(b"\x89PNG\r\n\x1a\nbroken")
+            await database.insert_history_batch([record(0, hashes[:3]), record(1, hashes[3:] + [broken])])
+            for image_hash in hashes:
+                pipeline.submit(image_hash)
+            assert pipeline.dropped == 4
+            await wait_processed(pipeline, 1)
+
+            assert await pipeline.backfill() == 5
+            await wait_processed(pipeline, 6)
+            assert all([await database.image_metadata_exists(image_hash) for image_hash in hashes])
+            assert (pipeline.processed, pipeline.failed) == (5, 1)
+
+            missing = await database.fetch_images_without_metadata("", 10)
+            assert missing == [broken]
+            # 损坏的图片本进程不再提交
+            assert await pipeline.backfill() == 0
+            assert pipeline.get_stats()["backfilled"] == 5
+        finally:
+            await pipeline.stop()
+            await executor.stop()
+
+    run_with_database(scenario)